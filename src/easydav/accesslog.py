@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+'''Asynchronous logging and the access log. Log records are put in a
+queue, and a writer thread in each process writes them to the log files,
+so that slow storage does not delay the requests. If the writer falls
+behind by config.log_queue_size records, new records are dropped and
+counted in the easydav_log_records_dropped_total metric instead of
+blocking.
+
+The access log has one JSON line for each request:
+
+    {"time": "2026-10-17T12:00:00Z", "method": "PROPFIND", "path": "/dir/",
+     "status": 207, "bytes_in": 0, "bytes_out": 5120, "duration": 0.0213,
+     "lock_db": 0.0004, "fs": 0.0112, ...}
+
+Lock_db is the time spent in lock database queries and fs the time spent
+in stat, read and write calls of the file system. Successful requests of
+the methods in config.access_log_sample are logged only with the given
+probability, and then carry the field "sample" for scaling the counts.
+'''
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import Queue
+import davutils
+import metrics
+
+class QueueHandler(logging.Handler):
+    '''Logging handler that passes the records to a writer thread, which
+    emits them through the target handlers. Python 2 does not have
+    logging.handlers.QueueHandler. Log is the label of the dropped records
+    in the metrics.
+    '''
+    def __init__(self, handlers, maxsize = 10000, log = 'main'):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.log = log
+        self.queue = None
+        self.pid = None
+        self.dropped = 0
+    
+    def prepare(self, record):
+        '''Format the message and traceback in the calling thread, as the
+        arguments of the record may change before it is written.'''
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+    
+    def start(self):
+        '''Start the writer thread of the process. Threads do not survive
+        fork(), and neither should the records queued by the parent.'''
+        self.queue = Queue.Queue(self.maxsize)
+        self.pid = os.getpid()
+        thread = threading.Thread(target = self.writer_loop,
+                                  args = (self.queue, ), name = 'log writer')
+        thread.daemon = True
+        thread.start()
+    
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+            metrics.log_records_dropped.inc((self.log, ))
+    
+    def writer_loop(self, queue):
+        while True:
+            record = queue.get()
+            try:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                queue.task_done()
+    
+    def flush(self, timeout = 5.0):
+        '''Wait until the queued records have been written.'''
+        queue = self.queue
+        if queue is None or self.pid != os.getpid():
+            return
+        
+        deadline = time.time() + timeout
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks and time.time() < deadline:
+                queue.all_tasks_done.wait(deadline - time.time())
+    
+    def close(self):
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+access_logger = logging.getLogger('easydav.access')
+access_logger.propagate = False
+access_logger.setLevel(logging.INFO)
+
+def initialize(filename):
+    '''Write the access log to the file.'''
+    filehandler = logging.FileHandler(filename = filename)
+    filehandler.setFormatter(logging.Formatter('%(message)s'))
+    access_logger.addHandler(QueueHandler([filehandler],
+                                          config.log_queue_size, 'access'))
+
+def sample_rate(method, status):
+    '''Return the probability of logging a request. Errors are always
+    logged.'''
+    if status >= 400:
+        return 1.0
+    return config.access_log_sample.get(method, 1.0)
+
+def log_request(environ, status, bytes_in, bytes_out, duration,
+                lock_db, fs):
+    '''Write the access log line of a request, unless it is left out by
+    sampling. Status is the numeric HTTP status code.'''
+    method = environ.get('REQUEST_METHOD', '').upper()
+    rate = sample_rate(method, status)
+    if (rate < 1.0 and duration < config.access_log_slow
+            and random.random() >= rate):
+        return
+    
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    entry = {
+        'time': davutils.get_isoformat(time.time()),
+        'pid': os.getpid(),
+        'remote': environ.get('REMOTE_ADDR'),
+        'user': environ.get('REMOTE_USER'),
+        'method': method,
+        'path': path.decode('utf-8', 'replace'),
+        'status': status,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'duration': round(duration, 6),
+        'lock_db': round(lock_db, 6),
+        'fs': round(fs, 6),
+    }
+    if rate < 1.0:
+        entry['sample'] = rate
+    
+    access_logger.info(json.dumps(entry, sort_keys = True))
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import StringIO
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        log_queue_size = 10000
+        access_log_sample = {'PROPFIND': 0.1}
+        access_log_slow = 1.0
+    
+    class SlowHandler(logging.StreamHandler):
+        def emit(self, record):
+            time.sleep(0.01)
+            logging.StreamHandler.emit(self, record)
+    
+    output = StringIO.StringIO()
+    target = SlowHandler(output)
+    target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    handler = QueueHandler([target], maxsize = 5)
+    logger = logging.getLogger('test')
+    logger.propagate = False
+    logger.addHandler(handler)
+    
+    # Logging does not wait for the slow handler, and the records that
+    # do not fit in the queue are dropped.
+    start = time.time()
+    for i in range(20):
+        logger.warning('message %d', i)
+    assert time.time() - start < 0.1
+    handler.flush()
+    lines = output.getvalue().splitlines()
+    assert lines[0] == 'WARNING message 0'
+    assert 5 <= len(lines) <= 6 and handler.dropped == 20 - len(lines)
+    assert metrics.log_records_dropped.values == {('main', ): handler.dropped}
+    
+    try:
+        raise ValueError('test')
+    except ValueError:
+        logger.error('failed', exc_info = 1)
+    handler.flush()
+    assert output.getvalue().splitlines()[-1] == 'ValueError: test'
+    
+    output = StringIO.StringIO()
+    handler = logging.StreamHandler(output)
+    access_logger.addHandler(handler)
+    environ = {'REQUEST_METHOD': 'propfind', 'SCRIPT_NAME': '/dav',
+               'PATH_INFO': '/dir \xc3\xa4/', 'REMOTE_ADDR': '10.0.0.1'}
+    
+    random.seed(1)
+    for i in range(1000):
+        log_request(environ, 207, 100, 5000, 0.01, 0.001, 0.002)
+    entries = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert 50 < len(entries) < 150
+    assert entries[0]['path'] == u'/dav/dir \xe4/'
+    assert entries[0]['method'] == 'PROPFIND'
+    assert (entries[0]['status'], entries[0]['bytes_out'],
+            entries[0]['lock_db'], entries[0]['sample']) == \
+        (207, 5000, 0.001, 0.1)
+    
+    # Errors and slow requests are always logged
+    output.truncate(0)
+    log_request(environ, 404, 0, 9, 0.01, 0, 0)
+    log_request(environ, 207, 0, 9, 2.5, 0, 0)
+    environ['REQUEST_METHOD'] = 'PUT'
+    log_request(environ, 201, 9, 0, 0.01, 0, 0.005)
+    entries = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [entry['status'] for entry in entries] == [404, 207, 201]
+    assert 'sample' not in entries[2] and entries[2]['fs'] == 0.005
+    
+    print "Unit tests OK"
@@ -0,0 +1,1087 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Performance benchmarks for EasyDAV.
+
+Run all benchmarks with 'python benchmark.py', or only some of them by
+giving their names as arguments, e.g. 'python benchmark.py server'.
+The benchmarks run against a temporary root_dir and never touch the
+configured one.
+
+The 'micro' benchmarks time the hot paths of single requests. Their
+results can be saved as JSON and later compared to, to catch regressions:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+When --save or --compare is given without benchmark names, only the
+'micro' benchmarks are run. With --compare, the exit status is 1 if any
+of them is slower than the baseline by more than --threshold.
+'''
+
+import cgi
+import datetime
+import httplib
+import json
+import multiprocessing
+import optparse
+import os
+import os.path
+import platform
+import shutil
+import socket
+import string
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+# Templates are loaded relative to the working directory.
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import webdavconfig as config
+config.root_dir = tempfile.mkdtemp(prefix = 'easydav-bench-')
+config.log_file = None
+config.access_log = None
+config.log_level = 40
+
+import davutils
+import davxml
+import etags
+import filecopy
+import lock_manager
+import requestinfo
+import webdav
+import server
+import zipstream
+from wsgi_input_wrapper import WSGIInputWrapper
+
+def wsgi_request(method, path, body = '', headers = {}):
+    '''Call webdav.main directly, without a HTTP server.
+    Returns status, the length of response body and the response headers
+    as a dictionary.
+    '''
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'HTTP_HOST': 'localhost',
+        'REMOTE_ADDR': '127.0.0.1',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO.StringIO(body),
+    }
+    environ.update(headers)
+    
+    response = []
+    def start_response(status, headers, exc_info = None):
+        response.append((status, dict(headers)))
+    
+    body = webdav.main(environ, start_response)
+    length = sum(len(data) for data in body)
+    if hasattr(body, 'close'):
+        body.close()
+    status, headers = response[0]
+    return status, length, headers
+
+def make_tree(path, files, size = 0):
+    '''Create a directory containing the given number of files.'''
+    os.mkdir(path)
+    data = 'x' * size
+    for i in range(files):
+        open(os.path.join(path, 'file%06d.dcm' % i), 'wb').write(data)
+
+def timeit(func, repeat = 5):
+    '''Return the best wall clock time of several calls to func.'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def count_syscalls(func):
+    '''Count the calls to os.stat, os.lstat and os.access made by func.
+    The os.path functions such as exists and getsize go through these.
+    '''
+    counter = [0]
+    originals = {}
+    
+    def wrap(name):
+        original = originals[name] = getattr(os, name)
+        def counted(*args):
+            counter[0] += 1
+            return original(*args)
+        setattr(os, name, counted)
+    
+    for name in ('stat', 'lstat', 'access'):
+        wrap(name)
+    try:
+        func()
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return counter[0]
+
+def free_port():
+    '''Find a TCP port that is currently not in use.'''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def run_server(port, mode, workers):
+    '''Target for the server process used by bench_server.'''
+    httpd = server.make_server('127.0.0.1', port, webdav.main,
+        mode = mode, workers = workers, backlog = 128, keepalive = 15)
+    httpd.serve_forever()
+
+def wait_for_port(port, timeout = 10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('Server did not start on port %d' % port)
+
+def client_loop(port, client_id, deadline, counts):
+    '''Repeat a PUT / GET / PROPFIND cycle until deadline. The PUT body is
+    sent in pieces with small pauses, like a client on a slow network, so
+    that a server which serves one request at a time stalls the others.
+    '''
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    path = '/bench/client%d.bin' % client_id
+    piece = 'x' * 8192
+    pieces = 8
+    done = 0
+
+    while time.time() < deadline:
+        conn.putrequest('PUT', path)
+        conn.putheader('Content-Length', str(len(piece) * pieces))
+        conn.endheaders()
+        for i in range(pieces):
+            conn.send(piece)
+            time.sleep(0.002)
+        conn.getresponse().read()
+
+        conn.request('GET', path)
+        conn.getresponse().read()
+
+        conn.request('PROPFIND', '/bench/', headers = {'Depth': '1'})
+        conn.getresponse().read()
+        done += 3
+
+    conn.close()
+    counts[client_id] = done
+
+def legacy_get_locks(manager, rel_path, recursive):
+    '''The SQL query that LockManager.get_locks used before the in-memory
+    lock index.
+    '''
+    path_exprs = ['path = ?']
+    path_args = [rel_path]
+    
+    partial_path = rel_path
+    while partial_path:
+        partial_path = os.path.dirname(partial_path)
+        path_exprs.append('(infinite_depth AND path = ?)')
+        path_args.append(partial_path)
+    
+    if recursive:
+        if rel_path != '':
+            prefix = rel_path + '/'
+        else:
+            prefix = ''
+        
+        path_exprs.append('SUBSTR(path,1,?) = ?')
+        path_args.append(len(prefix))
+        path_args.append(prefix)
+    
+    manager._sql_query('SELECT * FROM locks WHERE '
+        + "valid_until >= DATETIME('now') AND ("
+        + ' OR '.join(path_exprs) + ')', path_args)
+    return map(lock_manager.Lock, manager.db_cursor.fetchall())
+
+def insert_locks(manager, locks):
+    '''Fill the lock database with shared locks spread over a tree of
+    100 x 100 directories. Returns the inserted rows.'''
+    valid_until = datetime.datetime.utcnow() + datetime.timedelta(hours = 1)
+    rows = []
+    for i in range(locks):
+        path = u'dir%02d/sub%02d/file%06d' % (i % 100, i / 100 % 100, i)
+        rows.append((uuid.uuid4().urn, path, True, '', False, valid_until))
+    
+    manager._sql_query('BEGIN IMMEDIATE TRANSACTION')
+    manager.db_cursor.executemany('INSERT INTO locks VALUES (?,?,?,?,?,?)', rows)
+    manager.db_cursor.executemany(
+        'INSERT INTO lock_changes (urn) VALUES (?)', [row[:1] for row in rows])
+    manager._sql_query('END TRANSACTION')
+    return rows
+
+def bench_locks(locks = 100000, queries = 500):
+    '''Lock checks against a database of many active locks, with the old
+    SQL queries and with the in-memory lock index.
+    '''
+    manager = lock_manager.LockManager()
+    rows = insert_locks(manager, locks)
+    
+    paths = [rows[i * locks / queries][1] for i in range(queries)]
+    
+    def query_all(get_locks, recursive):
+        for path in paths:
+            if recursive:
+                path = path.rsplit('/', 1)[0]
+            get_locks(path, recursive)
+    
+    def legacy(path, recursive):
+        return legacy_get_locks(manager, path, recursive)
+    
+    def full_load():
+        manager.index.clear()
+        manager.get_locks('', False)
+    
+    print 'Lock checks with %d active locks, %d queries per run' % (
+        locks, queries)
+    print 'Full index load: %.3f s' % timeit(full_load, 1)
+    
+    print '%-10s %-10s %12s' % ('query', 'method', 'us/query')
+    for recursive in (False, True):
+        label = recursive and 'depth inf' or 'depth 0'
+        for method, get_locks in (('sql', legacy),
+                                  ('index', manager.get_locks)):
+            elapsed = timeit(lambda: query_all(get_locks, recursive), 3)
+            print '%-10s %-10s %12.1f' % (label, method,
+                                          elapsed / queries * 1e6)
+    
+    # Changes made by another process are applied to the index one by one.
+    other = lock_manager.LockManager()
+    other.index = lock_manager.LockIndex()
+    other.get_locks('', False)
+    
+    def incremental():
+        lock = manager.create_lock(u'changed', False, '', 0, 100)
+        manager.release_lock(lock.path, lock.urn)
+        other.get_locks(u'changed', False)
+    
+    elapsed = timeit(incremental, 20)
+    print 'Create + release + index update in other process: %.2f ms' % (
+        elapsed * 1e3)
+    
+    manager.close()
+    other.close()
+
+LOCK_BODY = '''<?xml version="1.0" encoding="utf-8"?>
+<D:lockinfo xmlns:D="DAV:">
+    <D:lockscope><D:exclusive/></D:lockscope>
+    <D:locktype><D:write/></D:locktype>
+    <D:owner>benchmark</D:owner>
+</D:lockinfo>'''
+
+def lock_cycle_loop(client_id, deadline, results):
+    '''Repeat a LOCK / PUT / UNLOCK cycle until deadline and put the
+    (method, status, seconds) of each request in the results queue.
+    '''
+    path = '/stress/client%d.txt' % client_id
+    timings = []
+    
+    def timed(method, *args, **kwargs):
+        start = time.time()
+        status, length, headers = wsgi_request(method, path, *args, **kwargs)
+        timings.append((method, status[:3], time.time() - start))
+        return status, headers
+    
+    while time.time() < deadline:
+        status, headers = timed('LOCK', LOCK_BODY)
+        if status[:3] not in ('200', '201'):
+            continue
+        
+        token = headers['Lock-Token']
+        timed('PUT', 'x' * 1024, {'HTTP_IF': '(<%s>)' % token})
+        timed('UNLOCK', headers = {'HTTP_LOCK_TOKEN': '<%s>' % token})
+    
+    results.put(timings)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_lockstress(duration = 5, processes = 16, lock_wait = 1):
+    '''Many processes creating and removing locks at the same time,
+    with the old rollback journal and with the default storage profile.
+    '''
+    os.mkdir(os.path.join(config.root_dir, 'stress'))
+    saved = (config.lock_db, config.lock_wait, config.lock_journal_mode,
+             config.lock_synchronous)
+    config.lock_wait = lock_wait
+    
+    print 'LOCK / PUT / UNLOCK, %d processes, %d s per run, lock_wait %s s' % (
+        processes, duration, lock_wait)
+    print '%-8s %-8s %10s %10s %10s %8s' % ('journal', 'sync', 'requests/s',
+        'p50 (ms)', 'p99 (ms)', '503 (%)')
+    
+    try:
+        for journal, sync in (('DELETE', 'FULL'), ('WAL', 'NORMAL')):
+            config.lock_db = '.easydav_locks_' + journal.lower()
+            config.lock_journal_mode = journal
+            config.lock_synchronous = sync
+            
+            results = multiprocessing.Queue()
+            deadline = time.time() + duration
+            procs = [multiprocessing.Process(target = lock_cycle_loop,
+                args = (i, deadline, results)) for i in range(processes)]
+            start = time.time()
+            for proc in procs:
+                proc.start()
+            timings = []
+            for proc in procs:
+                timings += results.get()
+            for proc in procs:
+                proc.join()
+            elapsed = time.time() - start
+            
+            latencies = [t for method, status, t in timings]
+            busy = len([1 for method, status, t in timings if status == '503'])
+            print '%-8s %-8s %10.1f %10.2f %10.2f %8.2f' % (journal, sync,
+                len(timings) / elapsed,
+                percentile(latencies, 0.5) * 1e3,
+                percentile(latencies, 0.99) * 1e3,
+                100.0 * busy / len(timings))
+    finally:
+        (config.lock_db, config.lock_wait, config.lock_journal_mode,
+         config.lock_synchronous) = saved
+
+def bench_server(duration = 5, clients = 16):
+    '''Request throughput of the stand-alone server with different
+    concurrency modes and worker counts.
+    '''
+    os.mkdir(os.path.join(config.root_dir, 'bench'))
+
+    print 'Server throughput, %d clients, %d s per run' % (clients, duration)
+    print '%-8s %8s %12s' % ('mode', 'workers', 'requests/s')
+
+    runs = [('single', 1)]
+    runs += [('thread', n) for n in (1, 2, 4, 8, 16)]
+    runs += [('process', n) for n in (1, 2, 4, 8)]
+
+    for mode, workers in runs:
+        port = free_port()
+        proc = multiprocessing.Process(target = run_server,
+            args = (port, mode, workers))
+        proc.start()
+        try:
+            wait_for_port(port)
+
+            counts = [0] * clients
+            deadline = time.time() + duration
+            threads = [threading.Thread(target = client_loop,
+                args = (port, i, deadline, counts)) for i in range(clients)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+        finally:
+            proc.terminate()
+            proc.join()
+
+        print '%-8s %8d %12.1f' % (mode, workers, sum(counts) / elapsed)
+
+def bench_dirindex(files = 50000):
+    '''HTML directory listing of a large directory, when the listing is
+    read from the disk and when it comes from the cache.'''
+    make_tree(os.path.join(config.root_dir, 'dirindex'), files)
+    
+    def dirindex(query):
+        status, length, headers = wsgi_request('GET', '/dirindex/',
+            headers = {'QUERY_STRING': query})
+        assert status.startswith('200')
+    
+    def uncached():
+        webdav.dirindex_cache.listings.clear()
+        dirindex('')
+    
+    print 'Directory index of %d files, %d per page' % (files,
+        config.dirindex_page_size)
+    print '%-32s %10s' % ('request', 'time (ms)')
+    runs = [
+        ('first page, not cached', uncached),
+        ('first page', lambda: dirindex('')),
+        ('last page', lambda: dirindex('page=%d' %
+            (files / config.dirindex_page_size))),
+        ('sorted by size', lambda: dirindex('sort=size&order=desc')),
+        ('filter *99.dcm', lambda: dirindex('filter=%2A99.dcm')),
+    ]
+    for label, func in runs:
+        print '%-32s %10.1f' % (label, timeit(func, 3) * 1000)
+
+def bench_propfind(files = 10000):
+    '''Depth: 1 PROPFIND with all properties on a large directory.'''
+    make_tree(os.path.join(config.root_dir, 'propfind'), files)
+    
+    def propfind():
+        status, length, headers = wsgi_request('PROPFIND', '/propfind/',
+            headers = {'HTTP_DEPTH': '1'})
+        assert status.startswith('207')
+    
+    elapsed = timeit(propfind, 3)
+    syscalls = count_syscalls(propfind)
+    print 'PROPFIND Depth: 1 on %d files: %.3f s, %.1f us per entry' % (
+        files, elapsed, elapsed / files * 1e6)
+    print '%.1f stat/access calls per entry' % (float(syscalls) / files)
+
+# The kid templates that rendered PROPFIND and LOCK responses before
+# davxml, for comparison in bench_templates.
+LEGACY_MULTISTATUS = '''<?xml version="1.0" encoding="utf-8" ?>
+<?python
+import kid.parser
+import xml.etree.ElementTree as ET
+from davutils import DAVError
+?>
+<D:multistatus xmlns:D="DAV:" xmlns:py="http://purl.org/kid/ns#">
+    <D:response py:for="real_url, propstats in result_files">
+        <D:href py:content="real_url" />
+        <element py:if="isinstance(propstats, DAVError)" py:strip="">
+            <D:status>HTTP/1.1 ${propstats.httpstatus}</D:status>
+            <D:error py:if="propstats.body"
+                     py:content="XML(propstats.body)" />
+        </element>
+        <D:propstat py:for="status, props in getattr(propstats, 'items', list)()">
+            <D:prop>
+                <element py:for="prop, value in props" py:strip="">
+                    <?python
+                        if isinstance(value, basestring):
+                            value  = [(kid.parser.TEXT, value)]
+                        else:
+                            value = list(XML(''.join(
+                                [ET.tostring(e) for e in value])))
+                    ?>
+                    <element py:replace="kid.parser.ElementStream(
+                        [(kid.parser.START, kid.Element(prop))]
+                        + value
+                        + [(kid.parser.END, kid.Element(prop))])" />
+                </element>
+            </D:prop>
+            <D:status>HTTP/1.1 ${status}</D:status>
+            <D:error py:if="getattr(status, 'body', None)"
+                     py:content="XML(status.body)" />
+        </D:propstat>
+    </D:response>
+</D:multistatus>
+'''
+
+LEGACY_ACTIVELOCK = '''<?xml version="1.0" encoding="utf-8" ?>
+<?python import urlparse ?>
+<D:prop xmlns:D="DAV:" xmlns:py="http://purl.org/kid/ns#">
+    <D:lockdiscovery>
+        <D:activelock>
+            <D:locktype><D:write/></D:locktype>
+            <D:lockscope>
+                <D:exclusive py:if="not lock.shared" />
+                <D:shared py:if="lock.shared" />
+            </D:lockscope>
+            <D:depth py:if="lock.infinite_depth">infinity</D:depth>
+            <D:depth py:if="not lock.infinite_depth">0</D:depth>
+            <D:owner py:replace="XML(lock.owner)"></D:owner>
+            <D:timeout>Second-${str(lock.seconds_until_timeout())}</D:timeout>
+            <D:locktoken>
+                <D:href>${lock.urn}</D:href>
+            </D:locktoken>
+            <D:lockroot>
+                <D:href>${urlparse.urljoin(root_url, lock.path)}</D:href>
+            </D:lockroot>
+        </D:activelock>
+    </D:lockdiscovery>
+</D:prop>
+'''
+
+def startup_time(code, cleanup = None, repeat = 5):
+    '''Best wall clock time of running code in a new python process.'''
+    best = None
+    for i in range(repeat):
+        if cleanup:
+            cleanup()
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c',
+            'import webdavconfig; webdavconfig.log_file = None\n'
+            'webdavconfig.access_log = None\n' + code])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_templates(files = 1000, repeat = 20):
+    '''Process startup and response rendering with davxml and with the
+    kid templates that were loaded when webdav.py was imported.
+    '''
+    import kid
+    
+    tempdir = tempfile.mkdtemp(prefix = 'easydav-kid-')
+    legacy_files = []
+    for name, source in (('multistatus', LEGACY_MULTISTATUS),
+                         ('activelock', LEGACY_ACTIVELOCK)):
+        path = os.path.join(tempdir, name + '.kid')
+        open(path, 'w').write(source)
+        legacy_files.append(path)
+    
+    def remove_compiled():
+        for path in legacy_files + ['dirindex.kid']:
+            if os.path.exists(path[:-4] + '.pyc'):
+                os.unlink(path[:-4] + '.pyc')
+    
+    legacy_import = ('import kid, webdav\n' +
+        ''.join(['kid.load_template(%r)\n' % path for path in legacy_files]) +
+        'webdav.get_template("dirindex")\n')
+    dirindex_import = 'import webdav\nwebdav.get_template("dirindex")\n'
+    
+    print '%-40s %10s' % ('process startup', 'time (ms)')
+    runs = [
+        ('python only', 'pass', None),
+        ('import webdav', 'import webdav', None),
+        ('  + dirindex, precompiled', dirindex_import, None),
+        ('  + dirindex, compiled each time', dirindex_import, remove_compiled),
+        ('kid templates at import (old)', legacy_import, None),
+        ('  compiled each time', legacy_import, remove_compiled),
+    ]
+    for label, code, cleanup in runs:
+        print '%-40s %10.1f' % (label, startup_time(code, cleanup) * 1000)
+    print
+    
+    multistatus = kid.load_template(legacy_files[0])
+    activelock = kid.load_template(legacy_files[1])
+    
+    tree = os.path.join(config.root_dir, 'templates')
+    make_tree(tree, files)
+    results = []
+    for path in [tree] + [os.path.join(tree, name)
+                          for name in sorted(os.listdir(tree))]:
+        results.append(('http://localhost/templates/' + os.path.basename(path),
+            webdav.read_properties(path, os.stat(path),
+                                   webdav.property_handlers.keys())))
+    
+    lock = lock_manager.Lock({
+        'urn': 'urn:uuid:' + str(uuid.uuid4()),
+        'path': u'templates/file000000.dcm',
+        'shared': False,
+        'owner': '<D:owner xmlns:D="DAV:"><D:href>bench</D:href></D:owner>',
+        'infinite_depth': False,
+        'valid_until': datetime.datetime.utcnow()
+                       + datetime.timedelta(seconds = 3600),
+    })
+    root_url = 'http://localhost/'
+    
+    def propfind_kid():
+        multistatus.Template(result_files = results).serialize(output = 'xml')
+    
+    def propfind_davxml():
+        ''.join(davxml.multistatus(results))
+    
+    def lock_kid():
+        for i in range(repeat):
+            activelock.Template(lock = lock,
+                root_url = root_url).serialize(output = 'xml')
+    
+    def lock_davxml():
+        for i in range(repeat):
+            davxml.activelock(lock, root_url)
+    
+    print '%-24s %12s %12s %8s' % ('response', 'kid (ms)', 'davxml (ms)',
+                                  'speedup')
+    for label, count, legacy, fast in (
+            ('PROPFIND %d entries' % len(results), 1,
+             propfind_kid, propfind_davxml),
+            ('LOCK', repeat, lock_kid, lock_davxml)):
+        legacy_time = timeit(legacy, 3) / count
+        fast_time = timeit(fast, 3) / count
+        print '%-24s %12.3f %12.3f %7.1fx' % (label, legacy_time * 1000,
+            fast_time * 1000, legacy_time / fast_time)
+    
+    shutil.rmtree(tempdir)
+
+def bench_match(studies = 100, series = 10, images = 100):
+    '''Access rule checks as done for every entry of a PROPFIND, with
+    compare_path and with the compiled PathMatcher.
+    '''
+    paths = []
+    for i in range(studies):
+        for j in range(series):
+            for k in range(images):
+                paths.append(os.path.join(config.root_dir, 'data',
+                    'study%03d' % i, 'series%02d' % j, 'image%04d.dcm' % k))
+    
+    print 'Access checks on %d paths, %d + %d patterns' % (len(paths),
+        len(config.restrict_access), len(config.restrict_write))
+    print '%-14s %10s' % ('method', 'us/path')
+    
+    def legacy():
+        for path in paths:
+            davutils.compare_path(path, config.restrict_access)
+            davutils.compare_path(path, config.restrict_write)
+    
+    def compiled():
+        access = davutils.PathMatcher(config.restrict_access)
+        write = davutils.PathMatcher(config.restrict_write)
+        for path in paths:
+            access.match(path)
+            write.match(path)
+    
+    for label, func in (('compare_path', legacy), ('PathMatcher', compiled)):
+        elapsed = timeit(func, 3)
+        print '%-14s %10.2f' % (label, elapsed / len(paths) * 1e6)
+
+def bench_put(small_files = 500, small_size = 4096,
+              large_files = 8, large_size = 16*1024*1024):
+    '''Upload throughput with each upload_fsync mode, for many small
+    files and for a few large ones.
+    '''
+    directory = os.path.join(config.root_dir, 'put')
+    os.mkdir(directory)
+    saved = config.upload_fsync
+    
+    print '%-6s %-10s %10s %10s' % ('fsync', 'files', 'files/s', 'MB/s')
+    try:
+        for mode in (None, 'file', 'dir'):
+            config.upload_fsync = mode
+            for count, size in ((small_files, small_size),
+                                (large_files, large_size)):
+                body = 'x' * size
+                
+                def upload():
+                    for i in range(count):
+                        status, length, headers = wsgi_request('PUT',
+                            '/put/file%d' % i, body)
+                        assert status[:3] in ('201', '204')
+                
+                elapsed = timeit(upload, 3)
+                print '%-6s %-10s %10.1f %10.1f' % (mode,
+                    '%d x %dk' % (count, size / 1024), count / elapsed,
+                    count * size / elapsed / 1e6)
+    finally:
+        config.upload_fsync = saved
+
+def bench_copy(small_files = 20000, small_size = 4096,
+               large_files = 4, large_size = 256*1024*1024):
+    '''Server-side copy of a tree of many small files and of a few large
+    ones, with shutil.copytree and with filecopy.copy_tree using
+    different numbers of threads.'''
+    trees = []
+    for count, size in ((small_files, small_size),
+                        (large_files, large_size)):
+        tree = os.path.join(config.root_dir, 'copy%d' % count)
+        os.mkdir(tree)
+        data = os.urandom(min(size, 1024*1024)) * max(1, size / (1024*1024))
+        for i in range(count):
+            directory = os.path.join(tree, 'series%02d' % (i / 1000))
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+            open(os.path.join(directory, 'image%05d' % i), 'wb').write(data)
+        trees.append((tree, count, size))
+    
+    fd_in = os.open(os.path.join(trees[0][0], 'series00', 'image00000'),
+                    os.O_RDONLY)
+    fd_out = os.open(os.path.join(config.root_dir, 'method'),
+                     os.O_WRONLY | os.O_CREAT)
+    print 'Copy method on this file system:', filecopy.copy_data(fd_in, fd_out)
+    os.close(fd_in)
+    os.close(fd_out)
+    
+    print '%-12s %-24s %10s %10s %10s' % ('files', 'method', 'time (s)',
+                                          'files/s', 'MB/s')
+    for tree, count, size in trees:
+        dest = tree + '_dest'
+        runs = [('shutil.copytree', lambda: shutil.copytree(tree, dest,
+                                                            symlinks = True))]
+        runs += [('copy_tree, %d thread(s)' % n,
+                  lambda n = n: filecopy.copy_tree(tree, dest, n))
+                 for n in (1, 4, 8)]
+        for label, func in runs:
+            elapsed = None
+            for i in range(3):
+                start = time.time()
+                func()
+                elapsed = min(elapsed or 1e9, time.time() - start)
+                shutil.rmtree(dest)
+            print '%-12s %-24s %10.2f %10.1f %10.1f' % (
+                '%d x %dk' % (count, size / 1024), label, elapsed,
+                count / elapsed, count * size / elapsed / 1e6)
+
+def bench_delete(files = 20000):
+    '''Latency of DELETE on a directory tree, removed during the request
+    and moved to the trash.'''
+    saved = config.trash_dir
+    print 'DELETE of a directory with %d files' % files
+    print '%-12s %12s' % ('trash_dir', 'time (ms)')
+    try:
+        for trash_dir in (None, '.easydav_trash'):
+            config.trash_dir = trash_dir
+            
+            def delete():
+                status, length, headers = wsgi_request('DELETE', '/delete')
+                assert status.startswith('204')
+            
+            best = None
+            for i in range(3):
+                make_tree(os.path.join(config.root_dir, 'delete'), files)
+                elapsed = timeit(delete, 1)
+                best = min(best or elapsed, elapsed)
+            print '%-12s %12.1f' % (trash_dir, best * 1000)
+    finally:
+        config.trash_dir = saved
+
+def io_bytes_written():
+    '''Return the number of bytes this process has passed to write()
+    calls, from /proc/self/io, or None if it is not available.'''
+    try:
+        for line in open('/proc/self/io'):
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+    except IOError:
+        return None
+
+def legacy_post_upload(body, content_type, dest_dir):
+    '''The upload of the HTML interface before multipart.py: the cgi module
+    spools the file part to a temporary file, which is then copied to the
+    destination.'''
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    fields = cgi.FieldStorage(fp = StringIO.StringIO(body), environ = environ)
+    f = fields['file']
+    webdav.write_file(os.path.join(dest_dir, f.filename),
+                      davutils.read_blocks(f.file))
+
+def bench_upload(size = 128*1024*1024):
+    '''Throughput of a file upload through the HTML interface, with the
+    old cgi.FieldStorage based parsing and with the streaming multipart
+    parser.'''
+    directory = os.path.join(config.root_dir, 'upload')
+    os.mkdir(directory)
+    
+    boundary = '----WebKitFormBoundary' + uuid.uuid4().hex[:16]
+    content_type = 'multipart/form-data; boundary=' + boundary
+    body = ''.join([
+        '--', boundary, '\r\n',
+        'Content-Disposition: form-data; name="file"; filename="upload.bin"',
+        '\r\nContent-Type: application/octet-stream\r\n\r\n',
+        os.urandom(1024*1024) * (size / (1024*1024)),
+        '\r\n--', boundary, '\r\n',
+        'Content-Disposition: form-data; name="btn_upload"\r\n\r\n',
+        'Upload\r\n--', boundary, '--\r\n'])
+    
+    def streaming():
+        status, length, headers = wsgi_request('POST', '/upload/', body,
+            {'CONTENT_TYPE': content_type})
+        assert status.startswith('200')
+    
+    print 'HTML form upload of a %d MB file' % (size >> 20)
+    print '%-20s %10s %10s %16s' % ('parser', 'time (s)', 'MB/s',
+                                    'written (MB)')
+    runs = [
+        ('cgi.FieldStorage',
+         lambda: legacy_post_upload(body, content_type, directory)),
+        ('multipart', streaming),
+    ]
+    for label, func in runs:
+        before = io_bytes_written()
+        elapsed = timeit(func, 3)
+        written = io_bytes_written()
+        if written is None:
+            written = '-'
+        else:
+            written = '%.0f' % ((written - before) / 3 / 1e6)
+        print '%-20s %10.2f %10.1f %16s' % (label, elapsed,
+            size / elapsed / 1e6, written)
+
+def bench_zip(total_size = 2 << 30, file_size = 16 << 20):
+    '''ZIP export of a synthetic tree of moderately compressible files,
+    with the old add_to_zip_recursively into a temporary file and with
+    zipstream using different numbers of compression threads.
+    '''
+    tree = os.path.join(config.root_dir, 'zip')
+    os.mkdir(tree)
+    
+    # Random bytes limited to 16 values compress to about half.
+    table = string.maketrans(''.join(map(chr, range(256))),
+                             'abcdefghijklmnop' * 16)
+    data = os.urandom(file_size + 65536).translate(table)
+    for i in range(total_size / file_size):
+        directory = os.path.join(tree, 'series%02d' % (i / 16))
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        offset = i * 4099 % 65536
+        open(os.path.join(directory, 'image%04d' % i), 'wb').write(
+            data[offset:offset + file_size])
+    
+    def check_read(path):
+        return True
+    
+    def legacy():
+        datafile = tempfile.TemporaryFile()
+        zipobj = zipfile.ZipFile(datafile, 'w', zipfile.ZIP_DEFLATED, True)
+        davutils.add_to_zip_recursively(zipobj, tree, config.root_dir,
+                                        check_read)
+        zipobj.close()
+        size = datafile.tell()
+        datafile.seek(0)
+        for block in davutils.read_blocks(datafile):
+            pass
+        return size
+    
+    def streaming(workers):
+        return sum(len(block) for block in zipstream.zip_recursively([tree],
+            config.root_dir, check_read, workers = workers))
+    
+    print 'ZIP export of %d MB in %d MB files' % (total_size >> 20,
+                                                 file_size >> 20)
+    print '%-30s %10s %10s %8s' % ('method', 'time (s)', 'MB/s', 'ratio')
+    runs = [('add_to_zip_recursively', legacy)]
+    runs += [('zip_recursively, %d thread(s)' % n,
+              lambda n = n: streaming(n)) for n in (1, 2, 4, 8)]
+    for label, func in runs:
+        start = time.time()
+        size = func()
+        elapsed = time.time() - start
+        print '%-30s %10.2f %10.1f %8.2f' % (label, elapsed,
+            total_size / elapsed / 1e6, float(size) / total_size)
+
+def legacy_search_directory(directory, depth = -1):
+    '''The os.listdir and os.path.isdir based walker that was used before
+    davutils.walk_directory, with its isdir() call fixed to use the full
+    path so that it actually recurses.
+    '''
+    yield directory
+    
+    if depth == 0 or not os.path.isdir(directory):
+        return
+    
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if os.path.isdir(path):
+            for path in legacy_search_directory(path, depth - 1):
+                yield path
+        else:
+            yield path
+
+def bench_walk(wide_files = 20000, deep_levels = 100, deep_files = 20):
+    '''Directory walk followed by a stat of each entry, like PROPFIND does,
+    on a wide and on a deep tree.
+    '''
+    wide = os.path.join(config.root_dir, 'wide')
+    make_tree(wide, wide_files)
+    
+    deep = os.path.join(config.root_dir, 'deep')
+    path = deep
+    for i in range(deep_levels):
+        make_tree(path, deep_files)
+        path = os.path.join(path, 'sub')
+    
+    def legacy(tree):
+        for path in legacy_search_directory(tree):
+            os.stat(path)
+    
+    def walker(tree):
+        for entry in davutils.walk_directory(tree):
+            entry.stat()
+    
+    def listdir_walker(tree):
+        saved = davutils.scandir
+        davutils.scandir = None
+        try:
+            walker(tree)
+        finally:
+            davutils.scandir = saved
+    
+    # The scandir module makes its stat calls in C, so they can not be
+    # counted by replacing os.stat.
+    print '%-6s %-24s %10s %14s' % ('tree', 'walker', 'time (s)', 'os.stat/file')
+    for name, tree in (('wide', wide), ('deep', deep)):
+        entries = len(list(legacy_search_directory(tree)))
+        runs = [('search_directory (old)', legacy),
+                ('walk_directory, listdir', listdir_walker)]
+        if davutils.scandir is not None:
+            runs.append(('walk_directory, scandir', walker))
+        
+        for label, func in runs:
+            elapsed = timeit(lambda: func(tree))
+            if func is walker:
+                syscalls = 'n/a'
+            else:
+                syscalls = '%.2f' % (float(count_syscalls(lambda: func(tree)))
+                                     / entries)
+            print '%-6s %-24s %10.3f %14s' % (name, label, elapsed, syscalls)
+
+def time_loop(func, number):
+    start = time.time()
+    for i in xrange(number):
+        func()
+    return time.time() - start
+
+def microbench(func, min_time = 0.1, repeat = 5):
+    '''Return the time in seconds of one call to func: the best of several
+    runs of a loop that is long enough to take at least min_time.'''
+    number = 1
+    while time_loop(func, number) < min_time:
+        number *= 2
+    return min(time_loop(func, number) for i in range(repeat)) / number
+
+# Results of bench_micro as {name: microseconds per call}, for --save and
+# --compare.
+micro_results = {}
+
+def bench_micro(dirs = 20, files = 100, locks = 10000, entries = 100):
+    '''Single calls of the functions on the hot paths of requests, on a
+    synthetic tree and lock table. The names of the results include the
+    sizes, so that results of different sizes are not compared.
+    '''
+    tree = os.path.join(config.root_dir, 'micro')
+    os.mkdir(tree)
+    for i in range(dirs):
+        make_tree(os.path.join(tree, 'series%02d' % i), files, 100)
+    image = os.path.join(tree, 'series00', 'file000000.dcm')
+    st = os.stat(image)
+    
+    saved = config.lock_db
+    config.lock_db = '.easydav_locks_micro'
+    try:
+        manager = lock_manager.get_lockmanager()
+        insert_locks(manager, locks)
+        lock = manager.create_lock(u'micro/series00/file000000.dcm', False,
+                                   '', 0, 3600)
+        
+        if_header = ('<http://localhost/micro/series00/file000000.dcm> '
+            '(<%s> [%s]) (Not <DAV:no-lock>)' % (lock.urn,
+                                                 etags.create_etag(image, st)))
+        environ = {
+            'REQUEST_METHOD': 'PUT',
+            'PATH_INFO': '/micro/series00/file000000.dcm',
+            'HTTP_HOST': 'localhost',
+            'REMOTE_ADDR': '127.0.0.1',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'CONTENT_LENGTH': '0',
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO.StringIO(),
+        }
+        
+        def new_reqinfo(headers):
+            env = dict(environ, **headers)
+            env['wsgi.input'] = WSGIInputWrapper(env)
+            return requestinfo.RequestInfo(env)
+        
+        def create_and_release():
+            created = manager.create_lock(u'micro/new', False, '', 0, 100)
+            manager.release_lock(created.path, created.urn)
+        
+        directory = os.path.join(tree, 'series01')
+        properties = webdav.property_handlers.keys()
+        results = [('http://localhost/micro/series01/' + name,
+                    webdav.read_properties(os.path.join(directory, name),
+                        os.stat(os.path.join(directory, name)), properties))
+                   for name in sorted(os.listdir(directory))[:entries]]
+        
+        matcher = davutils.get_matcher(config.restrict_access)
+        runs = [
+            ('compare_path', lambda: davutils.compare_path(image,
+                                                           config.restrict_access)),
+            ('PathMatcher.match', lambda: matcher.match(image)),
+            ('parse_if_header', lambda: davutils.parse_if_header(if_header)),
+            ('create_etag', lambda: etags.create_etag(image, st)),
+            ('search_directory, %d entries' % (dirs * (files + 1) + 1),
+             lambda: list(davutils.search_directory(tree))),
+            ('get_locks depth 0, %d locks' % locks,
+             lambda: manager.get_locks(u'dir05/sub07/file000705', False)),
+            ('get_locks depth infinity, %d locks' % locks,
+             lambda: manager.get_locks(u'dir05/sub07', True)),
+            ('create_lock + release_lock', create_and_release),
+            ('RequestInfo', lambda: new_reqinfo({})),
+            ('RequestInfo, If header', lambda: new_reqinfo({
+                'HTTP_IF': if_header})),
+            ('multistatus, %d entries' % len(results),
+             lambda: ''.join(davxml.multistatus(results))),
+        ]
+        
+        print '%-40s %12s' % ('function', 'us/call')
+        for name, func in runs:
+            micro_results[name] = microbench(func) * 1e6
+            print '%-40s %12.2f' % (name, micro_results[name])
+    finally:
+        config.lock_db = saved
+
+def save_results(filename, results):
+    '''Save the results of bench_micro as JSON.'''
+    data = {
+        'date': davutils.get_isoformat(time.time()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    json.dump(data, open(filename, 'w'), indent = 2, sort_keys = True)
+
+def compare_results(filename, results, threshold):
+    '''Compare the results of bench_micro to a baseline saved by
+    save_results. Returns the names of the functions that are slower
+    than the baseline by more than the threshold ratio.'''
+    baseline = json.load(open(filename))['results']
+    regressions = []
+    
+    print 'Comparison to %s, threshold %.2f' % (filename, threshold)
+    print '%-40s %12s %12s %8s' % ('function', 'baseline', 'us/call', 'ratio')
+    for name in sorted(results):
+        if name not in baseline:
+            print '%-40s %12s %12.2f %8s' % (name, '-', results[name], '-')
+            continue
+        
+        ratio = results[name] / baseline[name]
+        mark = ''
+        if ratio > threshold:
+            regressions.append(name)
+            mark = '  SLOWER'
+        print '%-40s %12.2f %12.2f %8.2f%s' % (name, baseline[name],
+            results[name], ratio, mark)
+    return regressions
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = '%prog [options] [benchmark ...]')
+    parser.add_option('--save', metavar = 'FILE',
+        help = 'save the results of the micro benchmarks as JSON')
+    parser.add_option('--compare', metavar = 'FILE',
+        help = 'compare the results of the micro benchmarks to a saved file')
+    parser.add_option('--threshold', type = 'float', default = 1.25,
+        help = 'ratio to the baseline that counts as a regression '
+               '[default: %default]')
+    options, names = parser.parse_args()
+    
+    if not names and (options.save or options.compare):
+        names = ['micro']
+    elif not names:
+        names = sorted(name[len('bench_'):] for name in globals()
+                       if name.startswith('bench_'))
+
+    regressions = []
+    try:
+        for name in names:
+            globals()['bench_' + name]()
+            print
+        
+        if micro_results and options.save:
+            save_results(options.save, micro_results)
+        if micro_results and options.compare:
+            regressions = compare_results(options.compare, micro_results,
+                                          options.threshold)
+    finally:
+        shutil.rmtree(config.root_dir)
+
+    if regressions:
+        sys.exit(1)
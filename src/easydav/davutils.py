@@ -4,17 +4,34 @@
 tests.
 '''
 
+import email.utils
+import errno
+import itertools
+import metrics
 import mimetypes
 import time
+import os
 import os.path
 import re
-from fnmatch import fnmatchcase
+import stat
+import threading
+import uuid
+from fnmatch import fnmatchcase, translate
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 class DAVError(Exception):
     '''A protocol exception that is passed to client through HTTP.
     Two properties:
     - httpstatus: e.g. '404 Not Found'
-    - body: None or e.g. '<DAV:cannot-modify-protected-property/>'
+    - body: None or e.g. '<D:cannot-modify-protected-property xmlns:D="DAV:"/>'
     
     Argument httpstatus is passed to WebDAV client as HTTP status code.
     Body can optionally be an XML response body; otherwise,
@@ -45,24 +62,336 @@ def read_blocks(source, count = None, blocksize = 1024*1024):
     '''Read and yield block-sized strings from open file object,
     up to a total of count bytes.
     '''
-    while count is None or count > 0:
-        if count is not None:
-            blocksize = min(count, blocksize)
+    start = time.time()
+    total = 0
+    # Reads from files count as file system time, reads from the client not.
+    from_file = isinstance(source, (file, FileSlice))
+    try:
+        while count is None or count > 0:
+            if count is not None:
+                blocksize = min(count, blocksize)
+
+            if from_file:
+                read_start = time.time()
+                data = source.read(blocksize)
+                metrics.request_times.fs += time.time() - read_start
+            else:
+                data = source.read(blocksize)
+            
+            if len(data) == 0:
+                return # End of file
+            
+            if count is not None:
+                count -= len(data)
+            
+            total += len(data)
+            yield data
+    finally:
+        metrics.transfer_bytes.inc(('read_blocks', ), total)
+        metrics.transfer_seconds.inc(('read_blocks', ), time.time() - start)
+
+def write_blocks(dest, blocks):
+    '''Write a series of blocks to open file object.'''
+    start = time.time()
+    total = 0
+    try:
+        for block in blocks:
+            write_start = time.time()
+            dest.write(block)
+            metrics.request_times.fs += time.time() - write_start
+            total += len(block)
+    finally:
+        metrics.transfer_bytes.inc(('write_blocks', ), total)
+        metrics.transfer_seconds.inc(('write_blocks', ), time.time() - start)
+
+def load_fallocate():
+    '''Return a function fallocate(fd, offset, length) that reserves disk
+    space for a file, or None if the platform does not have it. Python 2
+    has no os.posix_fallocate, so the C library function is called
+    through ctypes.
+    '''
+    if hasattr(os, 'posix_fallocate'):
+        return os.posix_fallocate
+    
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        libc_fallocate = libc.posix_fallocate64
+    except (OSError, AttributeError):
+        return None
+    
+    libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    
+    def fallocate(fd, offset, length):
+        # Returns the error number instead of setting errno
+        err = libc_fallocate(fd, offset, length)
+        if err != 0:
+            raise OSError(err, os.strerror(err))
+    
+    return fallocate
 
-        data = source.read(blocksize)
+fallocate = load_fallocate()
+
+def fsync_directory(directory):
+    '''Flush the directory entries, such as a newly renamed file,
+    to disk.'''
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class AtomicFile(object):
+    '''File object that replaces real_path only when it is committed.
+    The data is written to a temporary file in the same directory, which
+    commit() renames over real_path and abort() removes. Readers see
+    either the old or the new file, never a partially written one.
+    
+    Size is the expected length of the data, used to reserve the disk
+    space in advance. Fsync is None, 'file' to flush the data to disk
+    before the rename, or 'dir' to also flush the rename itself.
+    '''
+    temp_prefix = '.easydav_upload_'
+    
+    def __init__(self, real_path, size = None, fsync = None):
+        assert fsync in (None, 'file', 'dir')
+        self.real_path = real_path
+        self.size = size
+        self.fsync = fsync
+        self.bytes_written = 0
+        
+        directory = os.path.dirname(real_path)
+        self.temp_path = os.path.join(directory,
+            self.temp_prefix + uuid.uuid4().hex)
+        
+        # Mode 0666 gives the same permissions as open(real_path, 'wb').
+        fd = os.open(self.temp_path,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        self.file = os.fdopen(fd, 'wb')
+        
+        if size and fallocate is not None:
+            try:
+                fallocate(fd, 0, size)
+            except OSError, e:
+                if e.errno == errno.ENOSPC:
+                    self.abort()
+                    raise DAVError('507 Insufficient Storage')
+                # Otherwise not supported by the file system, ignore.
+    
+    def write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+    
+    def commit(self):
+        '''Move the written data in place of real_path.'''
+        if self.size and self.bytes_written < self.size:
+            # Drop the unused part of the preallocated space.
+            self.file.truncate(self.bytes_written)
         
-        if len(data) == 0:
-            return # End of file
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
         
-        if count is not None:
-            count -= len(data)
+        os.rename(self.temp_path, self.real_path)
         
-        yield data
+        if self.fsync == 'dir':
+            fsync_directory(os.path.dirname(self.real_path))
+    
+    def abort(self):
+        '''Remove the temporary file, leaving real_path untouched.'''
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
 
-def write_blocks(dest, blocks):
-    '''Write a series of blocks to open file object.'''
-    for block in blocks:
-        dest.write(block)
+def join_blocks(strings, blocksize = 64*1024):
+    '''Combine a series of small strings, such as the output of a template
+    generator, into blocks of at least blocksize bytes.
+    '''
+    parts = []
+    size = 0
+    for data in strings:
+        parts.append(data)
+        size += len(data)
+        if size >= blocksize:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+    
+    if parts:
+        yield ''.join(parts)
+
+class FileSlice:
+    '''File-like object that gives access to count bytes starting at
+    offset in an open file. Fileno, offset and count are exposed so that
+    servers can transmit the slice with sendfile().
+    '''
+    def __init__(self, fileobj, offset, count):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+        self.position = 0
+        fileobj.seek(offset)
+    
+    def fileno(self):
+        return self.fileobj.fileno()
+    
+    def read(self, size = -1):
+        remaining = self.count - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+    
+    def close(self):
+        self.fileobj.close()
+
+_closing_wrappers = {}
+
+def wrap_file_response(environ, body, on_close):
+    '''If body is an object of the wsgi.file_wrapper class, return an object
+    of the same class for the same file, which counts the bytes read in
+    its bytes_sent attribute and calls on_close() after closing the body.
+    Servers recognize file responses by their class and send them with
+    sendfile(), which they would not do for an iterator wrapping body.
+    Returns None for other bodies.
+    '''
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    try:
+        if file_wrapper is None or not isinstance(body, file_wrapper):
+            return None
+    except TypeError:
+        return None # Not a class
+    
+    cls = _closing_wrappers.get(file_wrapper)
+    if cls is None:
+        try:
+            class ClosingFileWrapper(file_wrapper):
+                def __init__(self, body, on_close):
+                    file_wrapper.__init__(self, body.filelike,
+                                          getattr(body, 'blksize', 8192))
+                    # wsgiref sets close to the close() of the file.
+                    self.__dict__.pop('close', None)
+                    self.body = body
+                    self.on_close = on_close
+                    self.bytes_sent = 0
+                
+                def next(self):
+                    data = file_wrapper.next(self)
+                    self.bytes_sent += len(data)
+                    return data
+                
+                def close(self):
+                    try:
+                        if hasattr(self.body, 'close'):
+                            self.body.close()
+                    finally:
+                        self.on_close()
+        except TypeError:
+            return None # The server's wrapper type can not be subclassed
+        cls = _closing_wrappers[file_wrapper] = ClosingFileWrapper
+    
+    return cls(body, on_close)
+
+class SharedThreadPool:
+    '''A thread pool shared by all requests of the process. It is created
+    on first use, and replaced with a new one if the number of workers
+    changes or after fork(). A replaced pool is terminated, unless it was
+    inherited from the parent process: its threads do not exist in the
+    child, so there is nothing to stop.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.key = None
+    
+    def get(self, workers):
+        '''Return the pool, creating it if needed.'''
+        key = (os.getpid(), workers)
+        with self.lock:
+            if self.key != key:
+                if self.pool is not None and self.key[0] == key[0]:
+                    self.pool.terminate()
+                self.pool = ThreadPool(workers)
+                self.key = key
+            return self.pool
+
+def parse_range(range_header, size):
+    '''Parse a HTTP Range header for a resource of given size.
+    Returns a list of (start, stop) tuples, where stop is exclusive.
+    Overlapping ranges are combined.
+    
+    Returns an empty list if no range is satisfiable, and None if the
+    header is invalid and should be ignored (RFC7233 section 3.1).
+    '''
+    range_header = range_header.strip()
+    if not range_header.startswith('bytes='):
+        return None
+    
+    ranges = []
+    for spec in range_header[len('bytes='):].split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        
+        first, sep, last = spec.partition('-')
+        first = first.strip()
+        last = last.strip()
+        if not sep or not (first + last).isdigit():
+            return None
+        
+        if not first:
+            # Suffix range: last N bytes of the file
+            start = max(size - int(last), 0)
+            stop = size
+        else:
+            start = int(first)
+            if last:
+                if int(last) < start:
+                    return None
+                stop = min(int(last) + 1, size)
+            else:
+                stop = size
+        
+        if start < stop:
+            ranges.append((start, stop))
+    
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def parse_content_range(header):
+    '''Parse a Content-Range header of a request, e.g. 'bytes 0-99/1000'.
+    Returns a (start, stop, total) tuple, where stop is exclusive, or
+    (None, None, total) for 'bytes */1000'. Returns None if the header
+    is invalid.
+    '''
+    unit, sep, spec = header.strip().partition(' ')
+    first_last, sep2, total = spec.strip().partition('/')
+    if unit != 'bytes' or not sep or not sep2 or not total.isdigit():
+        return None
+    
+    total = int(total)
+    if first_last == '*':
+        return None, None, total
+    
+    first, sep, last = first_last.partition('-')
+    if not sep or not first.isdigit() or not last.isdigit():
+        return None
+    
+    start, stop = int(first), int(last) + 1
+    if start >= stop or stop > total:
+        return None
+    return start, stop, total
 
 def path_inside_directory(path, root):
     '''Check if path is inside root directory.
@@ -101,6 +430,20 @@ def get_rfcformat(timestamp):
     t = time.gmtime(timestamp)
     return time.strftime('%a, %d %b %Y %H:%M:%S %z', t)
 
+def parse_http_date(string):
+    '''Parse a date in any of the formats allowed in HTTP headers, such
+    as If-Modified-Since. Returns a timestamp, or None if the string is
+    empty or not a valid date.
+    '''
+    parsed = email.utils.parsedate_tz(string)
+    if parsed is None:
+        return None
+    
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
 def get_usertime(timestamp):
     '''Format the timestamp for reading by user.'''
     t = time.localtime(timestamp)
@@ -147,12 +490,29 @@ def get_mimetype(real_path):
         mimetype = 'application/octet-stream'
     return mimetype
 
-def create_etag(real_path):
+def get_mtime_ns(st):
+    '''Modification time in nanoseconds. Python 2 only has the floating
+    point st_mtime, which still resolves well below a microsecond.
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1e9))
+    return mtime_ns
+
+def stat_key(st):
+    '''String identifying a version of a file: inode, modification time
+    in nanoseconds and size. Writing or replacing the file changes it.
+    '''
+    return '%x-%x-%x' % (st.st_ino, get_mtime_ns(st), st.st_size)
+
+def create_etag(real_path, st = None):
     '''Get an unique identifier for this revision of the file.
     This is used by HTTP clients for caching purposes.
+    St can be an already available os.stat() result for the file.
     '''
-    return ('"' + str(os.path.getmtime(real_path)) +
-        'S' + str(os.path.getsize(real_path)) + '"')
+    if st is None:
+        st = os.stat(real_path)
+    return '"' + stat_key(st) + '"'
 
 def compare_etags(etag, etag_list):
     '''Compare the specified etag against the list.
@@ -183,40 +543,123 @@ def add_to_dict_list(dictionary, key, item):
         dictionary[key] = []
     dictionary[key].append(item)
 
-def search_directory(directory, depth = -1):
+class FileEntry:
+    '''A file or directory found by walk_directory. Similar to the
+    DirEntry objects of scandir: the file type and stat result are
+    cached, and when the entry comes from scandir, is_dir() uses the
+    file type from the directory listing without a stat call.
+    '''
+    def __init__(self, path, direntry = None):
+        self.path = path
+        self.direntry = direntry
+        self._stat = False
+    
+    def stat(self):
+        '''Return the os.stat() result, following symbolic links,
+        or None if the file does not exist anymore.'''
+        if self._stat is False:
+            start = time.time()
+            try:
+                if self.direntry is not None:
+                    self._stat = self.direntry.stat()
+                else:
+                    self._stat = os.stat(self.path)
+            except OSError:
+                self._stat = None
+            metrics.request_times.fs += time.time() - start
+        return self._stat
+    
+    def is_dir(self):
+        '''Return True if the entry is a directory or a symbolic link
+        to a directory.'''
+        if self.direntry is not None and self._stat is False:
+            try:
+                return self.direntry.is_dir()
+            except OSError:
+                return False
+        
+        st = self.stat()
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+def list_directory(directory):
+    '''Yield a FileEntry for each file in the directory, using scandir
+    when it is available.'''
+    if scandir is not None:
+        for direntry in scandir(directory):
+            yield FileEntry(direntry.path, direntry)
+    else:
+        for filename in os.listdir(directory):
+            yield FileEntry(os.path.join(directory, filename))
+
+def walk_directory(directory, depth = -1, prune = None):
     '''Find all files and directories under a directory tree,
-    yielding paths. Depth is the recursion limit:
+    yielding FileEntry objects. Depth is the recursion limit:
         0 == yield just the start directory,
         1 == yield start directory and files there,
         -1 == infinite.
+    
+    Symbolic links to directories are followed, but a directory is not
+    entered again inside itself, so that link loops terminate.
+    
+    Prune is an optional function that gets the FileEntry of a directory
+    after it has been yielded, and returns True if the directory should
+    not be entered, e.g. because it is not readable by the user.
     '''
+    return _walk_directory(FileEntry(directory), depth, set(), prune)
+
+def _walk_directory(entry, depth, ancestors, prune):
+    yield entry
+    
+    if depth == 0 or not entry.is_dir():
+        return
     
-    yield directory
+    if prune is not None and prune(entry):
+        return
     
-    if depth == 0 or not os.path.isdir(directory):
+    st = entry.stat()
+    if st is None:
         return
     
-    for filename in os.listdir(directory):
-        path = os.path.join(directory, filename)
-        if os.path.isdir(filename):
-            for path in search_directory(path, depth - 1):
-                yield path
-        else:
-            yield path
+    key = (st.st_dev, st.st_ino)
+    if key in ancestors:
+        return # Symbolic link loop
+    
+    ancestors.add(key)
+    try:
+        for child in list_directory(entry.path):
+            for item in _walk_directory(child, depth - 1, ancestors,
+                                        prune):
+                yield item
+    except OSError:
+        pass # Directory was removed or became unreadable
+    finally:
+        ancestors.discard(key)
+
+def search_directory(directory, depth = -1):
+    '''Find all files and directories under a directory tree,
+    yielding paths. Depth is the recursion limit:
+        0 == yield just the start directory,
+        1 == yield start directory and files there,
+        -1 == infinite.
+    '''
+    for entry in walk_directory(directory, depth):
+        yield entry.path
 
 def add_to_zip_recursively(zipobj, real_path, root_dir, check_read):
     '''Adds the file at real_path, and if it is a directory,
     all files under it to a ZIP archive.
     Filenames are converted from UTF-8 to CP437.
     Root_dir is stripped from beginning of each file name.
-    Check_read is a function that returns False for files that
-    should not be included in archive.
+    Check_read is a function that returns False for files and
+    directories that should not be included in archive.
     '''
     if not root_dir.endswith('/'):
         root_dir += '/'
     
-    for path in search_directory(real_path):
-        if not os.path.isdir(path) and not check_read(path):
+    forbidden = lambda entry: not check_read(entry.path)
+    for entry in walk_directory(real_path, prune = forbidden):
+        path = entry.path
+        if not check_read(path):
             continue
         
         assert path[:len(root_dir)] == root_dir
@@ -244,6 +687,99 @@ def compare_path(real_path, patterns):
     
     return False
 
+class PathMatcher(object):
+    '''Compiled form of a pattern list for compare_path(). The shell glob
+    patterns are combined into a single regular expression, which is
+    matched once against each path component.
+    
+    Verdicts for the directories above the tested path are kept in a
+    cache of cache_size entries, from which the least recently used are
+    dropped. A path then only needs to match its own name, and otherwise
+    inherits the verdict of its parent directory. Functions in the pattern
+    list get the whole path and are called every time.
+    '''
+    def __init__(self, patterns, cache_size = 4096):
+        self.patterns = patterns
+        self.functions = [p for p in patterns if callable(p)]
+        
+        regexes = []
+        for pattern in patterns:
+            if not callable(pattern):
+                regex = translate(pattern)
+                assert regex.endswith('\\Z(?ms)')
+                regexes.append(regex[:-len('\\Z(?ms)')])
+        
+        if regexes:
+            regex = re.compile('(?ms)(?:' + '|'.join(regexes) + ')\\Z')
+            self.match_name = lambda name: regex.match(name) is not None
+        else:
+            self.match_name = lambda name: False
+        
+        self.cache = {}
+        self.cache_size = cache_size
+        self.clock = itertools.count()
+    
+    def _directory_matches(self, directory):
+        '''Verdict for a directory given without the leading and trailing
+        slashes. The cache entries are lists [verdict, last use].
+        '''
+        missing = []
+        while True:
+            entry = self.cache.get(directory)
+            if entry is not None:
+                entry[1] = next(self.clock)
+                verdict = entry[0]
+                break
+            
+            missing.append(directory)
+            if '/' not in directory:
+                verdict = False
+                break
+            directory = directory[:directory.rindex('/')]
+        
+        for directory in reversed(missing):
+            name = directory[directory.rfind('/') + 1:]
+            verdict = verdict or self.match_name(name)
+            
+            if len(self.cache) >= self.cache_size:
+                self._evict()
+            self.cache[directory] = [verdict, next(self.clock)]
+        
+        return verdict
+    
+    def _evict(self):
+        '''Drop the least recently used half of the cache.'''
+        entries = sorted(self.cache.items(), key = lambda item: item[1][1])
+        for directory, entry in entries[:len(entries) // 2]:
+            self.cache.pop(directory, None)
+    
+    def match(self, real_path):
+        '''Same as compare_path(real_path, self.patterns).'''
+        real_path = os.path.normpath(real_path)
+        
+        for function in self.functions:
+            if function(real_path):
+                return True
+        
+        parts = real_path.strip('/')
+        if '/' not in parts:
+            return self.match_name(parts)
+        
+        directory, name = parts.rsplit('/', 1)
+        return self.match_name(name) or self._directory_matches(directory)
+
+_matchers = {}
+
+def get_matcher(patterns):
+    '''Return a PathMatcher for the pattern list, compiling it on the first
+    use. Matchers are kept for the lifetime of the list object, so the list
+    should not be modified afterwards.
+    '''
+    matcher = _matchers.get(id(patterns))
+    if matcher is None or matcher.patterns is not patterns:
+        matcher = _matchers[id(patterns)] = PathMatcher(patterns)
+    return matcher
+
 def parse_if_list(string):
     '''Read a "List" structure as defined in RFC4918
     Returns list of tuples (Type, Invert, Value).
@@ -340,6 +876,7 @@ def parse_timeout(value):
         raise ValueError('Unknown timeout type')
 
 if __name__ == '__main__':
+    import multiprocessing.pool
     print "Unit tests"
     
     assert path_inside_directory('/tmp/foobar', '/tmp')
@@ -374,6 +911,16 @@ if __name__ == '__main__':
     assert compare_path('/tmp/hack.php.txt', ['*.php.*'])
     assert compare_path('/tmp/foo', ['*'])
     
+    patterns = ['.svn', '*.php', '*.php.*', '[ab]?', lambda p: p == '/x/f']
+    matcher = PathMatcher(patterns, 4)
+    for path in ['/', '/tmp/foo', '/tmp/.svn/foo', '/tmp/.svn', 'hack.php',
+                 '/x/.hack.php.txt/y', '/x/ac/', '/x/abc', '/x/f', '/x/f/',
+                 '/tmp/.svn/a/b/c/d', '/tmp/svn/a/b/c/d', '/tmp/../x.php']:
+        assert matcher.match(path) == compare_path(path, patterns), path
+    assert len(matcher.cache) <= 4
+    assert get_matcher(patterns) is get_matcher(patterns)
+    assert not PathMatcher([]).match('/tmp/foo')
+    
     assert (parse_if_list('(["Foobar"]Not["foobar"])') ==
             [('etag', False, '"Foobar"'), ('etag', True, '"foobar"')])
     
@@ -396,8 +943,109 @@ if __name__ == '__main__':
     assert (parse_if_header('<foo>(Not["Etag"])')
         == [('foo', [('etag', True, '"Etag"')])])
 
+    import tempfile
+    testfile = tempfile.NamedTemporaryFile()
+    testfile.write('0123456789')
+    assert FileSlice(testfile, 2, 5).read() == '23456'
+    assert (list(read_blocks(FileSlice(testfile, 7, 10), blocksize = 2))
+        == ['78', '9'])
+    
+    import wsgiref.util
+    closed = []
+    environ = {'wsgi.file_wrapper': wsgiref.util.FileWrapper}
+    testfile.flush()
+    body = wsgiref.util.FileWrapper(
+        FileSlice(open(testfile.name, 'rb'), 2, 5), 2)
+    wrapped = wrap_file_response(environ, body, lambda: closed.append(True))
+    assert isinstance(wrapped, wsgiref.util.FileWrapper)
+    assert wrapped.filelike is body.filelike
+    assert list(wrapped) == ['23', '45', '6'] and wrapped.bytes_sent == 5
+    wrapped.close()
+    assert closed == [True]
+    assert wrap_file_response(environ, ['data'], None) is None
+    assert wrap_file_response({}, body, None) is None
+    
+    assert create_etag(testfile.name) == create_etag(testfile.name,
+        os.stat(testfile.name))
+    
+    assert list(join_blocks(['a', 'bc', 'd', 'efg'], 3)) == ['abc', 'defg']
+    assert list(join_blocks(['a', 'b'], 3)) == ['ab']
+    assert list(join_blocks([], 3)) == []
+    
+    import shutil
+    testdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(testdir, 'a', 'b'))
+    open(os.path.join(testdir, 'a', 'b', 'c'), 'w').close()
+    os.symlink('..', os.path.join(testdir, 'a', 'b', 'loop'))
+    rel_paths = lambda d: sorted(os.path.relpath(p, testdir)
+                                 for p in search_directory(testdir, d))
+    assert rel_paths(0) == ['.']
+    assert rel_paths(1) == ['.', 'a']
+    assert rel_paths(-1) == ['.', 'a', 'a/b', 'a/b/c', 'a/b/loop']
+    assert [e.is_dir() for e in walk_directory(testdir, 1)] == [True, True]
+    pruned = walk_directory(testdir, prune = lambda e: e.path.endswith('b'))
+    assert sorted(os.path.relpath(e.path, testdir) for e in pruned) == \
+        ['.', 'a', 'a/b']
+    
+    target = os.path.join(testdir, 'atomic')
+    open(target, 'w').write('old')
+    outfile = AtomicFile(target, 100, 'dir')
+    outfile.write('new')
+    assert open(target).read() == 'old'
+    outfile.commit()
+    assert open(target).read() == 'new'
+    outfile = AtomicFile(target)
+    outfile.write('partial')
+    outfile.abort()
+    assert open(target).read() == 'new'
+    assert not [f for f in os.listdir(testdir)
+                if f.startswith(AtomicFile.temp_prefix)]
+    shutil.rmtree(testdir)
+    
+    assert parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT') == 784111777
+    assert parse_http_date('Sun, 06 Nov 1994 10:49:37 +0200') == 784111777
+    assert parse_http_date(get_rfcformat(784111777)) == 784111777
+    assert parse_http_date('') is None
+    assert parse_http_date('yesterday') is None
+    
+    assert parse_range('bytes=0-499', 1000) == [(0, 500)]
+    assert parse_range('bytes=500-', 1000) == [(500, 1000)]
+    assert parse_range('bytes=-200', 1000) == [(800, 1000)]
+    assert parse_range('bytes=-2000', 1000) == [(0, 1000)]
+    assert parse_range('bytes=900-1999', 1000) == [(900, 1000)]
+    assert parse_range('bytes=0-0, -1', 1000) == [(0, 1), (999, 1000)]
+    assert parse_range('bytes=0-99,50-149,500-', 1000) == [(0, 150), (500, 1000)]
+    assert parse_range('bytes=1000-', 1000) == []
+    assert parse_range('bytes=-1', 0) == []
+    assert parse_range('bytes=5-1', 1000) is None
+    assert parse_range('bytes=a-b', 1000) is None
+    assert parse_range('items=0-1', 1000) is None
+    assert parse_content_range('bytes 0-99/1000') == (0, 100, 1000)
+    assert parse_content_range(' bytes 999-999/1000') == (999, 1000, 1000)
+    assert parse_content_range('bytes */1000') == (None, None, 1000)
+    assert parse_content_range('bytes 0-1000/1000') is None
+    assert parse_content_range('bytes 5-4/1000') is None
+    assert parse_content_range('bytes 0-99/*') is None
+    assert parse_content_range('items 0-99/1000') is None
+
     assert parse_timeout('Second-1234') == 1234
     assert parse_timeout('Infinite') is None
 
+    # Concurrent first requests get the same pool, and a pool that is
+    # replaced is terminated.
+    shared = SharedThreadPool()
+    pools = []
+    threads = [threading.Thread(target = lambda: pools.append(shared.get(2)))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(pools) == 8 and len(set(map(id, pools))) == 1
+    assert shared.get(3) is not pools[0]
+    assert pools[0]._state == multiprocessing.pool.TERMINATE
+    assert shared.get(3).apply(len, ('abc',)) == 3
+    shared.get(3).terminate()
+
     print "Unit tests OK"
     
\ No newline at end of file
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+'''Fast XML output for the responses that have a fixed shape: the
+multistatus of PROPFIND and PROPPATCH and the lock discovery of LOCK.
+The documents are built directly from strings, so that kid and the
+templates are only loaded when the HTML interface needs them.
+
+Property values are either strings, which are written as text, or
+sequences of ElementTree elements. Error bodies of DAVError and lock
+owners are XML strings that are copied to the output as is.
+'''
+
+import urlparse
+from xml.sax.saxutils import escape, quoteattr
+from davutils import DAVError
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+def text(value):
+    '''Escape a string for use as element content.'''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return escape(value)
+
+def raw(value):
+    '''Pass an XML string to the output.'''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value
+
+_tags = {}
+
+def get_tag(name):
+    '''Return the tag name and namespace declaration for an element name
+    in the ElementTree {namespace}name notation. Elements in the DAV:
+    namespace use the D prefix declared in the document element.
+    '''
+    try:
+        return _tags[name]
+    except KeyError:
+        pass
+    
+    if name.startswith('{'):
+        namespace, localname = name[1:].split('}', 1)
+    else:
+        namespace, localname = None, name
+    
+    if namespace == 'DAV:':
+        result = ('D:' + localname, '')
+    elif namespace:
+        result = ('ns0:' + localname, ' xmlns:ns0=' + quoteattr(namespace))
+    else:
+        result = (localname, '')
+    
+    # Property names come from clients, so only remember a limited number.
+    if len(_tags) < 1000:
+        _tags[name] = result
+    return result
+
+def element(name, content = ''):
+    '''Return an element with already formatted content.'''
+    tag, xmlns = get_tag(name)
+    if not content:
+        return '<' + tag + xmlns + '/>'
+    return '<' + tag + xmlns + '>' + content + '</' + tag + '>'
+
+def serialize(elem):
+    '''Serialize an ElementTree element and its children.'''
+    content = [text(elem.text or '')]
+    for child in elem:
+        content.append(serialize(child))
+        content.append(text(child.tail or ''))
+    return element(elem.tag, ''.join(content))
+
+def property_xml(name, value):
+    '''Return the element for a property in a <D:prop>.'''
+    if isinstance(value, basestring):
+        return element(name, text(value))
+    return element(name, ''.join([serialize(elem) for elem in value]))
+
+def response_xml(real_url, propstats):
+    '''Return the <D:response> element for one resource.
+    Propstats is either a dictionary from status to a list of
+    (property name, value) tuples, or a DAVError for the whole resource.
+    '''
+    parts = ['<D:response><D:href>', text(real_url), '</D:href>']
+    
+    if isinstance(propstats, DAVError):
+        parts += ['<D:status>HTTP/1.1 ', text(propstats.httpstatus),
+                  '</D:status>']
+        if propstats.body:
+            parts += ['<D:error>', raw(propstats.body), '</D:error>']
+    else:
+        for status, props in propstats.items():
+            parts.append('<D:propstat><D:prop>')
+            for name, value in props:
+                parts.append(property_xml(name, value))
+            parts += ['</D:prop><D:status>HTTP/1.1 ', text(str(status)),
+                      '</D:status>']
+            if getattr(status, 'body', None):
+                parts += ['<D:error>', raw(status.body), '</D:error>']
+            parts.append('</D:propstat>')
+    
+    parts.append('</D:response>')
+    return ''.join(parts)
+
+def multistatus(result_files):
+    '''Generate a <D:multistatus> document from (url, propstats) tuples,
+    one response at a time.'''
+    yield XML_DECLARATION + '<D:multistatus xmlns:D="DAV:">'
+    for real_url, propstats in result_files:
+        yield response_xml(real_url, propstats)
+    yield '</D:multistatus>\n'
+
+def activelock(lock, root_url):
+    '''Return the body of a LOCK response, describing the lock inside
+    <D:prop><D:lockdiscovery>.'''
+    if lock.shared:
+        scope = '<D:shared/>'
+    else:
+        scope = '<D:exclusive/>'
+    
+    if lock.infinite_depth:
+        depth = 'infinity'
+    else:
+        depth = '0'
+    
+    return ''.join([XML_DECLARATION,
+        '<D:prop xmlns:D="DAV:"><D:lockdiscovery><D:activelock>',
+        '<D:locktype><D:write/></D:locktype>',
+        '<D:lockscope>', scope, '</D:lockscope>',
+        '<D:depth>', depth, '</D:depth>',
+        raw(lock.owner),
+        '<D:timeout>Second-', str(lock.seconds_until_timeout()),
+        '</D:timeout>',
+        '<D:locktoken><D:href>', text(lock.urn), '</D:href></D:locktoken>',
+        '<D:lockroot><D:href>', text(urlparse.urljoin(root_url, lock.path)),
+        '</D:href></D:lockroot>',
+        '</D:activelock></D:lockdiscovery></D:prop>\n'])
+
+if __name__ == '__main__':
+    import xml.etree.ElementTree as ET
+    print "Unit tests"
+    
+    def parse(blocks):
+        return ET.fromstring(''.join(blocks))
+    
+    collection = [ET.Element('{DAV:}collection')]
+    doc = parse(multistatus([
+        ('/a%20b/', {
+            '200 OK': [('{DAV:}resourcetype', collection),
+                       ('{DAV:}getcontenttype', u'text/plain <\xe4>')],
+            '404 Not Found': [('{http://example.com/}foo', ''),
+                              ('bar', '')]}),
+        ('/c', DAVError('507 Insufficient Storage',
+            '<D:number-of-matches-within-limits xmlns:D="DAV:"/>')),
+    ]))
+    
+    responses = doc.findall('{DAV:}response')
+    assert len(responses) == 2
+    assert responses[0].findtext('{DAV:}href') == '/a%20b/'
+    props = {}
+    for propstat in responses[0].findall('{DAV:}propstat'):
+        status = propstat.findtext('{DAV:}status')
+        for prop in propstat.find('{DAV:}prop'):
+            props[prop.tag] = (status, prop)
+    assert props['{DAV:}resourcetype'][1][0].tag == '{DAV:}collection'
+    assert props['{DAV:}getcontenttype'][1].text == u'text/plain <\xe4>'
+    assert props['{http://example.com/}foo'][0] == 'HTTP/1.1 404 Not Found'
+    assert props['bar'][1].tag == 'bar'
+    assert responses[1].findtext('{DAV:}status') == \
+        'HTTP/1.1 507 Insufficient Storage'
+    assert responses[1].find('{DAV:}error')[0].tag == \
+        '{DAV:}number-of-matches-within-limits'
+    
+    # Errors of PROPPATCH instructions are used as status keys
+    error = DAVError('403 Forbidden',
+        '<D:cannot-modify-protected-property xmlns:D="DAV:"/>')
+    doc = parse(multistatus([('/d', {error: [('{DAV:}getetag', '')]})]))
+    propstat = doc.find('{DAV:}response/{DAV:}propstat')
+    assert propstat.findtext('{DAV:}status') == 'HTTP/1.1 403 Forbidden'
+    assert propstat.find('{DAV:}error')[0].tag == \
+        '{DAV:}cannot-modify-protected-property'
+    
+    class lock:
+        shared = False
+        infinite_depth = True
+        owner = u'<ns0:owner xmlns:ns0="DAV:">\xe4</ns0:owner>'
+        urn = 'urn:uuid:1234'
+        path = 'dir/file&.txt'
+        def seconds_until_timeout(self):
+            return 60
+    
+    doc = ET.fromstring(activelock(lock(), 'http://example.com/dav/'))
+    active = doc.find('{DAV:}lockdiscovery/{DAV:}activelock')
+    assert active.find('{DAV:}lockscope/{DAV:}exclusive') is not None
+    assert active.findtext('{DAV:}depth') == 'infinity'
+    assert active.findtext('{DAV:}owner') == u'\xe4'
+    assert active.findtext('{DAV:}timeout') == 'Second-60'
+    assert active.findtext('{DAV:}locktoken/{DAV:}href') == lock.urn
+    assert active.findtext('{DAV:}lockroot/{DAV:}href') == \
+        'http://example.com/dav/dir/file&.txt'
+    
+    print "Unit tests OK"
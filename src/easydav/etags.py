@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+'''ETag generation. By default ETags come from davutils.create_etag(), which
+uses a single os.stat() result. In the 'content' mode of config.etag_mode
+they are SHA-1 hashes of the file contents, which stay the same when a file
+is saved again with identical bytes. The hash is computed when the ETag is
+first needed and stored together with the stat key of the file, either in
+an extended attribute of the file or in a SQLite index in root_dir. The
+rows of the index are removed with forget() when files are deleted or
+moved.
+'''
+
+import errno
+import hashlib
+import os
+import os.path
+import stat
+import davutils
+import sqlitedb
+from davutils import DAVError
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+XATTR_NAME = 'user.easydav.sha1'
+
+def hash_file(real_path):
+    '''Return the SHA-1 hex digest of the file and the os.stat() result
+    of the file when it was read.
+    '''
+    infile = open(real_path, 'rb')
+    try:
+        digest = hashlib.sha1()
+        for data in davutils.read_blocks(infile):
+            digest.update(data)
+        return digest.hexdigest(), os.fstat(infile.fileno())
+    finally:
+        infile.close()
+
+def read_xattr(real_path):
+    '''Return the (key, digest) stored in the extended attribute of the
+    file, or None.'''
+    if xattr is None:
+        return None
+    
+    try:
+        value = xattr.getxattr(real_path, XATTR_NAME)
+    except (IOError, OSError):
+        return None # Not set or not supported
+    
+    try:
+        key, digest = value.split(' ')
+    except ValueError:
+        return None
+    return key, digest
+
+def write_xattr(real_path, key, digest):
+    '''Store the hash in an extended attribute. Returns False if the file
+    system or the file permissions do not allow it.'''
+    if xattr is None:
+        return False
+    
+    try:
+        xattr.setxattr(real_path, XATTR_NAME, key + ' ' + digest)
+        return True
+    except (IOError, OSError):
+        return False
+
+class HashIndex(sqlitedb.Database):
+    '''SQLite table of content hashes, for files that can not store
+    them in extended attributes.'''
+    name = 'ETag DB'
+    
+    def __init__(self):
+        sqlitedb.Database.__init__(self, get_dbpath(), config)
+    
+    def _create_tables(self):
+        self._sql_query('''CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT PRIMARY KEY,
+            key TEXT,
+            digest TEXT)''')
+    
+    def get(self, real_path):
+        self._sql_query('SELECT key, digest FROM hashes WHERE path = ?',
+            (real_path, ))
+        row = self.db_cursor.fetchone()
+        return row and (str(row[0]), str(row[1]))
+    
+    def put(self, real_path, key, digest):
+        self._sql_query('INSERT OR REPLACE INTO hashes VALUES (?,?,?)',
+            (real_path, key, digest))
+    
+    def remove(self, real_path):
+        '''Remove the hashes of the path and of everything under it.
+        The paths under it sort between prefix/ and prefix0.'''
+        prefix = real_path.rstrip('/')
+        self._sql_query('DELETE FROM hashes WHERE path = ? '
+            'OR (path >= ? AND path < ?)',
+            (real_path, prefix + '/', prefix + '0'))
+
+def get_dbpath():
+    '''Etag_db can be absolute path or relative to root dir.'''
+    return os.path.join(config.root_dir, config.etag_db)
+
+_pool = sqlitedb.DatabasePool(HashIndex)
+
+def get_hash_index():
+    '''Return the HashIndex of the current thread, see
+    sqlitedb.DatabasePool.'''
+    return _pool.get(get_dbpath())
+
+def forget(real_path):
+    '''Remove the stored hashes of a deleted or moved file or directory
+    tree from the index.'''
+    if config.etag_mode != 'content' or not config.etag_db:
+        return
+    
+    try:
+        get_hash_index().remove(real_path)
+    except DAVError:
+        pass # Database is busy, the rows only take space
+
+def content_etag(real_path, st):
+    '''ETag based on the SHA-1 hash of the file contents.'''
+    key = davutils.stat_key(st)
+    
+    cached = read_xattr(real_path)
+    if cached is None and config.etag_db:
+        try:
+            cached = get_hash_index().get(real_path)
+        except DAVError:
+            pass # Database is busy, compute the hash
+    if cached is not None and cached[0] == key:
+        return '"' + cached[1] + '"'
+    
+    digest, new_st = hash_file(real_path)
+    if davutils.stat_key(new_st) == key:
+        # Only store the hash if the file did not change while reading.
+        if not write_xattr(real_path, key, digest) and config.etag_db:
+            try:
+                get_hash_index().put(real_path, key, digest)
+            except DAVError:
+                pass # Database is busy, the hash is computed again next time
+    
+    return '"' + digest + '"'
+
+def create_etag(real_path, st = None):
+    '''Get an unique identifier for this revision of the file.
+    This is used by HTTP clients for caching purposes.
+    St can be an already available os.stat() result for the file.
+    '''
+    if st is None:
+        st = os.stat(real_path)
+    
+    if config.etag_mode == 'content' and stat.S_ISREG(st.st_mode):
+        try:
+            return content_etag(real_path, st)
+        except IOError, e:
+            if e.errno != errno.EACCES:
+                raise
+            # Unreadable files, such as write-only uploads, can
+            # still be described by their stat key.
+    
+    return davutils.create_etag(real_path, st)
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import tempfile, shutil, time
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = tempfile.mkdtemp()
+        etag_mode = 'stat'
+        etag_db = '.easydav_etags'
+        lock_wait = 5
+        lock_journal_mode = 'WAL'
+        lock_synchronous = 'NORMAL'
+        lock_mmap_size = 0
+    
+    testfile = os.path.join(config.root_dir, 'testfile')
+    open(testfile, 'w').write('foo')
+    etag1 = create_etag(testfile)
+    assert etag1 == create_etag(testfile, os.stat(testfile))
+    assert ',' not in etag1
+    
+    # Rewrites within the same second give different ETags
+    time.sleep(0.01)
+    open(testfile, 'w').write('bar')
+    etag2 = create_etag(testfile)
+    assert etag2 != etag1
+    
+    # Content hashes, both in extended attributes and in the index
+    config.etag_mode = 'content'
+    for use_xattr in (True, False):
+        if not use_xattr:
+            xattr = None
+        
+        open(testfile, 'w').write('bar')
+        etag1 = create_etag(testfile)
+        assert etag1 == '"' + hashlib.sha1('bar').hexdigest() + '"'
+        time.sleep(0.01)
+        open(testfile, 'w').write('bar')
+        assert create_etag(testfile) == etag1
+        open(testfile, 'w').write('baz')
+        assert create_etag(testfile) != etag1
+    
+    key = davutils.stat_key(os.stat(testfile))
+    assert get_hash_index().get(testfile)[0] == key
+    assert create_etag(config.root_dir).count('-') == 2
+    
+    # Hashes of removed files and directory trees are forgotten
+    index = get_hash_index()
+    for name in (u'dir', u'dir/a', u'dir/sub/b', u'dir-2', u'dir0', u'di'):
+        index.put(os.path.join(config.root_dir, name), key, 'hash')
+    forget(os.path.join(config.root_dir, u'dir'))
+    forget(testfile)
+    index._sql_query('SELECT path FROM hashes ORDER BY path')
+    assert [os.path.basename(row[0]) for row in index.db_cursor.fetchall()] \
+        == [u'di', u'dir-2', u'dir0']
+    
+    shutil.rmtree(config.root_dir)
+    print "Unit tests OK"
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+'''Server-side copying of files and directory trees for COPY and MOVE.
+The data of each file is copied by the kernel when possible:
+
+1) reflink (the FICLONE ioctl) shares the data blocks between the files
+   on file systems such as Btrfs and XFS, so nothing is copied at all,
+2) copy_file_range() copies within the kernel, and lets network file
+   systems copy on the server,
+3) sendfile() copies within the kernel on older systems,
+4) otherwise the data is read and written in large blocks.
+
+Python 2 has no os.copy_file_range or os.sendfile, so the C library
+functions are called through ctypes. The files of a directory tree are
+copied by a pool of threads; ctypes and os.read/os.write release the GIL,
+so the copies proceed in parallel.
+'''
+
+import errno
+import fcntl
+import itertools
+import os
+import os.path
+import shutil
+import stat
+import davutils
+
+FICLONE = 0x40049409
+CHUNK_SIZE = 1 << 30
+
+# Errors that mean the method does not work for these two files,
+# so the next one should be tried.
+_unsupported = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                errno.ENOSYS, errno.EBADF, errno.ETXTBSY)
+
+def load_libc_copy(name):
+    '''Return a function copy(fd_in, fd_out, count) that copies up to count
+    bytes from the current position of fd_in using the C library function
+    copy_file_range or sendfile64, or None if it is not available.
+    Returns the number of bytes copied, 0 at end of file.
+    '''
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    
+    function.restype = ctypes.c_ssize_t
+    if name == 'copy_file_range':
+        function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                             ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        call = lambda fd_in, fd_out, count: function(fd_in, None, fd_out,
+                                                     None, count, 0)
+    else:
+        function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                             ctypes.c_size_t]
+        call = lambda fd_in, fd_out, count: function(fd_out, fd_in,
+                                                     None, count)
+    
+    def copy(fd_in, fd_out, count):
+        result = call(fd_in, fd_out, count)
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+    
+    return copy
+
+copy_file_range = load_libc_copy('copy_file_range')
+sendfile = load_libc_copy('sendfile64')
+
+def reflink(fd_in, fd_out):
+    '''Make fd_out share the data of fd_in.'''
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+    except IOError, e:
+        raise OSError(e.errno, e.strerror)
+
+def kernel_copy(copy, fd_in, fd_out):
+    '''Copy the rest of fd_in with copy_file_range or sendfile.'''
+    while copy(fd_in, fd_out, CHUNK_SIZE) > 0:
+        pass
+
+def buffered_copy(fd_in, fd_out, blocksize = 1024*1024):
+    '''Copy the rest of fd_in by reading and writing blocks.'''
+    while True:
+        data = os.read(fd_in, blocksize)
+        if not data:
+            return
+        while data:
+            written = os.write(fd_out, data)
+            data = data[written:]
+
+def copy_data(fd_in, fd_out):
+    '''Copy the contents of one open file to another with the fastest
+    method that works for them. Returns the name of the method.'''
+    methods = [('reflink', reflink)]
+    for name, copy in (('copy_file_range', copy_file_range),
+                       ('sendfile', sendfile)):
+        if copy is not None:
+            methods.append((name, lambda fd_in, fd_out, copy = copy:
+                            kernel_copy(copy, fd_in, fd_out)))
+    
+    for name, method in methods:
+        try:
+            method(fd_in, fd_out)
+            return name
+        except OSError, e:
+            if e.errno not in _unsupported:
+                raise
+            
+            # A failed ioctl leaves the files untouched, but the kernel
+            # copies may fail after copying a part of the data.
+            if name != 'reflink':
+                os.lseek(fd_in, 0, os.SEEK_SET)
+                os.lseek(fd_out, 0, os.SEEK_SET)
+                os.ftruncate(fd_out, 0)
+    
+    buffered_copy(fd_in, fd_out)
+    return 'buffered'
+
+def copy_file(src, dst, st = None):
+    '''Copy a regular file with its permission bits and timestamps,
+    like shutil.copy2. St is the os.stat() result of src if known.
+    Returns the name of the method used to copy the data.
+    '''
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        if st is None:
+            st = os.fstat(fd_in)
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         stat.S_IMODE(st.st_mode))
+        try:
+            method = copy_data(fd_in, fd_out)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+    
+    copy_stat(dst, st)
+    return method
+
+def copy_stat(dst, st):
+    '''Set the permission bits and timestamps of dst from a stat result.'''
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, (st.st_atime, st.st_mtime))
+
+def copy_entry(src, dst, st):
+    '''Copy a file, symbolic link or special file found in a tree.'''
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+    elif stat.S_ISREG(st.st_mode):
+        copy_file(src, dst, st)
+    else:
+        shutil.copy2(src, dst)
+
+def _copy_entry(args):
+    '''Copy_entry for the thread pool, returning the error instead of
+    raising it so that the other files are still copied.'''
+    try:
+        copy_entry(*args)
+        return None
+    except (IOError, OSError, shutil.Error), e:
+        return (args[0], args[1], str(e))
+
+_pool = davutils.SharedThreadPool()
+
+def get_pool(workers):
+    '''Return the thread pool for copying files, shared by all requests
+    of the process.'''
+    return _pool.get(workers)
+
+def copy_tree(src, dst, workers = 4, progress = None):
+    '''Copy a directory tree, like shutil.copytree with symlinks = True.
+    The directories are created first, then the files are copied by a
+    pool of worker threads, and last the directory timestamps are set
+    from the deepest directory up. Errors are collected and raised
+    together as shutil.Error after the rest of the tree has been copied.
+    
+    Progress is an optional function progress(done, total) that is called
+    after each file with the number of files copied so far.
+    '''
+    directories = []
+    files = []
+    errors = []
+    
+    pending = [src]
+    while pending:
+        directory = pending.pop()
+        target = dst + directory[len(src):]
+        try:
+            st = os.stat(directory)
+            os.mkdir(target)
+            directories.append((target, st))
+            names = os.listdir(directory)
+        except (IOError, OSError), e:
+            errors.append((directory, target, str(e)))
+            continue
+        
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError, e:
+                errors.append((path, os.path.join(target, name), str(e)))
+                continue
+            
+            if stat.S_ISDIR(st.st_mode):
+                pending.append(path)
+            else:
+                files.append((path, os.path.join(target, name), st))
+    
+    if workers > 1 and len(files) > 1:
+        results = get_pool(workers).imap_unordered(_copy_entry, files, 16)
+    else:
+        results = itertools.imap(_copy_entry, files)
+    for done, error in enumerate(results):
+        if error is not None:
+            errors.append(error)
+        if progress is not None:
+            progress(done + 1, len(files))
+    
+    # Copying the files changed the directory timestamps, so they are
+    # set last, children before parents.
+    for target, st in reversed(directories):
+        try:
+            copy_stat(target, st)
+        except OSError, e:
+            errors.append((target, target, str(e)))
+    
+    if errors:
+        raise shutil.Error(errors)
+
+def move(src, dst, workers = 4, progress = None):
+    '''Move a file or a directory tree. Within a file system it is
+    renamed. Across file systems it is copied with copy_file or copy_tree
+    and then removed.
+    '''
+    try:
+        os.rename(src, dst)
+        return
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+    
+    st = os.lstat(src)
+    if stat.S_ISDIR(st.st_mode):
+        copy_tree(src, dst, workers, progress)
+        shutil.rmtree(src)
+    else:
+        copy_entry(src, dst, st)
+        os.unlink(src)
+
+def remove_tree(path, progress = None):
+    '''Remove a directory tree, like shutil.rmtree. Progress is an
+    optional function progress(done, total) that is called after each
+    removed file or directory. The tree is listed first to know the total.
+    '''
+    if os.path.islink(path):
+        os.unlink(path)
+        return
+    
+    entries = []
+    for directory, dirnames, filenames in os.walk(path, topdown = False):
+        for name in filenames:
+            entries.append((os.path.join(directory, name), False))
+        for name in dirnames:
+            subdir = os.path.join(directory, name)
+            # Symbolic links to directories are listed but not entered.
+            entries.append((subdir, not os.path.islink(subdir)))
+    entries.append((path, True))
+    
+    for done, (entry, is_dir) in enumerate(entries):
+        if is_dir:
+            os.rmdir(entry)
+        else:
+            os.unlink(entry)
+        if progress is not None:
+            progress(done + 1, len(entries))
+
+if __name__ == '__main__':
+    import tempfile
+    print "Unit tests"
+    
+    tempdir = unicode(tempfile.mkdtemp())
+    src = os.path.join(tempdir, u'src \xe4')
+    os.makedirs(os.path.join(src, 'a', 'b'))
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    open(os.path.join(src, 'big'), 'wb').write(data)
+    open(os.path.join(src, 'a', 'empty'), 'wb').close()
+    for i in range(50):
+        open(os.path.join(src, 'a', 'b', 'f%d' % i), 'wb').write(str(i))
+    os.symlink('../big', os.path.join(src, 'a', 'link'))
+    os.chmod(os.path.join(src, 'big'), 0640)
+    os.utime(os.path.join(src, 'a'), (1000000000, 1000000000))
+    
+    # Every method gives the same result
+    for name, method in [('reflink', reflink), ('buffered', buffered_copy),
+            ('copy_file_range', copy_file_range and
+             (lambda i, o: kernel_copy(copy_file_range, i, o))),
+            ('sendfile', sendfile and
+             (lambda i, o: kernel_copy(sendfile, i, o)))]:
+        if method is None:
+            continue
+        dst = os.path.join(tempdir, name)
+        fd_in = os.open(os.path.join(src, 'big'), os.O_RDONLY)
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT)
+        try:
+            method(fd_in, fd_out)
+        except OSError, e:
+            assert name == 'reflink' and e.errno in _unsupported
+            continue
+        finally:
+            os.close(fd_in)
+            os.close(fd_out)
+        assert open(dst, 'rb').read() == data, name
+    
+    dst = os.path.join(tempdir, 'copy.bin')
+    assert copy_file(os.path.join(src, 'big'), dst) in (
+        'reflink', 'copy_file_range', 'sendfile', 'buffered')
+    assert open(dst, 'rb').read() == data
+    assert stat.S_IMODE(os.stat(dst).st_mode) == 0640
+    
+    def listing(top):
+        result = []
+        for directory, dirnames, filenames in os.walk(top):
+            for name in dirnames + filenames:
+                path = os.path.join(directory, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    content = open(path, 'rb').read()
+                elif stat.S_ISLNK(st.st_mode):
+                    content = os.readlink(path)
+                else:
+                    content = None
+                result.append((path[len(top):], st.st_mode,
+                               int(st.st_mtime), content))
+        return sorted(result)
+    
+    for workers in (1, 4):
+        dst = os.path.join(tempdir, u'tree %d' % workers)
+        reports = []
+        copy_tree(src, dst, workers, lambda *args: reports.append(args))
+        assert listing(dst) == listing(src)
+        assert reports[-1] == (53, 53) and len(reports) == 53
+    
+    try:
+        copy_tree(src, dst)
+        assert False
+    except shutil.Error, e:
+        assert len(e.args[0]) == 1
+    
+    move(dst, os.path.join(tempdir, 'moved'))
+    assert not os.path.exists(dst)
+    assert listing(os.path.join(tempdir, 'moved')) == listing(src)
+    
+    reports = []
+    remove_tree(os.path.join(tempdir, 'moved'),
+                lambda *args: reports.append(args))
+    assert not os.path.exists(os.path.join(tempdir, 'moved'))
+    assert os.path.exists(os.path.join(src, 'big'))
+    assert reports[-1] == (56, 56)
+    
+    shutil.rmtree(tempdir)
+    print "Unit tests OK"
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+'''Background jobs for DELETE, COPY and MOVE of large directories.
+A client that sends the header 'Prefer: respond-async' (RFC 7240) gets
+the answer 202 Accepted at once, with the URL of the job in the Location
+header. The operation then runs in a thread of a shared pool, and the
+client polls the job URL for its progress and final status:
+
+    GET /.easydav_job/2f1c8e0a9b...
+
+    {"state": "running", "done": 1200, "total": 50000, ...}
+
+The jobs are stored in a SQLite database, so that in the 'process' server
+mode any worker process can answer the status requests. The resources of
+a job are locked in the lock database until the job has finished.
+'''
+
+import logging
+import os
+import os.path
+import sqlite3
+import string
+import time
+import uuid
+import davutils
+import lock_manager
+import sqlitedb
+from davutils import DAVError
+
+# Job URLs are relative to the repository root. Like the databases, the
+# path is hidden from WebDAV clients by the '.easydav_*' restriction.
+status_prefix = '.easydav_job/'
+
+RUNNING, FINISHED, FAILED = 'running', 'finished', 'failed'
+
+def wants_async(environ):
+    '''Check if background jobs are enabled and requested by the client.'''
+    return (config.async_jobs and 'respond-async' in
+            environ.get('HTTP_PREFER', '').replace(' ', '').split(','))
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+def parse_status_path(rel_path):
+    '''Return the job id if rel_path is the URL path of a job, else None.
+    Job ids are the 32 hex digits of new_job_id().'''
+    if rel_path.startswith(status_prefix):
+        job_id = rel_path[len(status_prefix):]
+        if len(job_id) == 32 and all(c in string.hexdigits for c in job_id):
+            return str(job_id)
+    return None
+
+class JobManager(sqlitedb.Database):
+    '''Stores the state and progress of the jobs in a database. Finished
+    jobs are removed after config.job_expire seconds.
+    '''
+    name = 'Job DB'
+    
+    def __init__(self):
+        sqlitedb.Database.__init__(self, get_dbpath(), config)
+        self.db_conn.row_factory = sqlite3.Row
+        self.db_cursor = self.db_conn.cursor()
+    
+    def _create_tables(self):
+        self._sql_query('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            method TEXT,
+            url TEXT,
+            destination TEXT,
+            state TEXT,
+            status TEXT,
+            done INTEGER,
+            total INTEGER,
+            created REAL,
+            updated REAL)''')
+    
+    def create(self, job_id, method, url, destination = None):
+        '''Add a new running job.'''
+        now = time.time()
+        self._sql_query('INSERT INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?)',
+            (job_id, method, url, destination, RUNNING, None, 0, 0, now, now))
+    
+    def update(self, job_id, done, total):
+        '''Record the progress of a running job.'''
+        self._sql_query('UPDATE jobs SET done = ?, total = ?, updated = ? '
+            'WHERE id = ?', (done, total, time.time(), job_id))
+    
+    def finish(self, job_id, state, status):
+        '''Record the end of a job. Status is the HTTP status that the
+        request would have got if it had been run synchronously.'''
+        self._sql_query('UPDATE jobs SET state = ?, status = ?, updated = ? '
+            'WHERE id = ?', (state, status, time.time(), job_id))
+    
+    def get(self, job_id):
+        '''Return the job as a dictionary, or None if it does not exist.'''
+        self._sql_query('SELECT * FROM jobs WHERE id = ?', (job_id, ))
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        
+        job = dict(zip(row.keys(), row))
+        job['created'] = davutils.get_isoformat(job['created'])
+        job['updated'] = davutils.get_isoformat(job['updated'])
+        return job
+    
+    def purge_jobs(self):
+        '''Remove the jobs that finished more than config.job_expire
+        seconds ago.'''
+        self._sql_query('DELETE FROM jobs WHERE state != ? AND updated < ?',
+            (RUNNING, time.time() - config.job_expire))
+
+def get_dbpath():
+    '''Job_db can be absolute path or relative to root dir.'''
+    return os.path.join(config.root_dir, config.job_db)
+
+_managers = sqlitedb.DatabasePool(JobManager, JobManager.purge_jobs)
+
+def get_job_manager():
+    '''Return the JobManager of the current thread, see
+    sqlitedb.DatabasePool. Old finished jobs are purged at most once every
+    config.lock_purge_interval seconds.
+    '''
+    return _managers.get(get_dbpath(), config.lock_purge_interval)
+
+class Progress:
+    '''The progress(done, total) callback passed to the operation of a job.
+    Stores the progress at most once a second, and refreshes the locks of
+    the job before they expire.
+    '''
+    interval = 1.0
+    
+    def __init__(self, manager, job_id, lockmanager, locks):
+        self.manager = manager
+        self.job_id = job_id
+        self.lockmanager = lockmanager
+        self.locks = locks
+        self.next_update = time.time() + self.interval
+        self.next_refresh = time.time() + config.lock_max_time / 2.0
+    
+    def __call__(self, done, total):
+        now = time.time()
+        if now < self.next_update and done < total:
+            return
+        self.next_update = now + self.interval
+        
+        try:
+            self.manager.update(self.job_id, done, total)
+        except DAVError:
+            pass # Database is busy, report the progress next time
+        
+        if self.locks and now >= self.next_refresh:
+            self.next_refresh = now + config.lock_max_time / 2.0
+            self.locks = [self.lockmanager.refresh_lock(lock.path, lock.urn,
+                                                        config.lock_max_time)
+                          for lock in self.locks]
+
+def run(job_id, operation, locks):
+    '''Run operation(lockmanager, progress) and record its result. The
+    operation returns the HTTP status of a successful request or raises
+    DAVError. The locks are released when the operation has finished.
+    '''
+    manager = get_job_manager()
+    lockmanager = None
+    if config.lock_db:
+        lockmanager = lock_manager.get_lockmanager()
+    
+    progress = Progress(manager, job_id, lockmanager, locks)
+    try:
+        try:
+            manager.finish(job_id, FINISHED, operation(lockmanager, progress))
+        except DAVError, e:
+            manager.finish(job_id, FAILED, e.httpstatus)
+        except:
+            logging.error('Job ' + job_id + ' crashed', exc_info = 1)
+            manager.finish(job_id, FAILED, '500 Internal Server Error')
+    finally:
+        for lock in progress.locks:
+            try:
+                lockmanager.release_lock(lock.path, lock.urn)
+            except DAVError:
+                pass # Already removed with the resource
+
+_pool = davutils.SharedThreadPool()
+
+def get_pool():
+    '''Return the thread pool that runs the jobs of the process.'''
+    return _pool.get(config.job_workers)
+
+def start(job_id, operation, locks):
+    '''Run the job in the background.'''
+    get_pool().apply_async(run, (job_id, operation, locks))
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import shutil, tempfile
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = unicode(tempfile.mkdtemp())
+        async_jobs = True
+        job_db = '.easydav_jobs'
+        job_expire = 3600
+        job_workers = 2
+        lock_db = '.easydav_locks'
+        lock_wait = 5
+        lock_max_time = 3600
+        lock_purge_interval = 60
+        lock_journal_mode = 'DELETE'
+        lock_synchronous = 'NORMAL'
+        lock_mmap_size = 0
+        lock_cached_statements = 100
+    lock_manager.config = config
+    
+    assert wants_async({'HTTP_PREFER': 'wait=10, respond-async'})
+    assert not wants_async({'HTTP_PREFER': 'return=minimal'})
+    assert not wants_async({})
+    job_id = new_job_id()
+    assert parse_status_path(u'.easydav_job/' + job_id) == job_id
+    assert parse_status_path(u'.easydav_job/0123abc') is None
+    assert parse_status_path(u'.easydav_job/' + u'\xe4' * 32) is None
+    assert parse_status_path(u'.easydav_job/../x') is None
+    assert parse_status_path(u'dir/file') is None
+    
+    lockmanager = lock_manager.get_lockmanager()
+    lock = lockmanager.create_lock(u'dir', False, '', -1, 60)
+    manager = get_job_manager()
+    manager._sql_query('PRAGMA journal_mode')
+    assert manager.db_cursor.fetchone()[0] == 'delete'
+    
+    def operation(lockmanager, progress):
+        for i in range(3):
+            progress(i + 1, 3)
+        return '204 No Content'
+    
+    job_id = new_job_id()
+    manager.create(job_id, 'DELETE', 'http://localhost/dir/')
+    assert manager.get(job_id)['state'] == RUNNING
+    start(job_id, operation, [lock])
+    get_pool().close()
+    get_pool().join()
+    
+    job = manager.get(job_id)
+    assert (job['state'], job['status'], job['done'], job['total']) == \
+        (FINISHED, '204 No Content', 3, 3)
+    assert lockmanager.get_locks(u'dir', True) == []
+    
+    def failing(lockmanager, progress):
+        raise DAVError('507 Insufficient Storage')
+    
+    job_id = new_job_id()
+    manager.create(job_id, 'COPY', 'http://localhost/a/', 'http://localhost/b/')
+    run(job_id, failing, [])
+    job = manager.get(job_id)
+    assert (job['state'], job['status']) == (FAILED, '507 Insufficient Storage')
+    assert job['destination'] == 'http://localhost/b/'
+    assert manager.get('missing') is None
+    
+    config.job_expire = -1
+    manager.purge_jobs()
+    assert manager.get(job_id) is None
+    
+    manager.close()
+    lockmanager.close()
+    shutil.rmtree(config.root_dir)
+    print "Unit tests OK"
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+'''Directory listings for the HTML interface. Reading a large directory
+and checking the access to each of its files is slow, so the readable
+entries are kept in a cache until the directory changes. Each request
+then only sorts, filters and renders one page of the cached entries.
+'''
+
+import fnmatch
+import re
+import threading
+import time
+import davutils
+
+# Fields of the entry tuples
+NAME, IS_DIR, SIZE, MTIME = range(4)
+
+sort_fields = {
+    'name': NAME,
+    'size': SIZE,
+    'mtime': MTIME,
+}
+
+class Listing:
+    '''The readable entries of one directory, as (name, is_dir, size, mtime)
+    tuples. Key is the davutils.stat_key() of the directory when the
+    entries were read.
+    '''
+    def __init__(self, key, entries):
+        self.key = key
+        self.entries = entries
+        self.created = time.time()
+        self.orders = {}
+    
+    def sorted(self, sort = 'name', reverse = False):
+        '''Return the entries sorted by 'name', 'size' or 'mtime', with
+        directories first. The sorted lists are remembered, so that moving
+        between pages does not sort again.
+        '''
+        try:
+            return self.orders[(sort, reverse)]
+        except KeyError:
+            pass
+        
+        field = sort_fields[sort]
+        entries = sorted(self.entries, reverse = reverse,
+            key = lambda entry: (entry[field], entry[NAME]))
+        entries.sort(key = lambda entry: not entry[IS_DIR])
+        self.orders[(sort, reverse)] = entries
+        return entries
+
+class ListingCache:
+    '''Listings of recently shown directories. A listing is read again
+    when the stat key of the directory changes, which happens whenever
+    files are added, removed or renamed in it. Changes inside the files,
+    such as a file being rewritten in place, do not touch the directory,
+    so listings are also read again after max_age seconds.
+    '''
+    def __init__(self, size = 32, max_age = 10):
+        self.size = size
+        self.max_age = max_age
+        self.listings = {}
+        self.lock = threading.Lock()
+    
+    def get(self, real_path, st, read_entries):
+        '''Return the Listing of the directory real_path, whose os.stat()
+        result is st. Read_entries is called with the path to list the
+        directory if the cached listing is missing or out of date.
+        '''
+        key = davutils.stat_key(st)
+        self.lock.acquire()
+        try:
+            listing = self.listings.get(real_path)
+        finally:
+            self.lock.release()
+        
+        if (listing is not None and listing.key == key
+                and time.time() - listing.created < self.max_age):
+            return listing
+        
+        # The directory is read without holding the lock, so that other
+        # directories can be shown meanwhile.
+        listing = Listing(key, read_entries(real_path))
+        
+        self.lock.acquire()
+        try:
+            self.listings[real_path] = listing
+            while len(self.listings) > self.size:
+                oldest = min(self.listings.keys(),
+                    key = lambda path: self.listings[path].created)
+                del self.listings[oldest]
+        finally:
+            self.lock.release()
+        
+        return listing
+
+def name_filter(pattern):
+    '''Return a function that tells whether a file name matches the filter
+    pattern. Patterns with shell wildcards (*, ? or [) are matched against
+    the whole name, other patterns as substrings. Case is ignored.
+    '''
+    if '*' in pattern or '?' in pattern or '[' in pattern:
+        regex = re.compile(fnmatch.translate(pattern),
+            re.IGNORECASE | re.UNICODE)
+        return lambda name: regex.match(name) is not None
+    
+    pattern = pattern.lower()
+    return lambda name: pattern in name.lower()
+
+def get_page(listing, sort = 'name', reverse = False, pattern = '',
+             page = 1, page_size = 500):
+    '''Return (entries, page, pages, total) for one page of the listing.
+    Total is the number of entries that match the filter pattern, and
+    page is limited to the range 1 .. pages.
+    '''
+    entries = listing.sorted(sort, reverse)
+    if pattern:
+        match = name_filter(pattern)
+        entries = [entry for entry in entries if match(entry[NAME])]
+    
+    total = len(entries)
+    pages = max(1, (total + page_size - 1) // page_size)
+    page = min(max(page, 1), pages)
+    start = (page - 1) * page_size
+    return entries[start:start + page_size], page, pages, total
+
+if __name__ == '__main__':
+    import os
+    import os.path
+    import shutil
+    import tempfile
+    print "Unit tests"
+    
+    tempdir = unicode(tempfile.mkdtemp())
+    for i, name in enumerate([u'b.dcm', u'A.dcm', u'c.txt', u'\xe4.dcm']):
+        open(os.path.join(tempdir, name), 'w').write('x' * (10 - i))
+    os.mkdir(os.path.join(tempdir, 'z_dir'))
+    
+    reads = []
+    def read_entries(path):
+        reads.append(path)
+        entries = []
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            entries.append((name, os.path.isdir(os.path.join(path, name)),
+                            st.st_size, st.st_mtime))
+        return entries
+    
+    cache = ListingCache(size = 1)
+    listing = cache.get(tempdir, os.stat(tempdir), read_entries)
+    assert cache.get(tempdir, os.stat(tempdir), read_entries) is listing
+    assert len(reads) == 1
+    
+    names = [entry[NAME] for entry in listing.sorted()]
+    assert names == [u'z_dir', u'A.dcm', u'b.dcm', u'c.txt', u'\xe4.dcm']
+    names = [entry[NAME] for entry in listing.sorted('size', True)]
+    assert names == [u'z_dir', u'b.dcm', u'A.dcm', u'c.txt', u'\xe4.dcm']
+    assert listing.sorted('size', True) is listing.sorted('size', True)
+    
+    entries, page, pages, total = get_page(listing, pattern = u'*.DCM',
+                                           page = 5, page_size = 2)
+    assert (page, pages, total) == (2, 2, 3)
+    assert [entry[NAME] for entry in entries] == [u'\xe4.dcm']
+    entries, page, pages, total = get_page(listing, pattern = u'\xc4')
+    assert [entry[NAME] for entry in entries] == [u'\xe4.dcm']
+    entries, page, pages, total = get_page(listing, pattern = u'nothing')
+    assert (entries, page, pages, total) == ([], 1, 1, 0)
+    
+    # Changing the directory, an old listing and a full cache
+    time.sleep(0.01)
+    os.unlink(os.path.join(tempdir, 'c.txt'))
+    listing = cache.get(tempdir, os.stat(tempdir), read_entries)
+    assert len(reads) == 2 and len(listing.entries) == 4
+    cache.max_age = 0
+    cache.get(tempdir, os.stat(tempdir), read_entries)
+    assert len(reads) == 3
+    cache.max_age = 10
+    subdir = os.path.join(tempdir, 'z_dir')
+    cache.get(subdir, os.stat(subdir), read_entries)
+    assert cache.listings.keys() == [subdir]
+    
+    shutil.rmtree(tempdir)
+    print "Unit tests OK"
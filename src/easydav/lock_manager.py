@@ -2,11 +2,19 @@
 
 '''Stores lock data in a SQLite database. SQLite handles the cross-process
 and cross-thread synchronization, while this code handles WebDAV lock semantics.
+Lock queries are answered from an in-memory index that is kept in sync with
+the database through a table of change numbers.
 '''
 
+import copy
+import os
 import os.path
 import davutils
+import metrics
 import sqlite3
+import sqlitedb
+import threading
+import time
 from uuid import uuid4
 import datetime
 from davutils import DAVError
@@ -34,27 +42,151 @@ class Lock:
         delta = self.valid_until - datetime.datetime.utcnow()
         return delta.seconds + delta.days * 86400
 
-class LockManager:
-    '''Implementation of WebDAV lock semantics.'''
+def get_dbpath():
+    '''Lock_db can be absolute path or relative to root dir.'''
+    return os.path.join(config.root_dir, config.lock_db)
+
+def split_path(rel_path):
+    '''Split a relative path into components, '' being the root.'''
+    if rel_path:
+        return rel_path.split('/')
+    else:
+        return []
+
+class LockNode(object):
+    '''Node of the path trie in LockIndex. Count is the number of locks
+    in this node and all nodes below it.'''
+    __slots__ = ('children', 'locks', 'count')
+    
+    def __init__(self):
+        self.children = {}
+        self.locks = {}
+        self.count = 0
+
+class LockIndex:
+    '''In-memory copy of the lock table, organized as a trie keyed on the
+    components of the lock paths. Ancestor lookups take O(depth) and
+    descendant lookups only visit branches that contain locks.
+    
+    The index is shared by all LockManagers of a process. Version is the
+    last change number from the lock_changes table that is included in
+    the index, or None if the index has not been loaded.
+    '''
     def __init__(self):
-        # Lock_db can be absolute path or relative to root dir.
-        dbpath = os.path.join(config.root_dir, config.lock_db)
-        newfile = not os.path.exists(dbpath)
+        self.mutex = threading.RLock()
+        self.clear()
+    
+    def clear(self):
+        self.root = LockNode()
+        self.by_urn = {}
+        self.version = None
+    
+    def add(self, lock):
+        self.remove(lock.urn)
+        node = self.root
+        node.count += 1
+        for part in split_path(lock.path):
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = LockNode()
+            node = child
+            node.count += 1
+        node.locks[lock.urn] = lock
+        self.by_urn[lock.urn] = lock
+    
+    def remove(self, urn):
+        lock = self.by_urn.pop(urn, None)
+        if lock is None:
+            return
+        
+        node = self.root
+        node.count -= 1
+        for part in split_path(lock.path):
+            child = node.children[part]
+            child.count -= 1
+            if child.count == 0:
+                del node.children[part] # Drop the whole empty branch
+                return
+            node = child
+        del node.locks[urn]
+    
+    def get(self, urn, now):
+        '''Return the lock with the specified urn if it is not expired.'''
+        lock = self.by_urn.get(urn)
+        if lock is not None and lock.valid_until >= now:
+            return lock
+        return None
+    
+    def get_locks(self, rel_path, recursive, now):
+        '''Same as LockManager.get_locks, using the index.'''
+        result = []
+        node = self.root
+        for part in split_path(rel_path):
+            # Locks on parent collections
+            result += [l for l in node.locks.itervalues() if l.infinite_depth]
+            node = node.children.get(part)
+            if node is None:
+                break
+        else:
+            # Locks on the resource itself
+            result += node.locks.values()
+            
+            if recursive:
+                stack = node.children.values()
+                while stack:
+                    node = stack.pop()
+                    result += node.locks.values()
+                    stack += node.children.values()
         
-        self.db_conn = sqlite3.connect(dbpath,
-            isolation_level = None,
-            timeout = config.lock_wait,
-            detect_types=sqlite3.PARSE_DECLTYPES)
+        return [lock for lock in result if lock.valid_until >= now]
+    
+    def purge(self, now):
+        '''Remove expired locks from the index.'''
+        for lock in self.by_urn.values():
+            if lock.valid_until < now:
+                self.remove(lock.urn)
+
+_indexes = {}
+
+def get_index(dbpath):
+    '''Return the LockIndex of the current process for the database.'''
+    key = (os.getpid(), dbpath)
+    if key not in _indexes:
+        _indexes.clear() # Indexes inherited through fork() are invalid
+        _indexes[key] = LockIndex()
+    return _indexes[key]
+
+class LockManager(sqlitedb.Database):
+    '''Implementation of WebDAV lock semantics.
+    
+    Lock queries are answered from an in-memory LockIndex. SQLite remains
+    the durable store: every modification is written to the database and
+    recorded in the lock_changes table. Before each use, the index applies
+    the changes made by other processes since it was last updated.
+    
+    Expired locks are ignored by all queries, and removed from the
+    database by purge_locks().
+    '''
+    # Number of changes by other processes above which the whole lock
+    # table is reloaded instead of applying the changes one by one.
+    max_incremental_changes = 1000
+    
+    # Number of recent entries to keep in lock_changes when purging.
+    keep_changes = 10000
+    
+    name = 'Lock DB'
+    
+    def __init__(self):
+        dbpath = get_dbpath()
+        self.index = get_index(dbpath)
+        sqlitedb.Database.__init__(self, dbpath, config,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements = config.lock_cached_statements)
         self.db_conn.row_factory = sqlite3.Row
         self.db_cursor = self.db_conn.cursor()
-        
-        if newfile:
-            self._create_tables()
-        else:
-            self._purge_locks()
     
     def _create_tables(self):
-        self._sql_query('''CREATE TABLE locks (
+        self._sql_query('''CREATE TABLE IF NOT EXISTS locks (
             urn TEXT PRIMARY KEY,
             path TEXT,
             shared BOOLEAN,
@@ -62,11 +194,18 @@ class LockManager:
             infinite_depth BOOLEAN,
             valid_until TIMESTAMP)''')
         
-        self._sql_query('CREATE INDEX locks_idx1 ON locks (path)')
-        self._sql_query('CREATE INDEX locks_idx2 ON locks (valid_until)')
+        self._sql_query('CREATE INDEX IF NOT EXISTS locks_idx1 ON locks (path)')
+        self._sql_query('CREATE INDEX IF NOT EXISTS locks_idx2 ON locks (valid_until)')
+        
+        self._sql_query('''CREATE TABLE IF NOT EXISTS lock_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            urn TEXT)''')
     
-    def _purge_locks(self):
+    def purge_locks(self):
         '''Remove all expired locks from the database.'''
+        with self.index.mutex:
+            self.index.purge(datetime.datetime.utcnow())
+        
         # To avoid unnecessary write lock on the database file,
         # first check if such records exist.
         self._sql_query('''SELECT 1 FROM locks WHERE
@@ -75,19 +214,97 @@ class LockManager:
         if self.db_cursor.fetchone() is not None:
             self._sql_query('''DELETE FROM locks WHERE
                 valid_until < DATETIME('now')''')
+        
+        self._sql_query('''DELETE FROM lock_changes WHERE version <
+            (SELECT MAX(version) FROM lock_changes) - ?''',
+            (self.keep_changes, ))
     
     def _sql_query(self, *args, **kwargs):
-        '''Run a database query and wrap SQLite OperationalErrors, such
-        as locked databases.
-        '''
+        '''Run a database query and record its time in the metrics.'''
+        start = time.time()
         try:
-            self.db_cursor.execute(*args, **kwargs)
-        except sqlite3.OperationalError, e:
-            if 'locked' in e.message:
-                raise DAVError('503 Service Unavailable: Lock DB is busy')
+            sqlitedb.Database._sql_query(self, *args, **kwargs)
+        except DAVError, e:
+            if e.httpstatus.startswith('503'):
+                metrics.lock_db_busy.inc()
+            raise
+        finally:
+            elapsed = time.time() - start
+            metrics.request_times.lock_db += elapsed
+            metrics.lock_db_duration.observe(elapsed)
+    
+    def _update_index(self):
+        '''Bring the index up to date with the database. The queries run
+        without index.mutex, which is only held while their results are
+        applied, so that a thread waiting for the database does not hold
+        up the lock queries of the other threads.
+        '''
+        index = self.index
+        while True:
+            known = index.version
+            self._sql_query('SELECT MAX(version) FROM lock_changes')
+            version = self.db_cursor.fetchone()[0] or 0
+            
+            if version == known:
+                return
+            
+            changes = None
+            if known is not None and version > known:
+                self._sql_query('''SELECT version, urn FROM lock_changes
+                    WHERE version > ? ORDER BY version LIMIT ?''',
+                    (known, self.max_incremental_changes + 1))
+                changes = self.db_cursor.fetchall()
+                
+                if (not changes
+                        or len(changes) > self.max_incremental_changes
+                        or changes[0]["version"] != known + 1):
+                    changes = None # Too many, or log has been trimmed
+            
+            if changes is None:
+                self._sql_query('SELECT * FROM locks')
+                rows = self.db_cursor.fetchall()
             else:
-                raise DAVError('500 Internal Server Error: Lock DB: ' + e.message)
-
+                rows = []
+                for row in changes:
+                    urn = str(row["urn"])
+                    self._sql_query('SELECT * FROM locks WHERE urn = ?',
+                                    (urn, ))
+                    rows.append((urn, self.db_cursor.fetchone()))
+            
+            with index.mutex:
+                if index.version != known:
+                    continue # Updated by another thread in the meantime
+                
+                if changes is None:
+                    index.clear()
+                    for row in rows:
+                        index.add(Lock(row))
+                else:
+                    for urn, lock_row in rows:
+                        index.remove(urn)
+                        if lock_row is not None:
+                            index.add(Lock(lock_row))
+                
+                index.version = version
+                return
+    
+    def _apply_change(self, version, change):
+        '''Apply a change that this manager has committed to the index,
+        by calling change(index). If other changes are missing from the
+        index, it is left for _update_index to read from lock_changes.
+        '''
+        with self.index.mutex:
+            if self.index.version == version - 1:
+                change(self.index)
+                self.index.version = version
+    
+    def _record_change(self, urn):
+        '''Add an entry to lock_changes inside a write transaction.
+        Returns the new version number.
+        '''
+        self._sql_query('INSERT INTO lock_changes (urn) VALUES (?)', (urn, ))
+        return self.db_cursor.lastrowid
+    
     def get_locks(self, rel_path, recursive):
         '''Returns all locks that apply to the resource defined by rel_path.
         This includes:
@@ -97,43 +314,22 @@ class LockManager:
         Result is a list of Lock objects.
         '''
         assert not rel_path.startswith('/')
-        path_exprs = ['path = ?']
-        path_args = [rel_path]
-        
-        # Construct a list of parent directories that have to be checked
-        # for locks.
-        partial_path = rel_path
-        while partial_path:
-            partial_path = os.path.dirname(partial_path)
-            path_exprs.append('(infinite_depth AND path = ?)')
-            path_args.append(partial_path)
-
-        # Check for any resources inside this collection
-        if recursive:
-            if rel_path != '':
-                prefix = rel_path + '/'
-            else:
-                prefix = ''
-            
-            path_exprs.append('SUBSTR(path,1,?) = ?')
-            path_args.append(len(prefix))
-            path_args.append(prefix)
-
-        self._sql_query('SELECT * FROM locks WHERE '
-            + ' OR '.join(path_exprs), path_args)
-        return map(Lock, self.db_cursor.fetchall())
+        self._update_index()
+        with self.index.mutex:
+            return self.index.get_locks(rel_path, recursive,
+                datetime.datetime.utcnow())
     
     def validate_lock(self, rel_path, urn):
         '''Check that a lock with the specified urn exists and that it applies
         to path specified by rel_path. Returns True or False.
         '''
-        self._sql_query('SELECT * FROM locks WHERE urn = ?', (urn, ))
-        row = self.db_cursor.fetchone()
+        self._update_index()
+        with self.index.mutex:
+            lock = self.index.get(urn, datetime.datetime.utcnow())
         
-        if row is None:
+        if lock is None:
             return False
         
-        lock = Lock(row)
         if rel_path == lock.path:
             return True
         
@@ -162,29 +358,33 @@ class LockManager:
         valid_until = datetime.datetime.utcnow()
         valid_until += datetime.timedelta(seconds = timeout)
         
+        lock = Lock({'urn': urn, 'path': rel_path, 'shared': bool(shared),
+            'owner': owner, 'infinite_depth': depth == -1,
+            'valid_until': valid_until})
+        
         self._sql_query('BEGIN IMMEDIATE TRANSACTION')
         
         try:
-            for lock in self.get_locks(rel_path, depth == -1):
-                if not lock.shared or not shared:
+            for other in self.get_locks(rel_path, depth == -1):
+                if not other.shared or not shared:
                     # Allow only one exclusive lock
                     raise DAVError('423 Locked')
             
             self._sql_query('INSERT INTO locks VALUES (?,?,?,?,?,?)',
                 (urn, rel_path, bool(shared), owner, depth == -1, valid_until))
+            version = self._record_change(urn)
             self._sql_query('END TRANSACTION')
         except:
             self._sql_query('ROLLBACK')
             raise
         
-        self._sql_query('SELECT * FROM locks WHERE urn=?', (urn, ))
-        return Lock(self.db_cursor.fetchone())
+        self._apply_change(version, lambda index: index.add(lock))
+        return lock
         
     def release_lock(self, rel_path, urn):
         '''Remove a lock from database. The rel_path must match a lock
         with the specified urn.
         '''
-        
         self._sql_query('BEGIN IMMEDIATE TRANSACTION')
         try:
             if not self.validate_lock(rel_path, urn):
@@ -192,10 +392,13 @@ class LockManager:
                                '<DAV:lock-token-matches-request-uri/>')
             
             self._sql_query('DELETE FROM locks WHERE urn=?', (urn, ))
+            version = self._record_change(urn)
             self._sql_query('END TRANSACTION')
         except:
             self._sql_query('ROLLBACK')
             raise
+        
+        self._apply_change(version, lambda index: index.remove(urn))
 
     def refresh_lock(self, rel_path, urn, timeout):
         '''Refresh the given lock and return new Lock object.'''
@@ -209,15 +412,29 @@ class LockManager:
                 raise DAVError('412 Precondition Failed',
                                '<DAV:lock-token-matches-request-uri/>')
             
+            with self.index.mutex:
+                lock = copy.copy(self.index.by_urn[urn])
+            lock.valid_until = valid_until
+            
             self._sql_query('UPDATE locks SET valid_until=? WHERE urn=?',
                 (valid_until, urn))
+            version = self._record_change(urn)
             self._sql_query('END TRANSACTION')
         except:
             self._sql_query('ROLLBACK')
             raise
         
-        self._sql_query('SELECT * FROM locks WHERE urn=?', (urn, ))
-        return Lock(self.db_cursor.fetchone())
+        self._apply_change(version, lambda index: index.add(lock))
+        return lock
+
+_pool = sqlitedb.DatabasePool(LockManager, LockManager.purge_locks)
+
+def get_lockmanager():
+    '''Return a LockManager for the current thread, see
+    sqlitedb.DatabasePool. Expired locks are purged from the database at
+    most once every config.lock_purge_interval seconds.
+    '''
+    return _pool.get(get_dbpath(), config.lock_purge_interval)
 
 if __name__ != '__main__':
     import webdavconfig as config
@@ -231,6 +448,11 @@ else:
         lock_db = tempfile.mktemp()
         lock_max_time = 3600
         lock_wait = 5
+        lock_purge_interval = 60
+        lock_journal_mode = 'WAL'
+        lock_synchronous = 'NORMAL'
+        lock_mmap_size = 0
+        lock_cached_statements = 100
     
     print 'Tempfile is', config.lock_db
     
@@ -275,6 +497,28 @@ else:
     
     assert not mgr1.validate_lock(lock1.path, lock1.urn)
     
+    # Another process has its own index, which follows the changes
+    # through the lock_changes table.
+    mgr3 = LockManager()
+    mgr3.index = LockIndex()
+    assert mgr3.get_locks('testdir/testfile3/x', False) == [lock4]
+    lock5 = mgr1.create_lock('testdir/testfile5', True, '', 0, 100)
+    assert mgr3.get_locks('testdir', True) == [lock4, lock5] or \
+           mgr3.get_locks('testdir', True) == [lock5, lock4]
+    mgr1.release_lock(lock5.path, lock5.urn)
+    assert mgr3.get_locks('testdir', True) == [lock4]
+    assert mgr3.index.version == mgr1.index.version
+    assert not mgr3.validate_lock(lock5.path, lock5.urn)
+    
+    # Trimmed change log causes a full reload
+    mgr3.index.version -= 1
+    mgr3._sql_query('DELETE FROM lock_changes')
+    assert mgr3.get_locks('', True) == [lock4]
+    
+    # Empty branches are removed from the trie
+    assert mgr1.index.root.children.keys() == ['testdir']
+    assert mgr1.index.root.count == 1
+    
     # Test lock timeouts
     lock1 = mgr1.create_lock('testfile', False, '', 0, 2)
     lock2 = mgr1.create_lock('testfile2', False, '', 0, 2)
@@ -287,7 +531,48 @@ else:
     assert mgr2.validate_lock(lock1.path, lock1.urn)
     assert not mgr2.validate_lock(lock2.path, lock2.urn)
     
+    # Expired lock stays in database until purged, but does not apply
+    assert not mgr2.get_locks('testfile2', False)
+    mgr2._sql_query('SELECT COUNT(*) FROM locks')
+    assert mgr2.db_cursor.fetchone()[0] == 3
+    mgr2.purge_locks()
+    mgr2._sql_query('SELECT COUNT(*) FROM locks')
+    assert mgr2.db_cursor.fetchone()[0] == 2
+    
+    # Storage profile
+    mgr2._sql_query('PRAGMA journal_mode')
+    assert mgr2.db_cursor.fetchone()[0] == 'wal'
+    mgr2._sql_query('PRAGMA synchronous')
+    assert mgr2.db_cursor.fetchone()[0] == 1
+    
+    # A thread waiting for the database does not block lock queries
+    # of the other threads.
+    writer = sqlite3.connect(config.lock_db, isolation_level = None)
+    writer.execute('BEGIN IMMEDIATE TRANSACTION')
+    waiting = threading.Thread(target = lambda:
+        LockManager().create_lock('waiting', False, '', 0, 100))
+    waiting.start()
+    time.sleep(0.2)
+    start = time.time()
+    assert mgr2.validate_lock(lock1.path, lock1.urn)
+    assert time.time() - start < 1
+    writer.execute('ROLLBACK')
+    writer.close()
+    waiting.join()
+    assert mgr2.get_locks('waiting', False)
+    
+    # Pooled managers are reused within a thread
+    assert get_lockmanager() is get_lockmanager()
+    other = []
+    thread = threading.Thread(target = lambda: other.append(get_lockmanager()))
+    thread.start()
+    thread.join()
+    assert other[0] is not get_lockmanager()
+    
     os.unlink(config.lock_db)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(config.lock_db + suffix):
+            os.unlink(config.lock_db + suffix)
     
     print "Unit tests OK"
     
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+'''In-process metrics in the Prometheus text exposition format. The
+counters and histograms are kept in memory and updated under a lock,
+which costs about a microsecond per update. The metrics are served on
+the path configured by config.metrics_path, e.g.
+
+    GET /.easydav_metrics
+
+Each process has its own metrics, which carry a pid label. In the
+'process' server mode a scrape shows the worker process that answered it.
+'''
+
+import bisect
+import os
+import resource
+import threading
+import time
+
+# Request durations range from a cached PROPFIND to a COPY of a study.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def format_value(value):
+    '''Format a sample value, using repr() to keep the float precision.'''
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+def format_labels(names, values):
+    '''Format a label set like {method="GET",code="200"}.'''
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value.replace('\n', '\\n')))
+    return '{' + ','.join(pairs) + '}'
+
+class Counter(object):
+    '''A value that only increases, such as the number of requests.
+    Labels are given as a tuple of values for the label names.'''
+    kind = 'counter'
+    
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+    
+    def inc(self, labels = (), amount = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield self.name + format_labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    '''A value that can go up and down, such as requests in progress.'''
+    kind = 'gauge'
+    
+    def dec(self, labels = (), amount = 1):
+        self.inc(labels, -amount)
+
+class Histogram(object):
+    '''Counts of observed values, such as durations, in buckets with the
+    given upper bounds. Only the bucket of each value is incremented; the
+    cumulative counts are computed when the metrics are shown.'''
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+    
+    def observe(self, value, labels = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # Bucket counts, then the sum of the values
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[index] += 1
+            counts[-1] += value
+    
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, list(counts))
+                           for labels, counts in self.values.items())
+        
+        labelnames = self.labelnames + ('le', )
+        for labels, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                total += count
+                yield (self.name + '_bucket' + format_labels(labelnames,
+                       labels + (format_value(float(bound)), )), total)
+            labelstr = format_labels(self.labelnames, labels)
+            yield self.name + '_sum' + labelstr, counts[-1]
+            yield self.name + '_count' + labelstr, total
+
+registry = []
+
+requests = Counter('easydav_requests_total',
+    'Requests by method and HTTP status code.', ('method', 'code'))
+request_duration = Histogram('easydav_request_duration_seconds',
+    'Time from receiving a request to sending the end of the response.',
+    ('method', ))
+handler_duration = Histogram('easydav_handler_duration_seconds',
+    'Time spent in a request handler before the response body is sent.',
+    ('handler', ))
+requests_in_progress = Gauge('easydav_requests_in_progress',
+    'Requests being served.')
+request_bytes = Counter('easydav_request_bytes_total',
+    'Bytes of request bodies read.', ('method', ))
+response_bytes = Counter('easydav_response_bytes_total',
+    'Bytes of response bodies sent.', ('method', ))
+errors = Counter('easydav_errors_total',
+    'DAVErrors by HTTP status code.', ('code', ))
+lock_db_duration = Histogram('easydav_lock_db_query_seconds',
+    'Time of lock database queries, including waits for SQLite locks.',
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+lock_db_busy = Counter('easydav_lock_db_busy_total',
+    'Lock database queries that failed because the database was locked.')
+transfer_bytes = Counter('easydav_transfer_bytes_total',
+    'Bytes passed through the read_blocks and write_blocks loops.',
+    ('loop', ))
+transfer_seconds = Counter('easydav_transfer_seconds_total',
+    'Time spent in the read_blocks and write_blocks loops, including '
+    'the time the consumer of the blocks takes.', ('loop', ))
+log_records_dropped = Counter('easydav_log_records_dropped_total',
+    'Log records dropped because the log writer thread fell behind.',
+    ('log', ))
+
+class RequestTimes(threading.local):
+    '''Time spent by the current thread in lock database queries and in
+    file system calls. The access log records the growth of the values
+    during each request.'''
+    lock_db = 0.0
+    fs = 0.0
+
+request_times = RequestTimes()
+
+def timed(histogram, labels, function):
+    '''Wrap a function to observe its duration in the histogram.'''
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.time() - start, labels)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+_start_time = time.time()
+
+def process_samples():
+    '''Return the standard process metrics, which show the CPU and memory
+    that the server needs.'''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    samples = [
+        ('process_cpu_seconds_total', 'counter',
+         'User and system CPU time.', usage.ru_utime + usage.ru_stime),
+        ('process_start_time_seconds', 'gauge',
+         'Start time of the process since the epoch.', _start_time),
+        ('process_threads', 'gauge',
+         'Python threads in the process.', threading.active_count()),
+    ]
+    
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+        samples.append(('process_resident_memory_bytes', 'gauge',
+            'Resident memory size.', pages * resource.getpagesize()))
+        samples.append(('process_open_fds', 'gauge',
+            'Open file descriptors.', len(os.listdir('/proc/self/fd'))))
+    except (IOError, OSError):
+        pass # Not Linux
+    return samples
+
+def expose():
+    '''Return the metrics in the text exposition format.'''
+    pid = str(os.getpid())
+    lines = []
+    for name, kind, help, value in process_samples():
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind),
+                  '%s{pid="%s"} %s' % (name, pid, format_value(value))]
+    
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, value in metric.samples():
+            # The pid label tells the processes of the server apart.
+            if name.endswith('}'):
+                name = name[:-1] + ',pid="' + pid + '"}'
+            else:
+                name += '{pid="' + pid + '"}'
+            lines.append(name + ' ' + format_value(value))
+    
+    return '\n'.join(lines) + '\n'
+
+if __name__ == '__main__':
+    print "Unit tests"
+    
+    assert format_labels(('path', ), (u'a"b\\\n\xe4', )) == \
+        '{path="a\\"b\\\\\\n\xc3\xa4"}'
+    assert format_value(0.1) == '0.1' and format_value(3) == '3'
+    
+    requests.inc(('GET', '200'))
+    requests.inc(('GET', '200'), 2)
+    request_duration.observe(0.003, ('GET', ))
+    request_duration.observe(0.001, ('GET', ))
+    request_duration.observe(1000, ('GET', ))
+    requests_in_progress.inc()
+    requests_in_progress.dec()
+    
+    text = expose()
+    lines = text.splitlines()
+    pid = os.getpid()
+    assert 'easydav_requests_total{method="GET",code="200",pid="%d"} 3' % \
+        pid in lines
+    assert 'easydav_requests_in_progress{pid="%d"} 0' % pid in lines
+    assert ('easydav_request_duration_seconds_bucket'
+            '{method="GET",le="0.001",pid="%d"} 1' % pid) in lines
+    assert ('easydav_request_duration_seconds_bucket'
+            '{method="GET",le="0.005",pid="%d"} 2' % pid) in lines
+    assert ('easydav_request_duration_seconds_bucket'
+            '{method="GET",le="+Inf",pid="%d"} 3' % pid) in lines
+    assert 'easydav_request_duration_seconds_count{method="GET",pid="%d"} 3' \
+        % pid in lines
+    assert '# TYPE easydav_request_duration_seconds histogram' in lines
+    assert [line for line in lines if line.startswith('process_cpu_seconds')]
+    
+    # Every sample line is a name with labels and a number
+    for line in lines:
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            float(value.replace('+Inf', 'inf'))
+    
+    # Each thread has its own request times
+    request_times.fs += 0.5
+    result = []
+    thread = threading.Thread(target = lambda: result.append(request_times.fs))
+    thread.start()
+    thread.join()
+    assert result == [0.0] and request_times.fs == 0.5
+    
+    handler = timed(handler_duration, ('handle_get', ), lambda: 'x')
+    assert handler() == 'x'
+    assert handler_duration.values[('handle_get', )][-1] >= 0
+    
+    print "Unit tests OK"
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+'''Streaming parser for multipart/form-data request bodies, as sent by the
+upload form of the HTML interface. The body is read in large blocks and
+searched for the boundary with str.find(). The data of a file part is
+yielded block by block, so it can be written straight to its destination
+without first spooling it to a temporary file.
+'''
+
+import cgi
+from davutils import DAVError
+
+class Part:
+    '''One part of a multipart body. Name and filename come from the
+    Content-Disposition header; filename is None for ordinary form fields.
+    The data must be read with read_blocks() or read_value() before moving
+    to the next part, otherwise it is skipped.
+    '''
+    def __init__(self, headers, blocks):
+        self.headers = headers
+        disposition, params = cgi.parse_header(
+            headers.get('content-disposition', ''))
+        self.name = params.get('name')
+        self.filename = params.get('filename')
+        self.blocks = blocks
+    
+    def read_blocks(self):
+        '''Return an iterator over the data of the part.'''
+        return self.blocks
+    
+    def read_value(self, limit = 1024*1024):
+        '''Return the data of a form field as a string.'''
+        parts = []
+        size = 0
+        for data in self.blocks:
+            size += len(data)
+            if size > limit:
+                raise DAVError('413 Request Entity Too Large: Form field')
+            parts.append(data)
+        return ''.join(parts)
+
+class MultipartParser:
+    '''Iterate over the parts of a multipart body read from infile.
+    Length is the number of bytes in the body, or -1 to read until the
+    end of the file.
+    '''
+    max_header_size = 64*1024
+    
+    def __init__(self, infile, boundary, length = -1, blocksize = 1024*1024):
+        self.infile = infile
+        self.delimiter = '\r\n--' + boundary
+        self.remaining = length
+        self.blocksize = blocksize
+        
+        # The first boundary is not preceded by a line break.
+        self.buffer = '\r\n'
+    
+    def _fill(self):
+        '''Read the next block to the buffer. Returns False at the end
+        of the body.'''
+        if self.remaining == 0:
+            return False
+        
+        size = self.blocksize
+        if self.remaining > 0:
+            size = min(size, self.remaining)
+        
+        data = self.infile.read(size)
+        if not data:
+            self.remaining = 0
+            return False
+        
+        if self.remaining > 0:
+            self.remaining -= len(data)
+        self.buffer += data
+        return True
+    
+    def _read_body(self):
+        '''Yield the data up to the next delimiter, and remove the
+        delimiter from the buffer.'''
+        # A delimiter may be split between two reads, so its length - 1
+        # bytes are left in the buffer until more data has been read.
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index > 0:
+                    yield self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                return
+            
+            if len(self.buffer) > keep:
+                yield self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+            
+            if not self._fill():
+                raise DAVError('400 Bad Request: Incomplete multipart body')
+    
+    def _read_headers(self):
+        '''Parse the rest of the delimiter line and the part headers.'''
+        while True:
+            start = self.buffer.find('\r\n')
+            if start >= 0:
+                end = self.buffer.find('\r\n\r\n', start)
+                if end >= 0:
+                    break
+            
+            if len(self.buffer) > self.max_header_size:
+                raise DAVError('400 Bad Request: Too long multipart headers')
+            if not self._fill():
+                raise DAVError('400 Bad Request: Incomplete multipart body')
+        
+        headers = {}
+        for line in self.buffer[start + 2:end].split('\r\n'):
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        
+        self.buffer = self.buffer[end + 4:]
+        return headers
+    
+    def __iter__(self):
+        # Skip the preamble before the first boundary.
+        for data in self._read_body():
+            pass
+        
+        while True:
+            while len(self.buffer) < 2:
+                if not self._fill():
+                    raise DAVError('400 Bad Request: Incomplete multipart body')
+            
+            if self.buffer.startswith('--'):
+                return # Closing boundary, the rest is epilogue
+            
+            part = Part(self._read_headers(), self._read_body())
+            yield part
+            
+            for data in part.blocks:
+                pass # Skip the data that was not read
+
+def get_boundary(content_type):
+    '''Return the boundary parameter of a multipart/form-data content type,
+    or None for other content types.'''
+    mimetype, params = cgi.parse_header(content_type)
+    if mimetype != 'multipart/form-data':
+        return None
+    
+    boundary = params.get('boundary', '')
+    if not 0 < len(boundary) <= 70:
+        raise DAVError('400 Bad Request: Invalid multipart boundary')
+    return boundary
+
+if __name__ == '__main__':
+    import StringIO
+    print "Unit tests"
+    
+    boundary = '----WebKitFormBoundary7MA4YWxkTrZu0gW'
+    filedata = ''.join([chr(i % 256) for i in range(100000)])
+    filedata += '\r\n--' + boundary[:-1] # Almost a delimiter
+    body = '\r\n'.join([
+        'preamble',
+        '--' + boundary,
+        'Content-Disposition: form-data; name="file"; filename="a b.dcm"',
+        'Content-Type: application/octet-stream',
+        '',
+        filedata,
+        '--' + boundary,
+        'Content-Disposition: form-data; name="select"',
+        '',
+        'first',
+        '--' + boundary + '  ',
+        'Content-Disposition: form-data; name="select"',
+        '',
+        '',
+        '--' + boundary,
+        'Content-Disposition: form-data; name="skipped"; filename="x"',
+        '',
+        'not read',
+        '--' + boundary + '--',
+        'epilogue'])
+    
+    assert get_boundary('multipart/form-data; boundary=' + boundary) == boundary
+    assert get_boundary('application/x-www-form-urlencoded') is None
+    
+    # Block sizes that split the delimiters at every position
+    for blocksize in (1, 7, 64, 1000, 1024*1024):
+        parser = MultipartParser(StringIO.StringIO(body), boundary,
+            len(body), blocksize)
+        parts = []
+        for part in parser:
+            if part.name == 'file':
+                value = ''.join(part.read_blocks())
+            elif part.name == 'select':
+                value = part.read_value()
+            else:
+                value = None
+            parts.append((part.name, part.filename, value))
+        
+        assert parts == [('file', 'a b.dcm', filedata),
+                         ('select', None, 'first'),
+                         ('select', None, ''),
+                         ('skipped', 'x', None)]
+    
+    parser = MultipartParser(StringIO.StringIO(body[:5000]), boundary)
+    try:
+        for part in parser:
+            pass
+        assert False
+    except DAVError, e:
+        assert e.httpstatus.startswith('400')
+    
+    part = iter(MultipartParser(StringIO.StringIO(body), boundary)).next()
+    try:
+        part.read_value(limit = 1000)
+        assert False
+    except DAVError, e:
+        assert e.httpstatus.startswith('413')
+    
+    print "Unit tests OK"
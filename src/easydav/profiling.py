@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+'''Profiling of single requests with cProfile, to find out whether a slow
+PROPFIND or ZIP download spends its time in XML serialization, path
+matching, the lock database or stat calls. A request is profiled when
+
+- config.profile_all is set, or
+- a random draw falls below config.profile_sample, or
+- it has the header 'X-EasyDAV-Profile' with the value of
+  config.profile_token.
+
+For each profiled request, a cProfile dump that can be loaded with the
+pstats module or tools such as snakeviz, and a text summary of the top
+functions, are written to config.profile_dir. The directory must be
+outside root_dir, so that the dumps are not served to WebDAV clients.
+
+When none of the triggers is configured, webdav.main is not wrapped at
+all. Only the thread that serves the request is profiled; the threads
+that compress ZIP downloads or run background jobs are not.
+'''
+
+import cProfile
+import errno
+import hmac
+import logging
+import os
+import os.path
+import pstats
+import random
+import time
+import uuid
+import StringIO
+import davutils
+
+def is_enabled():
+    '''Check if any profiling trigger is configured and the dump directory
+    is usable.'''
+    if not (config.profile_all or config.profile_sample
+            or config.profile_token):
+        return False
+    
+    if not config.profile_dir:
+        logging.error('Profiling needs profile_dir to be set')
+        return False
+    
+    profile_dir = os.path.realpath(config.profile_dir)
+    if davutils.path_inside_directory(profile_dir,
+                                      os.path.realpath(config.root_dir)):
+        logging.error('Profile_dir must be outside root_dir, '
+                      'profiling disabled')
+        return False
+    
+    return True
+
+def compare_token(given, expected):
+    '''Compare the tokens in constant time, if the Python version allows.'''
+    compare_digest = getattr(hmac, 'compare_digest', None)
+    if compare_digest is None:
+        return given == expected
+    return compare_digest(given, expected)
+
+def wants_profile(environ):
+    '''Check if the request should be profiled.'''
+    if config.profile_all:
+        return True
+    
+    if config.profile_sample and random.random() < config.profile_sample:
+        return True
+    
+    token = environ.get('HTTP_X_EASYDAV_PROFILE')
+    return bool(token and config.profile_token
+                and compare_token(token, config.profile_token))
+
+def write_profile(profiler, environ, status, duration):
+    '''Write the cProfile dump and the text summary of a request. Returns
+    the path of the dump without the extension.'''
+    try:
+        os.makedirs(config.profile_dir, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    
+    method = environ.get('REQUEST_METHOD', '').upper()
+    name = '%s-%d-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                            ''.join(c for c in method if c.isalnum()),
+                            uuid.uuid4().hex[:8])
+    path = os.path.join(config.profile_dir, name)
+    profiler.dump_stats(path + '.prof')
+    
+    summary = StringIO.StringIO()
+    summary.write('%s %s%s\n' % (method, environ.get('SCRIPT_NAME', ''),
+                                 environ.get('PATH_INFO', '')))
+    summary.write('Status %s, %.3f seconds\n' % (status, duration))
+    stats = pstats.Stats(profiler, stream = summary)
+    stats.sort_stats('cumulative').print_stats(config.profile_top)
+    stats.sort_stats('time').print_stats(config.profile_top)
+    open(path + '.txt', 'w').write(summary.getvalue())
+    return path
+
+class ProfiledResponse(object):
+    '''Runs the application with the profiler enabled, also while its
+    response body is generated and closed. The profile is written when
+    the server closes the response. Use response() to get the object to
+    return to the server.
+    '''
+    def __init__(self, application, environ, start_response):
+        self.environ = environ
+        self.status = None
+        self.start = time.time()
+        self.profiler = cProfile.Profile()
+        
+        def profiled_start_response(status, headers, exc_info = None):
+            self.status = status
+            return start_response(status, headers, exc_info)
+        
+        self.body = self.profiler.runcall(application, environ,
+                                          profiled_start_response)
+    
+    def response(self):
+        '''Return self, or for a file response an object of the
+        wsgi.file_wrapper class, so that the server can still send the
+        file with sendfile(). The sending is then not profiled.'''
+        wrapped = davutils.wrap_file_response(self.environ, self.body,
+                                              self.write)
+        return wrapped or self
+    
+    def __iter__(self):
+        iterator = self.profiler.runcall(iter, self.body)
+        while True:
+            try:
+                data = self.profiler.runcall(iterator.next)
+            except StopIteration:
+                return
+            yield data
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.profiler.runcall(self.body.close)
+        finally:
+            self.write()
+    
+    def write(self):
+        try:
+            write_profile(self.profiler, self.environ, self.status,
+                          time.time() - self.start)
+        except (IOError, OSError):
+            logging.error('Writing profile failed', exc_info = 1)
+
+def profiled(application):
+    '''Wrap a WSGI application to profile the requests selected by
+    wants_profile().'''
+    def profiled_application(environ, start_response):
+        if not wants_profile(environ):
+            return application(environ, start_response)
+        return ProfiledResponse(application, environ,
+                                start_response).response()
+    profiled_application.__name__ = application.__name__
+    profiled_application.__doc__ = application.__doc__
+    return profiled_application
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import shutil, tempfile
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = unicode(tempfile.mkdtemp())
+        profile_dir = os.path.join(tempfile.mkdtemp(), 'profiles')
+        profile_all = False
+        profile_sample = 0
+        profile_token = None
+        profile_top = 10
+    
+    def busy_function(n):
+        return sum(i * i for i in range(n))
+    
+    def application(environ, start_response):
+        start_response('207 Multi-Status', [])
+        for i in range(3):
+            yield str(busy_function(10000))
+    
+    assert not is_enabled()
+    config.profile_token = 'secret'
+    assert is_enabled()
+    assert not wants_profile({})
+    assert not wants_profile({'HTTP_X_EASYDAV_PROFILE': 'wrong'})
+    assert wants_profile({'HTTP_X_EASYDAV_PROFILE': 'secret'})
+    
+    real_profile_dir = config.profile_dir
+    config.profile_dir = os.path.join(config.root_dir, 'profiles')
+    assert not is_enabled()
+    config.profile_dir = real_profile_dir
+    
+    app = profiled(application)
+    statuses = []
+    def start_response(status, headers, exc_info = None):
+        statuses.append(status)
+    environ = {'REQUEST_METHOD': 'PROPFIND', 'PATH_INFO': '/dir/'}
+    body = app(environ, start_response)
+    assert not isinstance(body, ProfiledResponse)
+    assert list(body) == ['333283335000'] * 3
+    
+    environ['HTTP_X_EASYDAV_PROFILE'] = 'secret'
+    body = app(environ, start_response)
+    assert list(body) == ['333283335000'] * 3
+    assert not os.path.exists(config.profile_dir)
+    body.close()
+    assert statuses == ['207 Multi-Status'] * 2
+    
+    names = sorted(os.listdir(config.profile_dir))
+    assert len(names) == 2 and '-PROPFIND-' in names[0]
+    assert names[0].endswith('.prof') and names[1].endswith('.txt')
+    summary = open(os.path.join(config.profile_dir, names[1])).read()
+    assert summary.startswith('PROPFIND /dir/\nStatus 207 Multi-Status')
+    assert 'busy_function' in summary
+    stats = pstats.Stats(os.path.join(config.profile_dir, names[0]))
+    calls = [key for key in stats.stats if key[2] == 'busy_function']
+    assert stats.stats[calls[0]][1] == 3
+    
+    # File responses keep the wsgi.file_wrapper class for sendfile()
+    import wsgiref.util
+    def file_application(environ, start_response):
+        start_response('200 OK', [])
+        return environ['wsgi.file_wrapper'](StringIO.StringIO('data'))
+    
+    environ['wsgi.file_wrapper'] = wsgiref.util.FileWrapper
+    body = profiled(file_application)(environ, start_response)
+    assert isinstance(body, wsgiref.util.FileWrapper)
+    assert ''.join(body) == 'data'
+    body.close()
+    assert len(os.listdir(config.profile_dir)) == 4
+    
+    config.profile_token = None
+    config.profile_sample = 0.5
+    random.seed(1)
+    selected = [wants_profile({}) for i in range(1000)]
+    assert 400 < selected.count(True) < 600
+    
+    shutil.rmtree(config.root_dir)
+    shutil.rmtree(os.path.dirname(config.profile_dir))
+    print "Unit tests OK"
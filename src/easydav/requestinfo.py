@@ -4,6 +4,8 @@
 
 import logging
 import os.path
+import stat
+import time
 import unicodedata
 import urlparse
 import urllib
@@ -12,8 +14,10 @@ import xml.etree.ElementTree as ET
 from xml.parsers.expat import ExpatError
 
 import davutils
+import etags
+import metrics
 from davutils import DAVError
-from lock_manager import LockManager
+from lock_manager import LockManager, get_lockmanager
 import webdavconfig as config
 
 class RequestInfo(object):
@@ -32,19 +36,57 @@ class RequestInfo(object):
         else:
             self.length = 0
         self._lockmanager = None
+        self.stat_cache = {}
         self.root_url = self.get_root_url()
         self.check_if_header()
     
     def get_lockmanager(self):
-        '''Lazy construction for LockManager to avoid unnecessarily opening
-        the database.
+        '''Lazy access to the LockManager to avoid unnecessarily opening
+        the database. The manager comes from a per-thread pool and is
+        shared with other requests.
         '''
         if self._lockmanager is None and config.lock_db:
-            self._lockmanager = LockManager()
+            self._lockmanager = get_lockmanager()
         return self._lockmanager
     
     lockmanager = property(get_lockmanager)
     
+    def stat(self, real_path):
+        '''Return os.stat() result for the path, or None if it does not exist.
+        Results are cached for the duration of the request, so that access
+        checks, URLs and properties of a resource share a single stat call.
+        '''
+        try:
+            return self.stat_cache[real_path]
+        except KeyError:
+            pass
+        
+        start = time.time()
+        try:
+            st = os.stat(real_path)
+        except OSError:
+            st = None
+        metrics.request_times.fs += time.time() - start
+        
+        self.stat_cache[real_path] = st
+        return st
+    
+    def remember_stat(self, real_path, st):
+        '''Add an already known os.stat() result, such as one found while
+        walking a directory tree, to the stat cache.
+        '''
+        self.stat_cache[real_path] = st
+    
+    def forget_stat(self, real_path = None):
+        '''Remove a path from the stat cache, or clear the whole cache if
+        path is None. Used after the request has modified files, and to
+        keep memory use bounded when walking large directory trees.
+        '''
+        if real_path is None:
+            self.stat_cache.clear()
+        else:
+            self.stat_cache.pop(real_path, None)
+    
     def log_environ(self):
         '''Log relevant WSGI environment variables for debugging purposes.'''
         headers = ['HTTP_HOST', 'REQUEST_URI', 'PATH_INFO',
@@ -107,7 +149,8 @@ class RequestInfo(object):
             for c_type, c_invert, c_value in conditions:
                 if c_type == 'etag':
                     real_path = self.get_real_path(rel_path, 'r')
-                    cond_passed = (davutils.create_etag(real_path) == c_value)
+                    etag = etags.create_etag(real_path, self.stat(real_path))
+                    cond_passed = (etag == c_value)
                 elif c_type == 'token':
                     cond_passed = self.lockmanager.validate_lock(rel_path, c_value)
                     self.provided_tokens.append((rel_path, c_value))
@@ -131,10 +174,11 @@ class RequestInfo(object):
         if not davutils.path_inside_directory(real_path, config.root_dir):
             raise DAVError('403 Permission Denied: Path is outside root_dir')
         
-        if davutils.compare_path(real_path, config.restrict_access):
+        if davutils.get_matcher(config.restrict_access).match(real_path):
             raise DAVError('403 Permission Denied: restrict_access')
         
-        if not os.path.exists(real_path):
+        st = self.stat(real_path)
+        if st is None:
             raise DAVError('404 Not Found')
         
         if not os.access(real_path, os.R_OK):
@@ -154,10 +198,10 @@ class RequestInfo(object):
         if not davutils.path_inside_directory(real_path, config.root_dir):
             raise DAVError('403 Permission Denied: Path is outside root_dir')
         
-        if davutils.compare_path(real_path, config.restrict_access):
+        if davutils.get_matcher(config.restrict_access).match(real_path):
             raise DAVError('403 Permission Denied: restrict_access')
         
-        if davutils.compare_path(real_path, config.restrict_write):
+        if davutils.get_matcher(config.restrict_write).match(real_path):
             raise DAVError('403 Permission Denied: restrict_write')
         
         if not os.path.exists(real_path):
@@ -281,7 +325,8 @@ class RequestInfo(object):
         rel_path = urllib.quote(rel_path.encode('utf-8'))
         url = urlparse.urljoin(self.root_url, rel_path)
         
-        if os.path.isdir(real_path) and not url.endswith('/'):
+        st = self.stat(real_path)
+        if st is not None and stat.S_ISDIR(st.st_mode) and not url.endswith('/'):
             url += '/' # Trailing slash for directories
         
         return url
@@ -332,6 +377,81 @@ class RequestInfo(object):
         else:
             return not davutils.compare_etags(etag, if_none_match)
     
+    def check_preconditions(self, etag, mtime):
+        '''Evaluate the conditional headers of a GET or HEAD request as
+        specified in RFC 7232 section 6, for a resource with the specified
+        ETag and modification time.
+        
+        Returns True if the resource should be sent, or False if the
+        response should be 304 Not Modified. Raises DAVError if the
+        request should fail with 412 Precondition Failed.
+        '''
+        if_match = self.environ.get('HTTP_IF_MATCH', '')
+        if_none_match = self.environ.get('HTTP_IF_NONE_MATCH', '')
+        
+        # Last-Modified has a resolution of one second.
+        mtime = int(mtime)
+        
+        if if_match:
+            if not davutils.compare_etags(etag, if_match):
+                raise DAVError('412 Precondition Failed')
+        else:
+            since = davutils.parse_http_date(
+                self.environ.get('HTTP_IF_UNMODIFIED_SINCE', ''))
+            if since is not None and mtime > since:
+                raise DAVError('412 Precondition Failed')
+        
+        if if_none_match:
+            return not davutils.compare_etags(etag, if_none_match)
+        else:
+            since = davutils.parse_http_date(
+                self.environ.get('HTTP_IF_MODIFIED_SINCE', ''))
+            return since is None or mtime > since
+    
+    def get_ranges(self, size, validators):
+        '''Parse the HTTP Range and If-Range headers for a resource of
+        the specified size. Validators is a tuple of the current ETag and
+        Last-Modified values of the resource.
+        
+        Returns None if the whole resource should be sent, otherwise
+        a list of (start, stop) byte ranges. An empty list means that
+        the range is not satisfiable and the request should fail with
+        416 Requested Range Not Satisfiable.
+        '''
+        range_header = self.environ.get('HTTP_RANGE')
+        if not range_header:
+            return None
+        
+        # If the resource has changed, If-Range asks for the whole new
+        # version instead of a part of it. Only strong validators match.
+        if_range = self.environ.get('HTTP_IF_RANGE', '').strip()
+        if if_range and if_range not in validators:
+            return None
+        
+        return davutils.parse_range(range_header, size)
+    
+    def get_content_range(self):
+        '''Parse the Content-Range header of a PUT request.
+        Returns None if there is no header, otherwise a (start, stop, total)
+        tuple as returned by davutils.parse_content_range().
+        '''
+        header = self.environ.get('HTTP_CONTENT_RANGE')
+        if not header:
+            return None
+        
+        content_range = davutils.parse_content_range(header)
+        if content_range is None:
+            raise DAVError('400 Bad Request: Invalid Content-Range')
+        
+        start, stop, total = content_range
+        if start is not None and self.length >= 0 \
+                and self.length != stop - start:
+            raise DAVError('400 Bad Request: Content-Range does not match length')
+        if start is None and self.length > 0:
+            raise DAVError('400 Bad Request: Body without a byte range')
+        
+        return content_range
+    
     def get_xml_body(self):
         '''Decode the request body with ElementTree, returning an
         Element object or None.'''
@@ -485,9 +605,189 @@ if __name__ == '__main__':
     assert req.get_request_path('r')
     assert req.get_request_path('w')
     
+    # Read permission is checked with os.access(), which also knows about
+    # ACLs that the mode bits do not show.
+    real_access = os.access
+    os.access = lambda path, mode: not (mode & os.R_OK)
+    try:
+        req.assert_read(testfile)
+        assert False
+    except DAVError, e:
+        assert e.httpstatus.startswith('403')
+    finally:
+        os.access = real_access
+    
     assert req.get_url(testfile) == 'http://example.com/webdav.cgi/testfile%25%C3%A4'
     assert req.parse_simple_ref(req.get_url(testfile)) == u'testfile%ä'
     
+    # Conditional GET
+    import StringIO
+    config.log_file = None
+    config.access_log = None
+    config.log_level = logging.ERROR
+    import webdav
+    
+    def get(headers = {}):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/testfile%\xc3\xa4',
+            'HTTP_HOST': 'example.com',
+            'REMOTE_ADDR': '127.0.0.1',
+            'wsgi.input': StringIO.StringIO(''),
+            'wsgi.url_scheme': 'http',
+        }
+        environ.update(headers)
+        response = []
+        def start_response(status, headers, exc_info = None):
+            response.append((status, dict(headers)))
+        body = ''.join(webdav.main(environ, start_response))
+        return response[0][0], response[0][1], body
+    
+    status, headers, body = get()
+    assert status == '200 OK' and body == 'foo'
+    etag = headers['Etag']
+    last_modified = headers['Last-Modified']
+    
+    # Repeated fetches with the validators transfer no body
+    for conditions in ({'HTTP_IF_NONE_MATCH': etag},
+                       {'HTTP_IF_NONE_MATCH': '"other", ' + etag},
+                       {'HTTP_IF_NONE_MATCH': '*'},
+                       {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+        status, headers, body = get(conditions)
+        assert status == '304 Not Modified' and body == '', conditions
+        assert headers['Etag'] == etag
+    
+    # If-None-Match takes precedence over If-Modified-Since
+    status, headers, body = get({'HTTP_IF_NONE_MATCH': '"other"',
+                                 'HTTP_IF_MODIFIED_SINCE': last_modified})
+    assert status == '200 OK' and body == 'foo'
+    
+    status, headers, body = get({'HTTP_IF_MODIFIED_SINCE':
+                                 'Sun, 06 Nov 1994 08:49:37 GMT'})
+    assert status == '200 OK' and body == 'foo'
+    
+    status, headers, body = get({'HTTP_IF_UNMODIFIED_SINCE':
+                                 'Sun, 06 Nov 1994 08:49:37 GMT'})
+    assert status == '412 Precondition Failed'
+    
+    status, headers, body = get({'HTTP_IF_MATCH': '"other"'})
+    assert status == '412 Precondition Failed'
+    
+    status, headers, body = get({'HTTP_IF_MATCH': etag,
+                                 'HTTP_IF_UNMODIFIED_SINCE': 'invalid'})
+    assert status == '200 OK' and body == 'foo'
+    
+    # PROPFIND does not descend into restricted directories
+    os.makedirs(os.path.join(config.root_dir, u'dir', u'.svn', u'deep'))
+    open(os.path.join(config.root_dir, u'dir', u'visible'), 'w').close()
+    listed = []
+    def counted_list_directory(path):
+        listed.append(path)
+        return real_list_directory(path)
+    real_list_directory = davutils.list_directory
+    davutils.list_directory = counted_list_directory
+    status, headers, body = get({'REQUEST_METHOD': 'PROPFIND',
+                                 'PATH_INFO': '/dir/',
+                                 'HTTP_DEPTH': 'infinity'})
+    davutils.list_directory = real_list_directory
+    assert status == '207 Multistatus'
+    assert '/dir/visible' in body and '.svn' not in body
+    assert listed == [os.path.join(config.root_dir, u'dir')]
+    
+    # Failures after the headers are reported in the listing
+    def failing_read_properties(path, st, request_props):
+        if path.endswith('visible'):
+            raise IOError('Disk failure')
+        return real_read_properties(path, st, request_props)
+    real_read_properties = webdav.read_properties
+    webdav.read_properties = failing_read_properties
+    status, headers, body = get({'REQUEST_METHOD': 'PROPFIND',
+                                 'PATH_INFO': '/dir/',
+                                 'HTTP_DEPTH': '1'})
+    assert status == '207 Multistatus'
+    assert ('/dir/visible</D:href><D:status>HTTP/1.1 500 Internal Server'
+            ' Error</D:status>') in body
+    assert body.endswith('</D:multistatus>\n')
+    
+    status, headers, body = get({'REQUEST_METHOD': 'PROPFIND',
+                                 'PATH_INFO': '/dir/visible',
+                                 'HTTP_DEPTH': '0'})
+    webdav.read_properties = real_read_properties
+    assert status.startswith('500')
+    
+    # Deleting a file removes its content hash from the index
+    config.etag_mode, real_etag_mode = 'content', config.etag_mode
+    etags.xattr = None
+    removed = os.path.join(config.root_dir, u'dir', u'removed')
+    open(removed, 'w').write('x')
+    etags.create_etag(removed)
+    assert etags.get_hash_index().get(removed)
+    status, headers, body = get({'REQUEST_METHOD': 'DELETE',
+                                 'PATH_INFO': '/dir/removed'})
+    assert status == '204 No Content'
+    assert etags.get_hash_index().get(removed) is None
+    config.etag_mode = real_etag_mode
+    
+    # The stand-alone server sends files with sendfile() also when the
+    # response is measured for the metrics.
+    import httplib, threading, server
+    assert config.metrics_path
+    calls = []
+    def counted_sendfile(*args):
+        calls.append(args)
+        return real_sendfile(*args)
+    real_sendfile, server.sendfile = server.sendfile, counted_sendfile
+    
+    httpd = server.make_server('127.0.0.1', 0, webdav.main, mode = 'single',
+                               keepalive = 0)
+    thread = threading.Thread(target = httpd.handle_request)
+    thread.start()
+    conn = httplib.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    conn.request('GET', '/testfile%25%C3%A4')
+    response = conn.getresponse()
+    assert response.status == 200 and response.read() == 'foo'
+    thread.join()
+    httpd.server_close()
+    assert len(calls) == 1
+    
+    # A short send closes a keep-alive connection
+    server.sendfile = lambda *args: 0
+    httpd = server.make_server('127.0.0.1', 0, webdav.main, mode = 'single',
+                               keepalive = 5)
+    thread = threading.Thread(target = httpd.handle_request)
+    thread.start()
+    conn = httplib.HTTPConnection('127.0.0.1', httpd.server_address[1],
+                                  timeout = 2)
+    conn.request('GET', '/testfile%25%C3%A4')
+    response = conn.getresponse()
+    try:
+        response.read()
+        assert False
+    except httplib.IncompleteRead:
+        pass
+    thread.join(2)
+    assert not thread.is_alive()
+    httpd.server_close()
+    server.sendfile = real_sendfile
+    
+    # A client that stalls in the middle of the headers is disconnected,
+    # and the pool accepts no more connections than it has workers.
+    import socket
+    httpd = server.make_server('127.0.0.1', 0, webdav.main, mode = 'thread',
+                               workers = 1, keepalive = 5,
+                               request_timeout = 0.5)
+    assert httpd.connections.maxsize == 1
+    thread = threading.Thread(target = httpd.handle_request)
+    thread.start()
+    client = socket.create_connection(httpd.server_address, 5)
+    client.sendall('GET /testfile%25%C3%A4 HTTP/1.1\r\nHost: x\r\n')
+    start = time.time()
+    assert client.recv(100) == ''
+    assert time.time() - start < 2
+    client.close()
+    thread.join()
+    httpd.server_close()
+    
     shutil.rmtree(config.root_dir)
     
     print "Unit tests OK"
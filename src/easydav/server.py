@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+
+'''Stand-alone HTTP server for EasyDAV, built on wsgiref.
+
+The plain wsgiref.simple_server handles one request at a time, so that a
+single long upload blocks every other client. This module adds a pool of
+worker threads or worker processes on top of it, HTTP/1.1 keep-alive and a
+configurable listen backlog. It still drives any WSGI application, normally
+webdav.main.
+
+Modes, selected with server_mode in webdavconfig.py:
+- 'single': the original single-threaded wsgiref server.
+- 'thread': a fixed pool of server_workers threads in one process.
+- 'process': server_workers forked processes accepting on a shared socket.
+'''
+
+import errno
+import logging
+import mimetypes
+import os
+import select
+import signal
+import socket
+import threading
+import Queue
+from wsgiref import simple_server
+
+import webdavconfig as config
+
+def load_sendfile():
+    '''Return a function sendfile(out_fd, in_fd, offset, count) that
+    copies data between file descriptors inside the kernel, or None if
+    the platform does not have it. Python 2 has no os.sendfile, so the
+    C library function is called through ctypes.
+    '''
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        libc_sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+    
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    
+    return sendfile
+
+sendfile = load_sendfile()
+
+class InputStream(object):
+    '''Request body stream for one request on a persistent connection.
+    Limits reads to Content-Length, so that the application can never
+    consume the next request, and allows discarding any unread part of
+    the body afterwards.
+    '''
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint = -1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def discard(self):
+        '''Read and throw away the rest of the request body.'''
+        while self.remaining > 0:
+            if not self.read(64 * 1024):
+                break
+
+class ServerHandler(simple_server.ServerHandler):
+    '''wsgiref handler that answers with HTTP/1.1 and keeps the connection
+    open after the response. Responses of unknown length, such as streamed
+    PROPFIND results, are sent with chunked transfer encoding to HTTP/1.1
+    clients.
+    '''
+    http_version = '1.1'
+    keep_alive = False
+    chunked = False
+    sending_body = False
+
+    def cleanup_headers(self):
+        simple_server.ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers and self.has_body():
+            if (self.keep_alive and self.has_body()
+                    and self.request_handler.request_version == 'HTTP/1.1'):
+                self.chunked = True
+                self.headers['Transfer-Encoding'] = 'chunked'
+            else:
+                self.keep_alive = False
+        
+        if not self.keep_alive:
+            self.headers['Connection'] = 'close'
+    
+    def has_body(self):
+        '''Check whether the response can have a message body.'''
+        return (self.environ['REQUEST_METHOD'] != 'HEAD'
+                and self.status[:3] not in ('204', '304')
+                and not self.status.startswith('1'))
+    
+    def send_headers(self):
+        simple_server.ServerHandler.send_headers(self)
+        self.sending_body = True
+    
+    def _write(self, data):
+        # SimpleHandler._write would replace itself with stdout.write
+        if self.chunked and self.sending_body:
+            if data:
+                self.stdout.write('%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.stdout.write(data)
+    
+    def finish_content(self):
+        if not self.headers_sent and not self.has_body():
+            # BaseHandler would add Content-Length: 0, which in a 304 or
+            # HEAD response claims that the resource is empty.
+            self.send_headers()
+        else:
+            simple_server.ServerHandler.finish_content(self)
+        if self.chunked:
+            self.sending_body = False
+            self._write('0\r\n\r\n')
+    
+    def handle_error(self):
+        # The connection is in an unknown state after a failed response.
+        self.keep_alive = False
+        simple_server.ServerHandler.handle_error(self)
+    
+    def sendfile(self):
+        '''Transmit a response made with wsgi.file_wrapper using sendfile(),
+        so that the file contents never pass through Python strings.
+        Handles both plain files and davutils.FileSlice objects.
+        '''
+        filelike = self.result.filelike
+        if sendfile is None or not hasattr(filelike, 'fileno'):
+            return False
+        
+        if 'Content-Length' not in self.headers:
+            return False # Chunked encoding goes through the normal path
+        
+        try:
+            in_fd = filelike.fileno()
+            if hasattr(filelike, 'offset'):
+                offset, count = filelike.offset, filelike.count
+            else:
+                offset = filelike.tell()
+                count = os.fstat(in_fd).st_size - offset
+        except (AttributeError, IOError, OSError):
+            return False
+        
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        
+        out_fd = self.request_handler.connection.fileno()
+        while count > 0:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, min(count, 1 << 30))
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    # Sockets with a timeout are in non-blocking mode
+                    timeout = self.request_handler.connection.gettimeout()
+                    if not select.select([], [out_fd], [], timeout)[1]:
+                        raise socket.timeout('timed out')
+                    continue
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            
+            if sent == 0:
+                # File was truncated while sending. The headers are already
+                # out, so only closing the connection tells the client
+                # that the body is incomplete.
+                self.keep_alive = False
+                self.request_handler.close_connection = 1
+                break
+            
+            offset += sent
+            count -= sent
+            self.bytes_sent += sent
+        
+        return True
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+    '''Request handler that serves multiple requests per connection and
+    handles 'Expect: 100-continue' itself.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        '''Serve requests until the client or the response closes the
+        connection, or until keep-alive timeout expires.
+        '''
+        self.close_connection = 0
+        while not self.close_connection:
+            self.connection.settimeout(self.server.keepalive or None)
+            try:
+                self.handle_one_request()
+            except socket.timeout:
+                self.close_connection = 1
+
+    def handle_one_request(self):
+        '''Handle a single HTTP request.'''
+        self.raw_requestline = self.rfile.readline(65537)
+        self.connection.settimeout(self.server.request_timeout or None)
+
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            self.close_connection = 1
+            return
+
+        environ = self.get_environ()
+
+        if environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+            # Chunked request bodies are not decoded by wsgiref, so the
+            # connection can not be reused after them.
+            self.close_connection = 1
+            stdin = self.rfile
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            stdin = InputStream(self.rfile, length)
+
+        if environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+            self.wfile.write(self.protocol_version + ' 100 Continue\r\n\r\n')
+            del environ['HTTP_EXPECT']
+
+        handler = ServerHandler(stdin, self.wfile, self.get_stderr(), environ,
+            multithread = self.server.multithread,
+            multiprocess = self.server.multiprocess)
+        handler.request_handler = self      # backpointer for logging
+        handler.keep_alive = bool(self.server.keepalive
+            and not self.close_connection)
+        handler.run(self.server.get_app())
+
+        if not handler.keep_alive:
+            self.close_connection = 1
+        elif isinstance(stdin, InputStream):
+            stdin.discard()
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s' % (self.client_address[0], format % args))
+
+class WSGIServer(simple_server.WSGIServer):
+    '''Single-threaded server with configurable backlog and keep-alive.
+    Request_timeout limits how long a client may stall while a request
+    is received or its response sent, 0 for no limit.
+    '''
+    allow_reuse_address = True
+    multithread = False
+    multiprocess = False
+
+    def __init__(self, server_address, handler_class = RequestHandler,
+                 backlog = 5, keepalive = 0, request_timeout = 0):
+        self.request_queue_size = backlog
+        self.keepalive = keepalive
+        self.request_timeout = request_timeout
+        simple_server.WSGIServer.__init__(self, server_address, handler_class)
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''Server that hands accepted connections to a fixed pool of worker
+    threads. Unlike SocketServer.ThreadingMixIn, the number of threads is
+    bounded, so that a burst of clients can not exhaust the process.
+    Connections are only accepted when a worker is about to be free, so
+    that the others wait in the listen backlog.
+    '''
+    multithread = True
+
+    def __init__(self, server_address, handler_class = RequestHandler,
+                 backlog = 5, keepalive = 0, workers = 8,
+                 request_timeout = 0):
+        WSGIServer.__init__(self, server_address, handler_class,
+            backlog, keepalive, request_timeout)
+        self.connections = Queue.Queue(workers)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target = self.worker_loop,
+                name = 'easydav-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        # Blocks while all workers are busy
+        self.connections.put((request, client_address))
+
+    def worker_loop(self):
+        '''Serve connections from the queue until a None is received.'''
+        while True:
+            item = self.connections.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for thread in self.threads:
+            self.connections.put(None)
+
+class PreforkWSGIServer(WSGIServer):
+    '''Server that forks a number of worker processes, which all accept
+    connections from the same listening socket. Dead workers are restarted.
+    '''
+    multiprocess = True
+
+    def __init__(self, server_address, handler_class = RequestHandler,
+                 backlog = 5, keepalive = 0, workers = 8,
+                 request_timeout = 0):
+        WSGIServer.__init__(self, server_address, handler_class,
+            backlog, keepalive, request_timeout)
+        self.workers = workers
+        self.children = set()
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+
+        # In the worker process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            WSGIServer.serve_forever(self)
+        finally:
+            os._exit(0)
+
+    def serve_forever(self, poll_interval = 0.5):
+        '''Run the workers and restart them if they exit, until the
+        master process receives SIGTERM or SIGINT.
+        '''
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            while True:
+                while len(self.children) < self.workers:
+                    self.spawn_worker()
+
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+
+                self.children.discard(pid)
+                logging.warn('Worker %d exited with status %d' % (pid, status))
+        finally:
+            self.stop_workers()
+
+    def stop_workers(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children.clear()
+
+def make_server(host, port, app, mode = None, workers = None,
+                backlog = None, keepalive = None, request_timeout = None):
+    '''Create a server listening on host and port for the WSGI app.
+    Arguments that are None are taken from webdavconfig.
+    '''
+    if mode is None:
+        mode = config.server_mode
+    if workers is None:
+        workers = config.server_workers
+    if backlog is None:
+        backlog = config.server_backlog
+    if keepalive is None:
+        keepalive = config.server_keepalive
+    if request_timeout is None:
+        request_timeout = config.server_timeout
+
+    # mimetypes initializes its tables lazily on first use,
+    # which is not thread safe.
+    mimetypes.init()
+
+    if mode == 'single':
+        server = WSGIServer((host, port), RequestHandler, backlog, keepalive,
+            request_timeout)
+    elif mode == 'thread':
+        server = ThreadPoolWSGIServer((host, port), RequestHandler,
+            backlog, keepalive, workers, request_timeout)
+    elif mode == 'process':
+        server = PreforkWSGIServer((host, port), RequestHandler,
+            backlog, keepalive, workers, request_timeout)
+    else:
+        raise ValueError('Invalid server_mode: ' + repr(mode))
+
+    server.set_app(app)
+    return server
+
+def serve_forever(app):
+    '''Run the server configured in webdavconfig until interrupted.'''
+    server = make_server(config.server_host, config.server_port, app)
+    logging.info('Serving on %s:%d, mode %s, %d workers' % (config.server_host,
+        config.server_port, config.server_mode, config.server_workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+'''Common code of the SQLite databases of EasyDAV: the locks, resumable
+uploads, background jobs and content hashes. Each thread has its own
+connection to each database, and all of them follow the storage profile
+configured for the lock database, as they are stored on the same file
+system.
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from davutils import DAVError
+
+class Database:
+    '''Base class for an object that keeps its state in a SQLite database.
+    Subclasses create their tables in _create_tables() and set name, which
+    is used in error messages. Config is the configuration module of the
+    subclass, and the keyword arguments are passed to sqlite3.connect().
+    '''
+    name = 'DB'
+    
+    def __init__(self, dbpath, config, **kwargs):
+        self.dbpath = dbpath
+        self.pid = os.getpid()
+        self.db_conn = sqlite3.connect(dbpath,
+            isolation_level = None,
+            timeout = config.lock_wait,
+            **kwargs)
+        self.db_cursor = self.db_conn.cursor()
+        
+        self._set_pragmas(config)
+        self._create_tables()
+    
+    def _set_pragmas(self, config):
+        '''Apply the storage profile from the configuration. The journal
+        mode is stored in the database file, the other settings only apply
+        to this connection.
+        '''
+        if config.lock_journal_mode:
+            self._sql_query('PRAGMA journal_mode = ' + config.lock_journal_mode)
+        if config.lock_synchronous:
+            self._sql_query('PRAGMA synchronous = ' + config.lock_synchronous)
+        if config.lock_mmap_size is not None:
+            self._sql_query('PRAGMA mmap_size = %d' % config.lock_mmap_size)
+    
+    def _create_tables(self):
+        pass
+    
+    def close(self):
+        self.db_conn.close()
+    
+    def _sql_query(self, *args, **kwargs):
+        '''Run a database query and wrap SQLite OperationalErrors, such
+        as locked databases.
+        '''
+        try:
+            self.db_cursor.execute(*args, **kwargs)
+        except sqlite3.OperationalError, e:
+            if 'locked' in e.message:
+                raise DAVError('503 Service Unavailable: '
+                               + self.name + ' is busy')
+            else:
+                raise DAVError('500 Internal Server Error: '
+                               + self.name + ': ' + e.message)
+
+class DatabasePool:
+    '''Gives each thread its own object of a Database class. The objects
+    and their database connections are kept open and reused by later
+    requests served by the same thread. A new one is created with
+    factory() after fork(), or if the database path has changed.
+    
+    If purge is given, purge(database) is called at most once every
+    purge_interval seconds in the process, to remove expired rows.
+    '''
+    def __init__(self, factory, purge = None):
+        self.factory = factory
+        self.purge = purge
+        self.local = threading.local()
+        self.next_purge = 0
+    
+    def get(self, dbpath, purge_interval = 0):
+        '''Return the object of the current thread for the database.'''
+        database = getattr(self.local, 'database', None)
+        if (database is None or database.pid != os.getpid()
+                or database.dbpath != dbpath):
+            database = self.local.database = self.factory()
+        
+        now = time.time()
+        if self.purge is not None and now >= self.next_purge:
+            self.next_purge = now + purge_interval
+            try:
+                self.purge(database)
+            except DAVError:
+                pass # Database is busy, try again later
+        
+        return database
+
+if __name__ == '__main__':
+    import shutil, tempfile
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        lock_wait = 5
+        lock_journal_mode = 'WAL'
+        lock_synchronous = 'NORMAL'
+        lock_mmap_size = 0
+    
+    testdir = tempfile.mkdtemp()
+    dbpath = os.path.join(testdir, 'test.db')
+    
+    class Counter(Database):
+        name = 'Counter DB'
+        
+        def __init__(self):
+            Database.__init__(self, dbpath, config)
+        
+        def _create_tables(self):
+            self._sql_query('CREATE TABLE IF NOT EXISTS counts (n INTEGER)')
+    
+    purged = []
+    pool = DatabasePool(Counter, purged.append)
+    db = pool.get(dbpath, 60)
+    assert pool.get(dbpath, 60) is db and purged == [db]
+    
+    db._sql_query('PRAGMA journal_mode')
+    assert db.db_cursor.fetchone()[0] == 'wal'
+    db._sql_query('PRAGMA synchronous')
+    assert db.db_cursor.fetchone()[0] == 1
+    
+    try:
+        db._sql_query('SELECT * FROM missing')
+        assert False
+    except DAVError, e:
+        assert e.httpstatus.startswith('500 Internal Server Error: Counter DB')
+    
+    # Each thread has its own connection
+    other = []
+    thread = threading.Thread(target = lambda: other.append(pool.get(dbpath)))
+    thread.start()
+    thread.join()
+    assert other[0] is not db and len(purged) == 1
+    
+    # The journal mode is only changed if configured
+    config.lock_journal_mode = None
+    db = Counter()
+    db._sql_query('PRAGMA journal_mode')
+    assert db.db_cursor.fetchone()[0] == 'wal'
+    
+    shutil.rmtree(testdir)
+    print "Unit tests OK"
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+'''Fast deletion of files and directory trees. Instead of removing the
+files one by one while the client waits, remove() renames the target into
+a hidden trash directory under the root directory, which takes the same
+time for a single file and for a study folder of a million images.
+
+A reaper thread in each server process empties the trash in the
+background. It runs with the lowest CPU priority and, on Linux, with the
+idle I/O scheduling class, so that it only uses the disk when the
+requests of the clients do not. A file lock on the trash directory lets
+only one process empty it at a time.
+'''
+
+import atexit
+import errno
+import fcntl
+import logging
+import os
+import os.path
+import platform
+import threading
+import uuid
+import filecopy
+
+# System call numbers of ioprio_set(), which has no C library wrapper.
+_ioprio_syscalls = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def load_ioprio_set():
+    '''Return a function ioprio_set(ioprio) that sets the I/O priority of
+    the calling thread, or None if the platform does not have it. The
+    system call has no C library wrapper, so it is made through ctypes.
+    '''
+    number = _ioprio_syscalls.get(platform.machine())
+    if number is None:
+        return None
+    
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        syscall = libc.syscall
+    except (OSError, AttributeError):
+        return None
+    
+    def ioprio_set(ioprio):
+        # With id 0, only the calling thread is affected.
+        if syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    
+    return ioprio_set
+
+ioprio_set = load_ioprio_set()
+
+def set_idle_priority():
+    '''Lower the CPU and I/O priority of the calling thread. On Linux,
+    nice() affects only the calling thread, not the other threads of the
+    process. Returns True if the I/O priority was set.
+    '''
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+    
+    if ioprio_set is None:
+        return False
+    
+    try:
+        ioprio_set(IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        return True
+    except OSError:
+        return False
+
+def get_trash_path():
+    '''Trash_dir can be absolute path or relative to root dir.'''
+    return os.path.join(config.root_dir, config.trash_dir)
+
+def move_to_trash(real_path):
+    '''Rename a file or directory into the trash. Returns False if the
+    trash is disabled or on a different file system than real_path.'''
+    if not config.trash_dir:
+        return False
+    
+    trash_path = get_trash_path()
+    target = os.path.join(trash_path, uuid.uuid4().hex)
+    try:
+        try:
+            os.rename(real_path, target)
+        except OSError, e:
+            if e.errno != errno.ENOENT or os.path.isdir(trash_path):
+                raise
+            
+            # The first deletion creates the trash directory.
+            try:
+                os.mkdir(trash_path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.rename(real_path, target)
+    except OSError, e:
+        if e.errno == errno.EXDEV:
+            return False
+        raise
+    
+    start_reaper()
+    _wakeup.set()
+    return True
+
+def remove(real_path, progress = None):
+    '''Delete a file or a directory tree, through the trash if possible.
+    Progress is passed to filecopy.remove_tree when the tree has to be
+    removed at once.'''
+    if move_to_trash(real_path):
+        return
+    
+    if os.path.isdir(real_path):
+        filecopy.remove_tree(real_path, progress)
+    else:
+        os.unlink(real_path)
+
+def empty_trash():
+    '''Remove the contents of the trash, unless another process is already
+    doing it. Returns the number of removed entries.'''
+    trash_path = get_trash_path()
+    try:
+        names = os.listdir(trash_path)
+    except OSError:
+        return 0 # Nothing has been deleted yet
+    
+    # The names of the deleted entries never start with a dot.
+    if not [name for name in names if not name.startswith('.')]:
+        return 0
+    
+    lockfile = open(os.path.join(trash_path, '.reaper'), 'a')
+    try:
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return 0 # Another process is emptying the trash
+        
+        count = 0
+        for name in os.listdir(trash_path):
+            if name.startswith('.'):
+                continue
+            
+            path = os.path.join(trash_path, name)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    filecopy.remove_tree(path)
+                else:
+                    os.unlink(path)
+                count += 1
+            except OSError:
+                logging.error('Could not remove ' + repr(path) + ' from trash',
+                              exc_info = 1)
+        return count
+    finally:
+        lockfile.close()
+
+_wakeup = threading.Event()
+_stopping = threading.Event()
+_reapers = {}
+
+def reaper_loop():
+    '''Empty the trash whenever something is moved there, and check it
+    every config.lock_purge_interval seconds for leftovers of other
+    processes and earlier runs.'''
+    # The interpreter clears the module globals at exit while daemon
+    # threads still run, so use local references and stop quietly then.
+    wakeup, stopping, log_error = _wakeup, _stopping, logging.error
+    interval = config.lock_purge_interval
+    set_idle_priority()
+    while not stopping.is_set():
+        wakeup.clear()
+        try:
+            empty_trash()
+        except:
+            if not stopping.is_set():
+                log_error('Emptying trash failed', exc_info = 1)
+        wakeup.wait(interval)
+
+def stop_reaper():
+    '''Tell the reaper thread to exit, called at interpreter exit.'''
+    _stopping.set()
+    _wakeup.set()
+
+atexit.register(stop_reaper)
+
+def start_reaper():
+    '''Start the reaper thread of the process if it is not running.'''
+    key = os.getpid()
+    thread = _reapers.get(key)
+    if thread is None or not thread.is_alive():
+        _reapers.clear() # Threads do not survive fork()
+        thread = _reapers[key] = threading.Thread(target = reaper_loop,
+                                                  name = 'trash reaper')
+        thread.daemon = True
+        thread.start()
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import shutil, tempfile, time
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = unicode(tempfile.mkdtemp())
+        trash_dir = '.easydav_trash'
+        lock_purge_interval = 60
+    
+    tree = os.path.join(config.root_dir, u'study \xe4')
+    os.makedirs(os.path.join(tree, 'series'))
+    for i in range(100):
+        open(os.path.join(tree, 'series', str(i)), 'w').write('x')
+    os.symlink(config.root_dir, os.path.join(tree, 'link'))
+    single = os.path.join(config.root_dir, 'file')
+    open(single, 'w').write('x')
+    
+    assert empty_trash() == 0
+    assert move_to_trash(tree) and move_to_trash(single)
+    assert not os.path.exists(tree) and not os.path.exists(single)
+    
+    def wait_until_empty():
+        for i in range(100):
+            if os.listdir(get_trash_path()) == ['.reaper']:
+                return True
+            time.sleep(0.05)
+        return False
+    
+    # The reaper thread was woken up and removes both entries
+    assert wait_until_empty()
+    assert os.path.isdir(config.root_dir)
+    
+    # Nothing is removed while another process holds the lock
+    lockfile = open(os.path.join(get_trash_path(), '.reaper'), 'a')
+    fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+    os.mkdir(tree)
+    remove(tree)
+    assert not os.path.exists(tree)
+    assert empty_trash() == 0
+    assert len(os.listdir(get_trash_path())) == 2
+    lockfile.close()
+    _wakeup.set()
+    assert wait_until_empty()
+    
+    result = []
+    thread = threading.Thread(target = lambda: result.append(
+        set_idle_priority()))
+    thread.start()
+    thread.join()
+    assert result == [platform.machine() in _ioprio_syscalls]
+    
+    os.mkdir(tree)
+    config.trash_dir = None
+    remove(tree)
+    assert not os.path.exists(tree)
+    
+    # The reaper exits when the interpreter exits
+    thread = _reapers[os.getpid()]
+    stop_reaper()
+    thread.join(5)
+    assert not thread.is_alive()
+    
+    shutil.rmtree(config.root_dir)
+    print "Unit tests OK"
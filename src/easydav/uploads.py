@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+'''Resumable uploads. A client can send a large file in pieces, using
+PUT requests with a Content-Range header:
+
+    PUT /study/volume.nrrd
+    Content-Range: bytes 0-8388607/10737418240
+
+The pieces can arrive in any order, and several of them in parallel.
+Each piece is written at its offset to a partial file next to the target,
+and the received byte ranges are recorded in a SQLite database. When the
+last missing piece arrives, the partial file is renamed over the target.
+Until then the server answers 202 Accepted with a Range header listing the
+received ranges, so that after an interruption the client only sends the
+missing ones. A PUT with 'Content-Range: bytes */10737418240' and an empty
+body asks for the received ranges without sending data.
+'''
+
+import errno
+import os
+import os.path
+import time
+import uuid
+import davutils
+import sqlitedb
+from davutils import DAVError
+
+partial_prefix = '.easydav_partial_'
+
+def merge_ranges(ranges):
+    '''Combine overlapping and adjacent (start, stop) ranges.'''
+    result = []
+    for start, stop in sorted(ranges):
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], max(stop, result[-1][1]))
+        else:
+            result.append((start, stop))
+    return result
+
+def format_ranges(ranges):
+    '''Format (start, stop) ranges for a Range header.'''
+    return 'bytes=' + ','.join(['%d-%d' % (start, stop - 1)
+                                for start, stop in ranges])
+
+class UploadManager(sqlitedb.Database):
+    '''Keeps track of the unfinished uploads in a database. There is one
+    row for each target file, and the received ranges of its partial file.
+    Old unfinished uploads are removed after config.upload_expire seconds.
+    '''
+    name = 'Upload DB'
+    
+    def __init__(self):
+        sqlitedb.Database.__init__(self, get_dbpath(), config)
+    
+    def _create_tables(self):
+        self._sql_query('''CREATE TABLE IF NOT EXISTS uploads (
+            path TEXT PRIMARY KEY,
+            total INTEGER,
+            partial TEXT,
+            updated REAL)''')
+        self._sql_query('''CREATE TABLE IF NOT EXISTS upload_ranges (
+            path TEXT,
+            start INTEGER,
+            stop INTEGER)''')
+        self._sql_query('''CREATE INDEX IF NOT EXISTS upload_ranges_idx
+            ON upload_ranges (path)''')
+    
+    def _get_ranges(self, real_path):
+        self._sql_query('''SELECT start, stop FROM upload_ranges
+            WHERE path = ?''', (real_path, ))
+        return merge_ranges(self.db_cursor.fetchall())
+    
+    def _remove(self, real_path, partial):
+        '''Forget an upload and remove its partial file. Must be called
+        inside a transaction.'''
+        self._sql_query('DELETE FROM uploads WHERE path = ?', (real_path, ))
+        self._sql_query('DELETE FROM upload_ranges WHERE path = ?',
+            (real_path, ))
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+    
+    def get_ranges(self, real_path, total):
+        '''Return the received ranges of the upload to real_path, or an
+        empty list if there is no upload of that total size.'''
+        self._sql_query('SELECT total FROM uploads WHERE path = ?',
+            (real_path, ))
+        row = self.db_cursor.fetchone()
+        if row is None or row[0] != total:
+            return []
+        return self._get_ranges(real_path)
+    
+    def begin(self, real_path, total):
+        '''Return the path of the partial file for an upload of total bytes
+        to real_path, creating it for the first piece. An unfinished upload
+        of a different size to the same path is discarded.
+        '''
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            self._sql_query('SELECT total, partial FROM uploads WHERE path = ?',
+                (real_path, ))
+            row = self.db_cursor.fetchone()
+            
+            if row is not None and row[0] == total:
+                partial = row[1]
+            else:
+                if row is not None:
+                    self._remove(real_path, row[1])
+                
+                partial = os.path.join(os.path.dirname(real_path),
+                    partial_prefix + uuid.uuid4().hex)
+                create_partial(partial, total)
+                self._sql_query('INSERT INTO uploads VALUES (?,?,?,?)',
+                    (real_path, total, partial, time.time()))
+            
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+        
+        return partial
+    
+    def add_range(self, real_path, partial, start, stop):
+        '''Record that bytes start .. stop - 1 have been written to the
+        partial file. Returns the received ranges. When they cover the
+        whole file, the upload is removed from the database and the
+        caller should move the partial file in place.
+        '''
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            self._sql_query('SELECT total FROM uploads '
+                'WHERE path = ? AND partial = ?', (real_path, partial))
+            row = self.db_cursor.fetchone()
+            if row is None:
+                raise DAVError('409 Conflict: Upload was finished or replaced')
+            total = row[0]
+            
+            ranges = merge_ranges(self._get_ranges(real_path)
+                                  + [(start, stop)])
+            self._sql_query('DELETE FROM upload_ranges WHERE path = ?',
+                (real_path, ))
+            
+            if ranges == [(0, total)]:
+                self._sql_query('DELETE FROM uploads WHERE path = ?',
+                    (real_path, ))
+            else:
+                for range_start, range_stop in ranges:
+                    self._sql_query('INSERT INTO upload_ranges VALUES (?,?,?)',
+                        (real_path, range_start, range_stop))
+                self._sql_query('UPDATE uploads SET updated = ? WHERE path = ?',
+                    (time.time(), real_path))
+            
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+        
+        return ranges
+    
+    def purge_uploads(self):
+        '''Remove the uploads that have not received data for
+        config.upload_expire seconds, and their partial files.'''
+        limit = time.time() - config.upload_expire
+        self._sql_query('SELECT path, partial FROM uploads WHERE updated < ?',
+            (limit, ))
+        expired = self.db_cursor.fetchall()
+        if not expired:
+            return
+        
+        self._sql_query('BEGIN IMMEDIATE TRANSACTION')
+        try:
+            for real_path, partial in expired:
+                self._remove(real_path, partial)
+            self._sql_query('END TRANSACTION')
+        except:
+            self._sql_query('ROLLBACK')
+            raise
+
+def create_partial(partial, total):
+    '''Create the partial file, reserving the disk space if configured.'''
+    # Mode 0666 gives the same permissions as open(real_path, 'wb').
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+    try:
+        if config.upload_preallocate and davutils.fallocate is not None:
+            try:
+                davutils.fallocate(fd, 0, total)
+            except OSError, e:
+                if e.errno == errno.ENOSPC:
+                    os.close(fd)
+                    fd = None
+                    os.unlink(partial)
+                    raise DAVError('507 Insufficient Storage')
+                # Otherwise not supported by the file system, ignore.
+        os.ftruncate(fd, total)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def write_range(partial, start, blocks):
+    '''Write the blocks to the partial file starting at offset start.
+    Returns the number of bytes written.'''
+    try:
+        fd = os.open(partial, os.O_WRONLY)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            raise DAVError('409 Conflict: Upload was finished or replaced')
+        raise
+    
+    outfile = os.fdopen(fd, 'wb')
+    try:
+        outfile.seek(start)
+        written = 0
+        for data in blocks:
+            outfile.write(data)
+            written += len(data)
+        outfile.flush()
+        if config.upload_fsync:
+            os.fsync(fd)
+        return written
+    finally:
+        outfile.close()
+
+def finish(partial, real_path):
+    '''Move a completely received partial file in place of real_path.'''
+    os.rename(partial, real_path)
+    if config.upload_fsync == 'dir':
+        davutils.fsync_directory(os.path.dirname(real_path))
+
+def get_dbpath():
+    '''Upload_db can be absolute path or relative to root dir.'''
+    return os.path.join(config.root_dir, config.upload_db)
+
+_pool = sqlitedb.DatabasePool(UploadManager, UploadManager.purge_uploads)
+
+def get_upload_manager():
+    '''Return the UploadManager of the current thread, see
+    sqlitedb.DatabasePool. Expired uploads are purged at most once every
+    config.lock_purge_interval seconds.
+    '''
+    return _pool.get(get_dbpath(), config.lock_purge_interval)
+
+if __name__ != '__main__':
+    import webdavconfig as config
+else:
+    import shutil, tempfile
+    print "Unit tests"
+    
+    class config:
+        '''Configuration for unit testing'''
+        root_dir = unicode(tempfile.mkdtemp())
+        upload_db = '.easydav_uploads'
+        upload_expire = 3600
+        upload_fsync = 'file'
+        upload_preallocate = True
+        lock_wait = 5
+        lock_purge_interval = 60
+        lock_journal_mode = 'DELETE'
+        lock_synchronous = 'FULL'
+        lock_mmap_size = None
+    
+    assert merge_ranges([(5, 10), (0, 3), (3, 4), (8, 12)]) == \
+        [(0, 4), (5, 12)]
+    assert format_ranges([(0, 4), (5, 12)]) == 'bytes=0-3,5-11'
+    
+    target = os.path.join(config.root_dir, u'target \xe4.bin')
+    data = ''.join([chr(i % 256) for i in range(1000)])
+    pieces = [(300, 600), (0, 300), (600, 1000)]
+    
+    manager = get_upload_manager()
+    assert manager.get_ranges(target, len(data)) == []
+    
+    # The storage profile of the lock database applies
+    manager._sql_query('PRAGMA journal_mode')
+    assert manager.db_cursor.fetchone()[0] == 'delete'
+    for i, (start, stop) in enumerate(pieces):
+        partial = manager.begin(target, len(data))
+        assert os.path.basename(partial).startswith(partial_prefix)
+        assert write_range(partial, start, [data[start:stop]]) == stop - start
+        ranges = manager.add_range(target, partial, start, stop)
+        if i == 0:
+            assert manager.get_ranges(target, len(data)) == [(300, 600)]
+            assert manager.get_ranges(target, 999) == []
+    
+    assert ranges == [(0, len(data))]
+    finish(partial, target)
+    assert open(target, 'rb').read() == data
+    assert manager.get_ranges(target, len(data)) == []
+    assert os.listdir(config.root_dir).count(os.path.basename(target)) == 1
+    
+    # A late duplicate of a piece of a finished upload
+    try:
+        write_range(partial, 0, ['x'])
+        assert False
+    except DAVError, e:
+        assert e.httpstatus.startswith('409')
+    
+    # Starting over with a different size replaces the old upload
+    partial = manager.begin(target, 10)
+    manager.add_range(target, partial, 0, 5)
+    partial2 = manager.begin(target, 20)
+    assert partial2 != partial and not os.path.exists(partial)
+    assert manager.get_ranges(target, 20) == []
+    try:
+        manager.add_range(target, partial, 5, 10)
+        assert False
+    except DAVError, e:
+        assert e.httpstatus.startswith('409')
+    
+    # Expired uploads are removed with their partial files
+    config.upload_expire = -1
+    manager.purge_uploads()
+    assert not os.path.exists(partial2)
+    assert manager.get_ranges(target, 20) == []
+    
+    manager.close()
+    shutil.rmtree(config.root_dir)
+    print "Unit tests OK"
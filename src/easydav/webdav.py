@@ -20,17 +20,34 @@ __program_name__ = 'EasyDAV'
 __version__ = "0.5-dev"
 
 import cgi
-import kid
-import kid.parser
+import itertools
+import json
 import logging
 import os
 import os.path
 import shutil
+import stat
 import sys
-import tempfile
-import zipfile
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+import xml.etree.ElementTree as ET
 
+import accesslog
 import davutils
+import davxml
+import etags
+import filecopy
+import jobs
+import listing
+import metrics
+import multipart
+import profiling
+import trash
+import uploads
+import zipstream
 from davutils import DAVError
 from requestinfo import RequestInfo
 from wsgi_input_wrapper import WSGIInputWrapper
@@ -38,24 +55,33 @@ import webdavconfig as config
 
 def initialize_logging():
     '''Initialize python logging module based on configuration file.
+    The log files are written by a background thread, see accesslog.py.
     Mark completion by setting logging.log_init_done to True.
     '''
     formatter = logging.Formatter(
     '%(asctime)s %(process)d %(levelname)s %(message)s')
     
     logging.getLogger().setLevel(config.log_level)
+    mypath = os.path.dirname(os.path.abspath(__file__))
+    handlers = []
     
     if config.log_file:
-        mypath = os.path.dirname(os.path.abspath(__file__))
         logfile = os.path.join(mypath, config.log_file)
         filehandler = logging.FileHandler(filename = logfile)
         filehandler.setFormatter(formatter)
-        logging.getLogger().addHandler(filehandler)
+        handlers.append(filehandler)
     
     if sys.stderr.isatty():
         streamhandler = logging.StreamHandler(sys.stderr)
         streamhandler.setFormatter(formatter)
-        logging.getLogger().addHandler(streamhandler)
+        handlers.append(streamhandler)
+    
+    if handlers:
+        logging.getLogger().addHandler(
+            accesslog.QueueHandler(handlers, config.log_queue_size))
+    
+    if config.access_log:
+        accesslog.initialize(os.path.join(mypath, config.access_log))
     
     logging.log_init_done = True
 
@@ -63,9 +89,25 @@ def initialize_logging():
 if not hasattr(logging, 'log_init_done'):
     initialize_logging()
 
-multistatus = kid.load_template('multistatus.kid')
-dirindex = kid.load_template('dirindex.kid')
-activelock = kid.load_template('activelock.kid')
+templates = {}
+templates_lock = threading.Lock()
+
+def get_template(name):
+    '''Load a kid template when it is first needed. Only the HTML
+    interface uses templates, so WebDAV clients are served without
+    importing kid at all. Kid compiles the template to a .pyc file next
+    to the .kid file, if it can write there; otherwise each process
+    compiles it again in memory, so the templates should be compiled
+    when installing.
+    '''
+    templates_lock.acquire()
+    try:
+        if not templates.has_key(name):
+            import kid
+            templates[name] = kid.load_template(name + '.kid')
+        return templates[name]
+    finally:
+        templates_lock.release()
 
 def handle_options(reqinfo, start_response):
     '''Handle an OPTIONS request.'''
@@ -76,58 +118,59 @@ def handle_options(reqinfo, start_response):
         start_response('200 OK', [('DAV', '1')])
     return ""
 
-def get_resourcetype(path):
+collection_type = [ET.Element('{DAV:}collection')]
+
+def get_resourcetype(path, st):
     '''Return the contents for <DAV:resourcetype> property.'''
-    if os.path.isdir(path):
-        element = kid.parser.Element('{DAV:}collection')
-        return kid.parser.ElementStream([
-            (kid.parser.START, element),
-            (kid.parser.END, element)
-        ])
+    if stat.S_ISDIR(st.st_mode):
+        return collection_type
     else:
         return ''
 
-def get_supportedlock(path):
+supported_locks = [
+    ET.XML('<D:lockentry xmlns:D="DAV:">'
+           '<D:lockscope><D:exclusive/></D:lockscope>'
+           '<D:locktype><D:write/></D:locktype>'
+           '</D:lockentry>'),
+    ET.XML('<D:lockentry xmlns:D="DAV:">'
+           '<D:lockscope><D:shared/></D:lockscope>'
+           '<D:locktype><D:write/></D:locktype>'
+           '</D:lockentry>')
+]
+
+def get_supportedlock(path, st):
     '''Return the contents for <DAV:supportedlock> property.'''
-    if os.path.isdir(path):
-        return kid.parser.XML('''
-            <D:lockentry xmlns:D="DAV">
-                <D:lockscope><D:exclusive /></D:lockscope>
-                <D:locktype><D:write /></D:locktype>
-            </D:lockentry>
-            <D:lockentry xmlns:D="DAV">
-                <D:lockscope><D:shared /></D:lockscope>
-                <D:locktype><D:write /></D:locktype>
-            </D:lockentry>
-        ''')
+    if stat.S_ISDIR(st.st_mode):
+        return supported_locks
     else:
         return ''
 
 # All supported properties.
 # Key is the element name inside DAV:prop element.
 # Value is tuple of functions: (get, set)
-# Get takes a file name and returns string.
+# Get takes a file name and its os.stat() result and returns string,
+# or a list of ElementTree elements.
 # Set takes a file name and a string value.
 # Set may be None to specify protected property.
 property_handlers = {
     '{DAV:}creationdate': (
-        lambda path: davutils.get_isoformat(os.path.getctime(path)),
+        lambda path, st: davutils.get_isoformat(st.st_ctime),
         None
     ),
     '{DAV:}getcontentlength': (
-        lambda path: str(os.path.getsize(path)),
+        lambda path, st: str(st.st_size),
         None
     ),
     '{DAV:}getetag': (
-        davutils.create_etag,
+        etags.create_etag,
         None
     ),
     '{DAV:}getlastmodified': (
-        lambda path: davutils.get_rfcformat(os.path.getmtime(path)),
+        lambda path, st: davutils.get_rfcformat(st.st_mtime),
         davutils.set_mtime
     ),
     '{DAV:}getcontenttype': (
-        davutils.get_mimetype,
+        lambda path, st: davutils.get_mimetype(path),
         None
     ),
     '{DAV:}resourcetype': (
@@ -139,8 +182,9 @@ property_handlers = {
 if config.lock_db is not None:
     property_handlers['{DAV:}supportedlock'] = (get_supportedlock, None)
 
-def read_properties(real_path, requested):
+def read_properties(real_path, st, requested):
     '''Return a propstats dictionary for the file specified by real_path.
+    St is the os.stat() result for the file.
     The argument 'requested' is either a list of property names,
     or the special value 'propname'.
     In the second case this function returns all defined properties but no
@@ -160,7 +204,7 @@ def read_properties(real_path, requested):
             continue
         
         try:
-            value = property_handlers[prop][0](real_path)
+            value = property_handlers[prop][0](real_path, st)
             davutils.add_to_dict_list(propstats, '200 OK', (prop, value))
         except Exception, e:
             logging.error('Property handler ' + repr(prop) + ' failed',
@@ -171,29 +215,79 @@ def read_properties(real_path, requested):
 
 def handle_propfind(reqinfo, start_response):
     '''Handle propfind request by listing files and their associated
-    properties.
+    properties. The response is generated while the directory tree is
+    walked, so that memory use does not depend on the number of files.
     '''
     depth = reqinfo.get_depth('infinity')
     request_props = reqinfo.parse_propfind_body(property_handlers.keys())
     real_path = reqinfo.get_request_path('r')
     
-    result_files = []
-    for path in davutils.search_directory(real_path, depth):
+    # The request url is handled before the headers are sent, so that
+    # errors with it still get their own status code.
+    result_files = propfind_results(reqinfo, real_path, depth, request_props)
+    first = result_files.next()
+    
+    start_response('207 Multistatus',
+        [('Content-Type', 'text/xml; charset=utf-8')])
+    return davutils.join_blocks(davxml.multistatus(
+        itertools.chain([first], result_files)))
+
+def propfind_results(reqinfo, real_path, depth, request_props):
+    '''Generate the (url, propstats) tuples for a PROPFIND response.
+    If a Depth: infinity request reaches config.propfind_max_entries,
+    the listing ends with a 507 Insufficient Storage status for the
+    request url. Errors with the request url are raised, as it comes
+    first, but other failed resources get a 500 status in the listing.
+    '''
+    if depth == -1:
+        max_entries = config.propfind_max_entries
+    else:
+        max_entries = None
+    
+    def forbidden(entry):
+        '''Do not descend into directories that are left out of the
+        listing, such as the trash or restrict_access matches.'''
+        try:
+            reqinfo.assert_read(entry.path)
+        except DAVError, e:
+            return e.httpstatus.startswith('403')
+        return False
+    
+    count = 0
+    for entry in davutils.walk_directory(real_path, depth, forbidden):
+        path = entry.path
+        reqinfo.remember_stat(path, entry.stat())
         try:
             reqinfo.assert_read(path)
         except DAVError, e:
+            if path == real_path:
+                raise
             if e.httpstatus.startswith('403'):
                 continue # Skip forbidden paths from listing
-            raise
+            if e.httpstatus.startswith('404'):
+                continue # Removed while the listing was in progress
+            yield (reqinfo.get_url(path), e)
+            continue
+        
+        if max_entries is not None and count >= max_entries:
+            logging.warn('PROPFIND truncated at ' + str(count) + ' entries')
+            yield (reqinfo.get_url(real_path),
+                DAVError('507 Insufficient Storage',
+                    '<D:number-of-matches-within-limits xmlns:D="DAV:"/>'))
+            return
         
+        count += 1
         real_url = reqinfo.get_url(path)
-        propstats = read_properties(path, request_props)
-        result_files.append((real_url, propstats))
-
-    start_response('207 Multistatus',
-        [('Content-Type', 'text/xml; charset=utf-8')])
-    t = multistatus.Template(result_files = result_files)
-    return [t.serialize(output = 'xml')]
+        try:
+            propstats = read_properties(path, reqinfo.stat(path),
+                                        request_props)
+        except Exception:
+            if path == real_path:
+                raise
+            logging.error('PROPFIND failed for ' + repr(path), exc_info = True)
+            propstats = DAVError('500 Internal Server Error')
+        reqinfo.forget_stat(path)
+        yield (real_url, propstats)
      
 def proppatch_verify_instruction(real_path, instruction):
     '''Verify that the property can be set on the file, or throw a DAVError.
@@ -210,7 +304,7 @@ def proppatch_verify_instruction(real_path, instruction):
         
         if property_handlers[propname][1] is None:
             raise DAVError('403 Forbidden',
-                '<DAV:cannot-modify-protected-property/>')
+                '<D:cannot-modify-protected-property xmlns:D="DAV:"/>')
     
     elif command == 'remove':
         # No properties to remove so far.
@@ -244,34 +338,91 @@ def handle_proppatch(reqinfo, start_response):
     
     start_response('207 Multistatus',
         [('Content-Type', 'text/xml; charset=utf-8')])
-    t = multistatus.Template(result_files = [(real_url, propstats)])
-    return [t.serialize(output = 'xml')]
+    return [''.join(davxml.multistatus([(real_url, propstats)]))]
+
+def write_file(real_path, blocks, length = -1):
+    '''Write the blocks to a file, replacing real_path atomically once all
+    of the data has been received. Length is the expected number of bytes,
+    or -1 if not known. If fewer bytes arrive, the old file is kept.
+    '''
+    size = None
+    if length > 0 and config.upload_preallocate:
+        size = length
+    
+    outfile = davutils.AtomicFile(real_path, size, config.upload_fsync)
+    try:
+        davutils.write_blocks(outfile, blocks)
+        
+        if length >= 0 and outfile.bytes_written < length:
+            raise DAVError('400 Bad Request: Incomplete request body')
+        
+        outfile.commit()
+    except:
+        outfile.abort()
+        raise
+
+def put_range(reqinfo, start_response, real_path, content_range):
+    '''Receive a piece of a resumable upload, see uploads.py.
+    Returns True if the file is now complete. Otherwise sends the
+    202 Accepted response listing the received ranges.
+    '''
+    if not config.upload_db:
+        raise DAVError('501 Not Implemented: Resumable uploads disabled')
+    
+    start, stop, total = content_range
+    manager = uploads.get_upload_manager()
+    
+    if start is None:
+        ranges = manager.get_ranges(real_path, total)
+    else:
+        partial = manager.begin(real_path, total)
+        blocks = davutils.read_blocks(reqinfo.wsgi_input, stop - start)
+        if uploads.write_range(partial, start, blocks) != stop - start:
+            raise DAVError('400 Bad Request: Incomplete request body')
+        
+        ranges = manager.add_range(real_path, partial, start, stop)
+        if ranges == [(0, total)]:
+            uploads.finish(partial, real_path)
+            return True
+    
+    headers = []
+    if ranges:
+        headers.append(('Range', uploads.format_ranges(ranges)))
+    start_response('202 Accepted', headers)
+    return False
 
 def handle_put(reqinfo, start_response):
-    '''Write to a single file, possibly replacing an existing one.'''
+    '''Write to a single file, possibly replacing an existing one.
+    With a Content-Range header, the request is a piece of a resumable
+    upload, and the file is replaced when all pieces have arrived.
+    '''
     real_path = reqinfo.get_request_path('w')
+    st = reqinfo.stat(real_path)
     
-    if os.path.isdir(real_path):
+    if st is not None and stat.S_ISDIR(st.st_mode):
         raise DAVError('405 Method Not Allowed: Overwriting directory')
     
-    if os.path.exists(real_path):
-        etag = davutils.create_etag(real_path)
+    if st is not None:
+        etag = etags.create_etag(real_path, st)
     else:
         etag = None
     
     if not reqinfo.check_ifmatch(etag):
         raise DAVError('412 Precondition Failed')
     
-    new_file = not os.path.exists(real_path)
-    if not new_file:
-        # Unlink the old file to reset mode bits.
-        # This has the additional benefit that old GET operations can
-        # continue even if the file is replaced.
-        os.unlink(real_path)
-
-    outfile = open(real_path, 'wb')
-    block_generator = davutils.read_blocks(reqinfo.wsgi_input)
-    davutils.write_blocks(outfile, block_generator)
+    new_file = st is None
+    
+    content_range = reqinfo.get_content_range()
+    if content_range is not None:
+        if not put_range(reqinfo, start_response, real_path, content_range):
+            return ""
+    else:
+        # The new file is renamed over the old one when complete. This resets
+        # the mode bits, and old GET operations can continue with the old file.
+        block_generator = davutils.read_blocks(reqinfo.wsgi_input)
+        write_file(real_path, block_generator, reqinfo.length)
+    
+    reqinfo.forget_stat(real_path)
     
     if new_file:
         start_response('201 Created', [])
@@ -284,25 +435,94 @@ def handle_get(reqinfo, start_response):
     '''Download a single file or show directory index.'''
     reqinfo.assert_nobody()
     real_path = reqinfo.get_request_path('r')
+    st = reqinfo.stat(real_path)
     
-    if os.path.isdir(real_path):
+    if stat.S_ISDIR(st.st_mode):
         return handle_dirindex(reqinfo, start_response)
     
-    etag = davutils.create_etag(real_path)
-    if not reqinfo.check_ifmatch(etag):
-        raise DAVError('412 Precondition Failed')
+    etag = etags.create_etag(real_path, st)
+    last_modified = davutils.get_rfcformat(st.st_mtime)
+    headers = [('Etag', etag),
+               ('Last-Modified', last_modified)]
     
-    start_response('200 OK',
-        [('Content-Type', davutils.get_mimetype(real_path)),
-         ('Etag', etag),
-         ('Content-Length', str(os.path.getsize(real_path))),
-         ('Last-Modified', davutils.get_rfcformat(os.path.getmtime(real_path)))])
+    if config.cache_control:
+        headers.append(('Cache-Control', config.cache_control))
+    
+    if not reqinfo.check_preconditions(etag, st.st_mtime):
+        start_response('304 Not Modified', headers)
+        return ''
+    
+    size = st.st_size
+    mimetype = davutils.get_mimetype(real_path)
+    headers.append(('Accept-Ranges', 'bytes'))
+    
+    ranges = reqinfo.get_ranges(size, (etag, last_modified))
+    
+    if ranges is None:
+        status = '200 OK'
+        ranges = [(0, size)]
+        headers += [('Content-Type', mimetype),
+                    ('Content-Length', str(size))]
+    elif not ranges:
+        start_response('416 Requested Range Not Satisfiable',
+            [('Content-Type', 'text/plain'),
+             ('Content-Range', 'bytes */' + str(size))])
+        return ['416 Requested Range Not Satisfiable']
+    elif len(ranges) == 1:
+        status = '206 Partial Content'
+        start, stop = ranges[0]
+        headers += [('Content-Type', mimetype),
+                    ('Content-Length', str(stop - start)),
+                    ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, size))]
+    else:
+        status = '206 Partial Content'
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, stop in ranges:
+            part_header = ('\r\n--' + boundary + '\r\n'
+                + 'Content-Type: ' + mimetype + '\r\n'
+                + 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (start, stop - 1, size))
+            parts.append((part_header, start, stop))
+        trailer = '\r\n--' + boundary + '--\r\n'
+        length = len(trailer) + sum(len(h) + stop - start for h, start, stop in parts)
+        headers += [('Content-Type', 'multipart/byteranges; boundary=' + boundary),
+                    ('Content-Length', str(length))]
+    
+    start_response(status, headers)
     
     if reqinfo.environ['REQUEST_METHOD'] == 'HEAD':
         return ''
     
     infile = open(real_path, 'rb')
-    return davutils.read_blocks(infile)
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        return send_file(reqinfo, davutils.FileSlice(infile, start, stop - start))
+    else:
+        return send_multipart(infile, parts, trailer)
+
+def send_file(reqinfo, fileobj):
+    '''Return the WSGI response iterable for sending the contents of a
+    file-like object. Uses wsgi.file_wrapper if the server provides it,
+    which allows the server to transmit the file without copying it
+    through Python strings.
+    '''
+    file_wrapper = reqinfo.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(fileobj, 1024*1024)
+    else:
+        return davutils.read_blocks(fileobj)
+
+def send_multipart(infile, parts, trailer):
+    '''Generate the body of a multipart/byteranges response.
+    Parts is a list of (part_header, start, stop) tuples.
+    '''
+    for part_header, start, stop in parts:
+        yield part_header
+        for block in davutils.read_blocks(
+                davutils.FileSlice(infile, start, stop - start)):
+            yield block
+    yield trailer
+    infile.close()
 
 def handle_mkcol(reqinfo, start_response):
     '''Create a new directory.'''
@@ -326,8 +546,65 @@ def purge_locks(lockmanager, real_path):
             continue
         lockmanager.release_lock(lock.path, lock.urn)
 
+def start_job(reqinfo, start_response, operation, real_paths):
+    '''Run operation(lockmanager, progress) as a background job and answer
+    202 Accepted with the job URL, see jobs.py. The real_paths are locked
+    until the job has finished. Paths that the client has locked itself,
+    as checked by assert_locks(), are left to the locks of the client.
+    '''
+    job_id = jobs.new_job_id()
+    job_url = urlparse.urljoin(reqinfo.root_url, jobs.status_prefix + job_id)
+    owner = ('<D:owner xmlns:D="DAV:"><D:href>' + davxml.text(job_url)
+             + '</D:href></D:owner>')
+    
+    locks = []
+    try:
+        for real_path in real_paths:
+            if not reqinfo.lockmanager:
+                break
+            
+            rel_path = davutils.get_relpath(real_path, config.root_dir)
+            try:
+                locks.append(reqinfo.lockmanager.create_lock(rel_path, False,
+                    owner, -1, config.lock_max_time))
+            except DAVError, e:
+                if not e.httpstatus.startswith('423'):
+                    raise
+        
+        manager = jobs.get_job_manager()
+        manager.create(job_id, reqinfo.environ['REQUEST_METHOD'],
+            reqinfo.get_url(real_paths[0]),
+            reqinfo.environ.get('HTTP_DESTINATION'))
+        jobs.start(job_id, operation, locks)
+    except:
+        for lock in locks:
+            reqinfo.lockmanager.release_lock(lock.path, lock.urn)
+        raise
+    
+    body = json.dumps(manager.get(job_id), sort_keys = True) + '\n'
+    start_response('202 Accepted',
+        [('Location', job_url),
+         ('Preference-Applied', 'respond-async'),
+         ('Content-Type', 'application/json'),
+         ('Content-Length', str(len(body)))])
+    return [body]
+
+def handle_job_status(reqinfo, start_response, job_id):
+    '''Report the state and progress of a background job.'''
+    job = jobs.get_job_manager().get(job_id)
+    if job is None:
+        raise DAVError('404 Not Found')
+    
+    body = json.dumps(job, sort_keys = True) + '\n'
+    start_response('200 OK',
+        [('Content-Type', 'application/json'),
+         ('Content-Length', str(len(body))),
+         ('Cache-Control', 'no-cache')])
+    return [body]
+
 def handle_delete(reqinfo, start_response):
-    '''Delete a file or a directory.'''
+    '''Delete a file or a directory. A directory is deleted in a background
+    job if the client asks for it.'''
     reqinfo.assert_nobody()
     real_path = reqinfo.get_request_path('wd')
     
@@ -337,51 +614,66 @@ def handle_delete(reqinfo, start_response):
     if not os.path.exists(real_path):
         raise DAVError('404 Not Found')
     
-    if os.path.isdir(real_path):
-        shutil.rmtree(real_path)
-    else:
-        os.unlink(real_path)
+    def delete(lockmanager, progress = None):
+        trash.remove(real_path, progress)
+        purge_locks(lockmanager, real_path)
+        etags.forget(real_path)
+        return '204 No Content'
     
-    purge_locks(reqinfo.lockmanager, real_path)
+    if os.path.isdir(real_path) and jobs.wants_async(reqinfo.environ):
+        return start_job(reqinfo, start_response, delete, [real_path])
     
-    start_response('204 No Content', [])
+    start_response(delete(reqinfo.lockmanager), [])
     return ""
 
 def handle_copy_move(reqinfo, start_response):
-    '''Copy or move a file or a directory.'''
+    '''Copy or move a file or a directory. Directory trees are copied or
+    moved in a background job if the client asks for it.'''
     reqinfo.assert_nobody()
     depth = reqinfo.get_depth()
+    is_copy = reqinfo.environ['REQUEST_METHOD'] == 'COPY'
     real_source = reqinfo.get_request_path('r')
+    if not is_copy:
+        real_source = reqinfo.get_request_path('wd')
     real_dest = reqinfo.get_destination_path('w')
     
     new_resource = not os.path.exists(real_dest)
-    if not new_resource:
-        if not reqinfo.get_overwrite():
-            raise DAVError('412 Precondition Failed: Would overwrite')
-        elif os.path.isdir(real_dest):
-            shutil.rmtree(real_dest)
-        else:
-            os.unlink(real_dest)
+    if not new_resource and not reqinfo.get_overwrite():
+        raise DAVError('412 Precondition Failed: Would overwrite')
     
-    if reqinfo.environ['REQUEST_METHOD'] == 'COPY':
-        if os.path.isdir(real_source):
-            if depth == 0:
-                os.mkdir(real_dest)
-                shutil.copystat(real_source, real_dest)
+    def copy_move(lockmanager, progress = None):
+        if not new_resource:
+            trash.remove(real_dest, progress)
+            etags.forget(real_dest)
+        
+        if is_copy:
+            if os.path.isdir(real_source):
+                if depth == 0:
+                    os.mkdir(real_dest)
+                    shutil.copystat(real_source, real_dest)
+                else:
+                    filecopy.copy_tree(real_source, real_dest,
+                        config.copy_workers, progress)
             else:
-                shutil.copytree(real_source, real_dest, symlinks = True)
+                filecopy.copy_file(real_source, real_dest)
         else:
-            shutil.copy2(real_source, real_dest)
-    else:
-        real_source = reqinfo.get_request_path('wd')
-        shutil.move(real_source, real_dest)
-        purge_locks(reqinfo.lockmanager, real_source)
+            filecopy.move(real_source, real_dest, config.copy_workers,
+                progress)
+            purge_locks(lockmanager, real_source)
+            etags.forget(real_source)
+        
+        if new_resource:
+            return '201 Created'
+        else:
+            return '204 No Content'
     
-    if new_resource:
-        start_response('201 Created', [])
-    else:
-        start_response('204 No Content', [])
-    return ""    
+    if (os.path.isdir(real_source) and (depth != 0 or not is_copy)
+            and jobs.wants_async(reqinfo.environ)):
+        return start_job(reqinfo, start_response, copy_move,
+            [real_source, real_dest])
+    
+    start_response(copy_move(reqinfo.lockmanager), [])
+    return ""
 
 def handle_lock(reqinfo, start_response):
     '''Create a lock or refresh an existing one.'''
@@ -412,9 +704,7 @@ def handle_lock(reqinfo, start_response):
     start_response(status,
         [('Content-Type', 'text/xml; charset=utf-8'),
          ('Lock-Token', lock.urn)])
-    t = activelock.Template(lock = lock, reqinfo = reqinfo,
-        part_only = False)
-    return [t.serialize(output = 'xml')]
+    return [davxml.activelock(lock, reqinfo.root_url)]
 
 def handle_unlock(reqinfo, start_response):
     '''Remove an existing lock.'''
@@ -429,9 +719,14 @@ def handle_unlock(reqinfo, start_response):
     start_response('204 No Content', [])
     return ""
 
+dirindex_cache = listing.ListingCache(config.dirindex_cache_size,
+    config.dirindex_cache_time)
+
 def handle_dirindex(reqinfo, start_response, message = None):
     '''Handle a GET request for a directory.
     Result is unimportant for DAV clients and only ment for WWW browsers.
+    The query string selects the page, the sort order ('sort' and 'order')
+    and a filter for the file names.
     '''
     
     if 'r' not in config.html_interface:
@@ -453,24 +748,88 @@ def handle_dirindex(reqinfo, start_response, message = None):
     except DAVError:
         can_write = False
     
-    files = os.listdir(real_path)
-    for filename in files:
-        try:
-            reqinfo.assert_read(os.path.join(real_path, filename))
-        except DAVError, e:
-            if e.httpstatus.startswith('403'):
-                files.remove(filename) # Remove forbidden files from listing
+    query = cgi.parse_qs(reqinfo.environ.get('QUERY_STRING', ''))
+    sort = query.get('sort', ['name'])[0]
+    if not listing.sort_fields.has_key(sort):
+        sort = 'name'
+    reverse = query.get('order', [''])[0] == 'desc'
+    pattern = unicode(query.get('filter', [''])[0], 'utf-8', 'replace')
+    try:
+        page = int(query.get('page', ['1'])[0])
+    except ValueError:
+        page = 1
     
-    files.sort(key = lambda f: not os.path.isdir(os.path.join(real_path, f)))
+    def read_entries(path):
+        '''List the files that the user is allowed to see.'''
+        entries = []
+        for entry in davutils.list_directory(path):
+            st = entry.stat()
+            reqinfo.remember_stat(entry.path, st)
+            try:
+                reqinfo.assert_read(entry.path)
+            except DAVError, e:
+                if e.httpstatus[:3] in ('403', '404'):
+                    continue # Skip forbidden and removed files from listing
+                raise
+            finally:
+                reqinfo.forget_stat(entry.path)
+            entries.append((os.path.basename(entry.path),
+                stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime))
+        return entries
+    
+    dir_listing = dirindex_cache.get(real_path, reqinfo.stat(real_path),
+        read_entries)
+    entries, page, pages, total = listing.get_page(dir_listing,
+        sort, reverse, pattern, page, config.dirindex_page_size)
+    
+    def query_url(**changes):
+        '''Link to the listing with some of the parameters changed.'''
+        params = {'sort': sort, 'order': reverse and 'desc' or 'asc',
+                  'filter': pattern.encode('utf-8'), 'page': page}
+        params.update(changes)
+        defaults = {'sort': 'name', 'order': 'asc', 'filter': '', 'page': 1}
+        params = [(key, value) for key, value in sorted(params.items())
+                  if defaults[key] != value]
+        return '?' + urllib.urlencode(params)
+    
+    base_url = urlparse.urlparse(real_url).path
+    rows = []
+    for name, is_dir, size, mtime in entries:
+        href = base_url + urllib.quote(name.encode('utf-8'))
+        if is_dir:
+            href += '/'
+            size = ''
+        else:
+            size = davutils.pretty_unit(size, 1024, 0, '%0.2f') + 'B'
+        rows.append((name, is_dir, href, davutils.get_usertime(mtime), size))
+    
+    if has_parent:
+        parent_url = urlparse.urlparse(
+            reqinfo.get_url(os.path.join(real_path, '..'))).path
+    else:
+        parent_url = None
     
     start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
-    t = dirindex.Template(
-        real_url = real_url, real_path = real_path, reqinfo = reqinfo,
-        files = files, has_parent = has_parent, message = message,
-        can_write = can_write
+    t = get_template('dirindex').Template(
+        real_url = real_url, rows = rows, parent_url = parent_url,
+        message = message, can_write = can_write, query_url = query_url,
+        sort = sort, reverse = reverse, pattern = pattern,
+        page = page, pages = pages, total = total
     )
     return [t.serialize(output = 'xhtml')]
 
+# Largest accepted size of the form fields in a POST request, other than
+# uploaded files.
+max_form_size = 16*1024*1024
+
+def decode_field(value):
+    '''Decode a file name sent by the HTML form. Browsers use the
+    encoding of the page, UTF-8.'''
+    try:
+        return unicode(value, 'utf-8')
+    except UnicodeDecodeError:
+        raise DAVError('400 Bad Request: File name is not UTF-8')
+
 def handle_post(reqinfo, start_response):
     '''Handle a POST request.
     Used for file uploads and deletes in the HTML GUI.
@@ -478,44 +837,60 @@ def handle_post(reqinfo, start_response):
     if 'w' not in config.html_interface:
         raise DAVError('403 HTML interface is configured as read-only')
     
-    fields = cgi.FieldStorage(fp = reqinfo.wsgi_input, environ = reqinfo.environ)
     real_path = reqinfo.get_request_path('r')
     message = ""
+    fields = {}
     
-    if fields.getfirst('file'):
-        f = fields['file']
-        dest_path = os.path.join(real_path, f.filename)
-        reqinfo.assert_write(dest_path)
-        
-        if os.path.isdir(dest_path):
-            raise DAVError('405 Method Not Allowed: Overwriting directory')
+    content_type = reqinfo.environ.get('CONTENT_TYPE', '')
+    boundary = multipart.get_boundary(content_type)
+    if boundary is None:
+        # Form without files, application/x-www-form-urlencoded
+        body = reqinfo.wsgi_input.read(max_form_size + 1)
+        if len(body) > max_form_size:
+            raise DAVError('413 Request Entity Too Large')
+        fields = cgi.parse_qs(body)
+    else:
+        parser = multipart.MultipartParser(reqinfo.wsgi_input, boundary,
+            reqinfo.length)
+        for part in parser:
+            if part.filename is None:
+                davutils.add_to_dict_list(fields, part.name,
+                    part.read_value(max_form_size))
+            elif part.filename:
+                filename = decode_field(part.filename)
+                dest_path = os.path.join(real_path, filename)
+                reqinfo.assert_write(dest_path)
+                
+                if os.path.isdir(dest_path):
+                    raise DAVError('405 Method Not Allowed: Overwriting directory')
+                
+                # The file is written straight from the request body.
+                write_file(dest_path, part.read_blocks())
+                
+                message = "Successfully uploaded " + filename + "."
     
-        if os.path.exists(dest_path):
-            os.unlink(dest_path)
-        
-        outfile = open(dest_path, 'wb')
-        davutils.write_blocks(outfile, davutils.read_blocks(f.file))
-        
-        message = "Successfully uploaded " + f.filename + "."
+    def getfirst(name):
+        return fields.get(name, [None])[0]
     
-    if fields.getfirst('btn_remove'):
-        filenames = fields.getlist('select')
+    def getlist(name):
+        return [decode_field(value) for value in fields.get(name, [])]
+    
+    if getfirst('btn_remove'):
+        filenames = getlist('select')
         
         for f in filenames:
             rm_path = os.path.join(real_path, f)
             reqinfo.assert_write(rm_path)
-            
-            if os.path.isdir(rm_path):
-                shutil.rmtree(rm_path)
-            else:
-                os.unlink(rm_path)
+            trash.remove(rm_path)
+            etags.forget(rm_path)
         
         message = "Successfully removed " + str(len(filenames)) + " files."
     
-    if fields.getfirst('btn_download'):
-        filenames = fields.getlist('select')
-        datafile = tempfile.TemporaryFile()
-        zipobj = zipfile.ZipFile(datafile, 'w', zipfile.ZIP_DEFLATED, True)
+    if message:
+        reqinfo.forget_stat()
+    
+    if getfirst('btn_download'):
+        filenames = getlist('select')
         
         def check_read(path):
             '''Callback function for zipping to verify that each file in
@@ -526,21 +901,23 @@ def handle_post(reqinfo, start_response):
             except DAVError:
                 return False
         
+        def store(path, head):
+            '''Callback function for zipping to select the files that are
+            already compressed.'''
+            return (davutils.get_matcher(config.zip_store_files).match(path)
+                    or zipstream.is_compressed_dicom(head))
+        
+        paths = []
         for f in filenames:
             file_path = os.path.join(real_path, f)
             reqinfo.assert_read(file_path)
-            davutils.add_to_zip_recursively(zipobj, file_path,
-                config.root_dir, check_read)
-        
-        zipobj.close()
+            paths.append(file_path)
         
-        start_response('200 OK', [
-            ('Content-Type', 'application/zip'),
-            ('Content-Length', str(datafile.tell()))
-        ])
-        
-        datafile.seek(0)
-        return davutils.read_blocks(datafile)
+        # The archive is sent while it is being compressed. Without
+        # Content-Length the server uses chunked transfer encoding.
+        start_response('200 OK', [('Content-Type', 'application/zip')])
+        return davutils.join_blocks(zipstream.zip_recursively(paths,
+            config.root_dir, check_read, store, config.zip_workers))
     
     return handle_dirindex(reqinfo, start_response, message)
 
@@ -560,14 +937,120 @@ request_handlers = {
     'POST': handle_post,
 }
 
+if config.metrics_path:
+    for method, handler in request_handlers.items():
+        request_handlers[method] = metrics.timed(metrics.handler_duration,
+            (handler.__name__, ), handler)
+
+def handle_metrics(environ, start_response):
+    '''Serve the metrics of the process, see metrics.py.'''
+    body = metrics.expose()
+    start_response('200 OK',
+        [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+         ('Content-Length', str(len(body))),
+         ('Cache-Control', 'no-cache')])
+    return [body]
+
+class MeasuredResponse(object):
+    '''Runs handle_request() and passes on its response body, counting
+    the bytes. The metrics and the access log line of the request are
+    recorded when the server closes the response after sending it.
+    Use response() to get the object to return to the server.
+    '''
+    def __init__(self, environ, start_response):
+        self.environ = environ
+        self.method = environ.get('REQUEST_METHOD', '').upper()
+        if not request_handlers.has_key(self.method):
+            self.method = 'other' # Keep the number of labels bounded
+        self.code = '500'
+        self.bytes_sent = 0
+        self.content_length = None
+        self.file_response = None
+        self.start = time.time()
+        self.lock_db_start = metrics.request_times.lock_db
+        self.fs_start = metrics.request_times.fs
+        if config.metrics_path:
+            metrics.requests_in_progress.inc()
+        
+        def measured_start_response(status, headers, exc_info = None):
+            self.code = status[:3]
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    self.content_length = int(value)
+            return start_response(status, headers, exc_info)
+        
+        self.body = handle_request(environ, measured_start_response)
+    
+    def response(self):
+        '''Return self, or for a file response an object of the
+        wsgi.file_wrapper class, so that the server can still send the
+        file with sendfile().'''
+        self.file_response = davutils.wrap_file_response(self.environ,
+            self.body, self.record)
+        return self.file_response or self
+    
+    def __iter__(self):
+        for data in self.body:
+            self.bytes_sent += len(data)
+            yield data
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.record()
+    
+    def record(self):
+        '''Record the metrics and the access log line of the request.'''
+        if self.file_response is not None:
+            # Files sent with sendfile() do not pass through the wrapper.
+            self.bytes_sent = (self.file_response.bytes_sent
+                               or self.content_length or 0)
+        
+        duration = time.time() - self.start
+        bytes_read = 0
+        wsgi_input = self.environ.get('wsgi.input')
+        if isinstance(wsgi_input, WSGIInputWrapper):
+            bytes_read = wsgi_input.bytes_read
+        
+        if config.metrics_path:
+            labels = (self.method, )
+            metrics.requests_in_progress.dec()
+            metrics.requests.inc((self.method, self.code))
+            metrics.request_duration.observe(duration, labels)
+            metrics.response_bytes.inc(labels, self.bytes_sent)
+            metrics.request_bytes.inc(labels, bytes_read)
+        
+        if config.access_log:
+            accesslog.log_request(self.environ, int(self.code), bytes_read,
+                self.bytes_sent, duration,
+                metrics.request_times.lock_db - self.lock_db_start,
+                metrics.request_times.fs - self.fs_start)
+
 def main(environ, start_response):
-    '''Main WSGI program to handle requests. Calls handlers from
-    request_handlers.
+    '''Main WSGI program to handle requests. Serves the metrics on
+    config.metrics_path and records them and the access log for the
+    other requests.
+    '''
+    if not config.metrics_path and not config.access_log:
+        return handle_request(environ, start_response)
+    
+    if (config.metrics_path and
+            environ.get('PATH_INFO', '').strip('/') == config.metrics_path):
+        return handle_metrics(environ, start_response)
+    
+    return MeasuredResponse(environ, start_response).response()
+
+def handle_request(environ, start_response):
+    '''Handle a request by calling the handler from request_handlers.
+    DAVErrors raised by the handlers are sent to the client.
     '''
     try:
-        logging.info(environ.get('REMOTE_ADDR')
-            + ' ' + environ.get('REQUEST_METHOD')
-            + ' ' + environ.get('PATH_INFO'))
+        if not config.access_log:
+            logging.info(environ.get('REMOTE_ADDR')
+                + ' ' + environ.get('REQUEST_METHOD')
+                + ' ' + environ.get('PATH_INFO'))
         
         request_method = environ.get('REQUEST_METHOD', '').upper()
         
@@ -579,13 +1062,21 @@ def main(environ, start_response):
         
         environ['wsgi.input'] = WSGIInputWrapper(environ)
         
+        if config.trash_dir:
+            # Empties the trash left by earlier runs of the server.
+            trash.start_reaper()
+        
         try:
             reqinfo = RequestInfo(environ)
-            if request_handlers.has_key(request_method):
+            job_id = jobs.parse_status_path(reqinfo.parse_request_path())
+            if job_id is not None and request_method in ('GET', 'HEAD'):
+                return handle_job_status(reqinfo, start_response, job_id)
+            elif request_handlers.has_key(request_method):
                 return request_handlers[request_method](reqinfo, start_response)
             else:
                 raise DAVError('501 Not Implemented')
         except DAVError, e:
+            metrics.errors.inc((e.httpstatus[:3], ))
             environ['wsgi.input'].read() # Discard request body
             if not e.body:
                 logging.warn(e.httpstatus)
@@ -613,7 +1104,9 @@ def main(environ, start_response):
         
         return [exc]
 
+if profiling.is_enabled():
+    main = profiling.profiled(main)
+
 if __name__ == '__main__':
-    from wsgiref.simple_server import make_server
-    server = make_server('0.0.0.0', 8085, main)
-    server.serve_forever()
+    import server
+    server.serve_forever(main)
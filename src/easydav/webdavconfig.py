@@ -26,7 +26,7 @@ root_url = None
 restrict_access = [
     '.ht*',
     '.svn',
-    '.easydav_locks'
+    '.easydav_*'
 ]
     
 # Deny write access to these files.
@@ -50,6 +50,56 @@ restrict_write = [
 # Allowed values: '' (no html interface), 'r' (read only) or 'rw' (read write)
 html_interface = 'rw'
 
+# Number of files per page in the directory listings of the HTML interface.
+dirindex_page_size = 500
+
+# Directory listings of the HTML interface are kept in memory for this many
+# directories. A cached listing is used until files are added to, removed
+# from or renamed in the directory, or until it is dirindex_cache_time
+# seconds old, so changes made inside files by other programs show up after
+# at most that time.
+dirindex_cache_size = 32
+dirindex_cache_time = 10
+
+# ETags identify versions of files for caching and conditional requests.
+# 'stat' derives them from the inode, modification time and size of a file.
+# 'content' uses a SHA-1 hash of the file contents, so a file that is saved
+# again with identical bytes keeps its ETag. The hash is computed when the
+# ETag is first needed after a change, which reads the whole file. It is
+# stored in an extended attribute of the file if the python xattr module
+# is installed, and otherwise in the etag_db database.
+etag_mode = 'stat'
+
+# Database file for content hashes. Path can be relative to root_dir
+# or absolute.
+etag_db = '.easydav_etags'
+
+# Cache-Control header sent with downloaded files, or None to leave it out.
+# The default lets clients keep copies but makes them check with the server
+# before using them. Unchanged files are then answered with a short
+# 304 Not Modified response.
+cache_control = 'private, no-cache'
+
+# Files that the "Download selected" button of the HTML interface puts in
+# the ZIP archive without compressing them again, because they are already
+# compressed. DICOM files with a compressed transfer syntax, such as
+# JPEG 2000, are detected automatically.
+zip_store_files = [
+    '*.gz', '*.bz2', '*.xz', '*.zip', '*.7z',
+    '*.jpg', '*.jpeg', '*.png', '*.jp2', '*.j2k',
+    '*.mp4', '*.mkv', '*.mp3',
+]
+
+# Number of threads that compress the files of a ZIP download in parallel.
+# The threads are shared by all requests. 1 compresses in the thread that
+# serves the request.
+zip_workers = 4
+
+# Number of threads that copy the files of a directory tree in COPY
+# requests, and in MOVE requests between file systems. The threads are
+# shared by all requests. 1 copies in the thread that serves the request.
+copy_workers = 4
+
 # File name normalization
 # Unicode can express same letters in multiple forms, such as composed and
 # decomposed forms. Therefore it is possible to have two filenames that
@@ -64,6 +114,62 @@ html_interface = 'rw'
 # use None to disable normalization.
 unicode_normalize = 'NFC'
 
+# Uploads are written to a temporary file that replaces the old file only
+# when the whole request body has been received. The setting upload_fsync
+# controls how the new file is flushed to disk before it is reported as
+# written:
+# None    leaves it to the operating system,
+# 'file'  flushes the file data before renaming it in place,
+# 'dir'   also flushes the directory, so the rename survives a power failure.
+upload_fsync = 'file'
+
+# Reserve disk space for uploads with a known length before writing them.
+# This reduces fragmentation and fails early if the disk is full.
+upload_preallocate = True
+
+# Large files can be uploaded in pieces, with PUT requests that have a
+# Content-Range header. An interrupted upload can then be resumed by sending
+# only the missing pieces. The received parts are tracked in this database.
+# Path can be relative to root_dir or absolute. None disables resumable
+# uploads.
+upload_db = '.easydav_uploads'
+
+# Seconds after which an unfinished resumable upload that has not received
+# any data is removed.
+upload_expire = 86400
+
+# Deleted files and directories are renamed into this hidden directory,
+# which takes the same short time regardless of the number of files.
+# A background thread then removes them with idle CPU and disk priority.
+# The name must match restrict_access, as the default '.easydav_*' does.
+# Path can be relative to root_dir or absolute, but must be on the same
+# file system as the files; otherwise they are removed directly. None
+# removes all files directly, which is also best when running as CGI.
+trash_dir = '.easydav_trash'
+
+# Background jobs for DELETE, COPY and MOVE of directories. When enabled,
+# a client can send the header 'Prefer: respond-async' to get the answer
+# 202 Accepted at once, with a job URL in the Location header that reports
+# the progress and the final status. The resources are locked while the
+# job runs. Jobs need a long-running server process, so leave this off
+# when running as CGI.
+async_jobs = False
+
+# Database file for the state of background jobs. Path can be relative to
+# root_dir or absolute.
+job_db = '.easydav_jobs'
+
+# Seconds that the status of a finished job is kept.
+job_expire = 3600
+
+# Number of jobs that run at the same time in each server process.
+job_workers = 2
+
+# Maximum number of entries returned by a PROPFIND request with
+# Depth: infinity, or None for no limit. Longer listings are cut off and
+# end with a 507 Insufficient Storage status for the requested collection.
+propfind_max_entries = None
+
 # Lock configuration
 
 # Lock database file, set to None to disable lock support.
@@ -80,6 +186,90 @@ lock_max_time = 3600
 # 503 Service Unavailable errors.
 lock_wait = 5
 
+# Interval in seconds between removing expired locks from the lock
+# database. Expired locks are ignored even before they are removed.
+lock_purge_interval = 60
+
+# Storage profile of the lock database. It also applies to the upload,
+# job and ETag databases.
+#
+# Journal mode 'WAL' lets requests check locks while another request is
+# creating or removing one. It needs shared memory between the processes
+# using the database, so use 'DELETE' if the lock database is on a network
+# file system. None leaves the mode stored in the database file unchanged.
+lock_journal_mode = 'WAL'
+
+# How often SQLite waits for data to reach the disk: 'OFF', 'NORMAL' or
+# 'FULL'. With WAL, 'NORMAL' may lose the latest lock changes on power
+# failure but never corrupts the database.
+lock_synchronous = 'NORMAL'
+
+# Bytes of the database file to access through memory mapping, 0 to
+# disable or None to use the SQLite default.
+lock_mmap_size = 0
+
+# Number of prepared SQL statements to keep per database connection.
+lock_cached_statements = 100
+
+# Path of the metrics for Prometheus, relative to the root url, or None to
+# disable them. The metrics include request rates, latencies, bytes
+# transferred, lock database times and errors, and the CPU and memory
+# used by the server process.
+metrics_path = '.easydav_metrics'
+
+# Profiling of single requests with cProfile. A profile and a summary of
+# the slowest functions are written to profile_dir for each profiled
+# request. When none of profile_all, profile_sample and profile_token are
+# set, the requests run without any profiling code.
+
+# Directory for the profiles, must be outside root_dir.
+profile_dir = '/tmp/easydav-profiles'
+
+# Profile every request, for debugging only.
+profile_all = False
+
+# Fraction of requests to profile, e.g. 0.001, or 0 to disable.
+profile_sample = 0
+
+# Profile the requests that have the header 'X-EasyDAV-Profile: <token>'.
+# Set to a secret string to enable, as anybody with the token can make the
+# server write profiles.
+profile_token = None
+
+# Number of functions listed in the profile summaries.
+profile_top = 30
+
+# Stand-alone server
+# These settings only apply when webdav.py is run directly, instead of
+# through CGI or FCGI.
+
+# Address and port to listen on.
+server_host = '0.0.0.0'
+server_port = 8085
+
+# Concurrency model:
+# 'single' serves one request at a time (plain wsgiref),
+# 'thread' uses a pool of server_workers threads,
+# 'process' forks server_workers processes sharing the listening socket.
+server_mode = 'thread'
+
+# Number of worker threads or processes, i.e. how many requests can be
+# served at the same time.
+server_workers = 8
+
+# Maximum number of pending connections in the listen queue.
+server_backlog = 64
+
+# Seconds to keep an idle HTTP/1.1 connection open for the next request,
+# or 0 to close the connection after each response. Note that an idle
+# connection occupies a worker for this time.
+server_keepalive = 15
+
+# Seconds a client may stall while sending a request or receiving the
+# response before the connection is closed, or 0 to wait forever.
+# Otherwise a client that stops halfway occupies a worker indefinitely.
+server_timeout = 60
+
 # Error logging
 
 # Log path, set to None to disable logging.
@@ -95,3 +285,18 @@ log_file = 'easydav.log'
 # FATAL = 50
 log_level = 30
 
+# Access log with one JSON line per request, including the status, bytes,
+# duration and the time spent in the lock database and the file system.
+# Path can be relative to webdav.py location or absolute, None to disable.
+access_log = 'easydav-access.log'
+
+# Fraction of successful requests logged in the access log, by method.
+# Errors are always logged, and so are requests that take longer than
+# access_log_slow seconds.
+access_log_sample = {'PROPFIND': 0.1}
+access_log_slow = 1.0
+
+# Log records are written by a background thread. If this many records
+# are waiting to be written, new records are dropped.
+log_queue_size = 10000
+
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+'''Writes ZIP archives as a stream of strings, so that they can be sent
+to the client while the files are being read and compressed. The sizes
+and checksums of each file follow its data in a data descriptor, and
+ZIP64 records are used for files and archives larger than 4 GB.
+'''
+
+import collections
+import itertools
+import os.path
+import stat
+import struct
+import time
+import zlib
+import davutils
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+DATA_DESCRIPTOR64 = struct.Struct('<4sLQQ')
+END_RECORD = struct.Struct('<4sHHHHLLH')
+END_RECORD64 = struct.Struct('<4sQHHLLQQQQ')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+FLAG_DATA_DESCRIPTOR = 0x08
+VERSION = 20
+VERSION64 = 45
+MADE_BY_UNIX = 3 << 8
+
+def dos_datetime(mtime):
+    '''Convert a timestamp to the (time, date) pair used in ZIP headers.'''
+    t = time.localtime(mtime)
+    if t[0] < 1980:
+        t = (1980, 1, 1, 0, 0, 0)
+    return (t[3] << 11 | t[4] << 5 | t[5] // 2,
+            (t[0] - 1980) << 9 | t[1] << 5 | t[2])
+
+def is_compressed_dicom(head):
+    '''Check if the data is the beginning of a DICOM file that uses a
+    compressed transfer syntax, such as JPEG, JPEG 2000 or RLE.
+    '''
+    if head[128:132] != 'DICM':
+        return False
+    
+    # Transfer Syntax UID (0002,0010) in the explicit VR file meta group
+    pos = head.find('\x02\x00\x10\x00UI', 132)
+    if pos < 0 or pos + 8 > len(head):
+        return False
+    
+    length = struct.unpack('<H', head[pos + 6:pos + 8])[0]
+    uid = head[pos + 8:pos + 8 + length].rstrip('\0 ')
+    return (uid.startswith('1.2.840.10008.1.2.4.')
+            or uid in ('1.2.840.10008.1.2.5', '1.2.840.10008.1.2.1.99'))
+
+def compress_block(data, compresslevel):
+    '''Compress a block independently of the other blocks of the file.
+    The sync flush ends the output on a byte boundary, so that compressed
+    blocks can be concatenated into one deflate stream.
+    '''
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def lookahead(iterable, count):
+    '''Iterate over iterable, keeping count items fetched in advance.
+    This lets the work started when producing the items run in the
+    background while the earlier items are consumed.
+    '''
+    items = collections.deque()
+    for item in iterable:
+        items.append(item)
+        if len(items) > count:
+            yield items.popleft()
+    
+    while items:
+        yield items.popleft()
+
+_pool = davutils.SharedThreadPool()
+
+def get_pool(workers):
+    '''Return a thread pool for compressing ZIP entries, shared by all
+    requests of the process. The zlib module releases the GIL while
+    compressing, so the threads can use multiple cores.
+    '''
+    return _pool.get(workers)
+
+class ZipEntry(object):
+    '''Information about a file in the archive for the central directory.'''
+    def __init__(self, arcname, st, method):
+        self.arcname = arcname
+        self.mode = st.st_mode
+        self.dostime, self.dosdate = dos_datetime(st.st_mtime)
+        self.method = method
+        self.offset = 0
+        self.crc = 0
+        self.compressed_size = 0
+        self.file_size = 0
+        self.zip64 = False
+        self.flags = 0
+
+# Parts of the archive passed from ZipStream._read_files to generate().
+HEADER, DATA, END = range(3)
+
+class ZipStream(object):
+    '''ZIP archive writer that produces the archive as strings instead of
+    writing to a seekable file.
+    
+    Store is a function store(real_path, head) that returns True for files
+    that should be stored without compression, head being the first block
+    of the file.
+    
+    If pool is given, the blocks of each file are compressed separately
+    by the threads of the pool. Up to lookahead blocks are read and
+    compressed ahead of the data that has been sent.
+    '''
+    zip64_limit = 0xFFFFFFFF
+    zip64_count = 0xFFFF
+    
+    def __init__(self, compresslevel = zlib.Z_DEFAULT_COMPRESSION,
+                 store = None, blocksize = 1024*1024,
+                 pool = None, lookahead = 16):
+        self.compresslevel = compresslevel
+        self.store = store
+        self.blocksize = blocksize
+        self.pool = pool
+        self.lookahead = lookahead
+        self.entries = []
+        self.offset = 0
+    
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+    
+    def _local_header(self, entry):
+        arcname = entry.arcname
+        if entry.zip64:
+            # Sizes are in the ZIP64 data descriptor after the data.
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+            version = VERSION64
+        else:
+            extra = ''
+            sizes = (0, 0)
+            version = VERSION
+        
+        return LOCAL_HEADER.pack('PK\x03\x04', version, entry.flags,
+            entry.method, entry.dostime, entry.dosdate, 0, sizes[0], sizes[1],
+            len(arcname), len(extra)) + arcname + extra
+    
+    def _data_descriptor(self, entry):
+        if entry.zip64:
+            return DATA_DESCRIPTOR64.pack('PK\x07\x08', entry.crc,
+                entry.compressed_size, entry.file_size)
+        else:
+            return DATA_DESCRIPTOR.pack('PK\x07\x08', entry.crc,
+                entry.compressed_size, entry.file_size)
+    
+    def _read_files(self, files):
+        '''Read the files and yield the parts of the archive as tuples
+        (HEADER, entry), (DATA, entry, data) and (END, entry). Data is either
+        a string or a pending result from the pool. The offsets and the
+        compressed sizes are filled in by generate().
+        '''
+        for real_path, arcname, st in files:
+            if stat.S_ISDIR(st.st_mode):
+                entry = ZipEntry(arcname.rstrip('/') + '/', st, ZIP_STORED)
+                yield HEADER, entry
+                yield END, entry
+                continue
+            
+            try:
+                infile = open(real_path, 'rb')
+            except IOError:
+                continue # Removed or unreadable, skip
+            
+            try:
+                size = st.st_size
+                head = infile.read(min(size, self.blocksize))
+                
+                if self.store is not None and self.store(real_path, head):
+                    entry = ZipEntry(arcname, st, ZIP_STORED)
+                else:
+                    entry = ZipEntry(arcname, st, ZIP_DEFLATED)
+                entry.flags = FLAG_DATA_DESCRIPTOR
+                
+                # Deflate can make incompressible data slightly larger.
+                entry.zip64 = size + (size >> 8) + 1024 >= self.zip64_limit
+                yield HEADER, entry
+                
+                compressor = None
+                if entry.method == ZIP_DEFLATED:
+                    compressor = zlib.compressobj(self.compresslevel,
+                                                  zlib.DEFLATED, -15)
+                
+                crc = 0
+                blocks = davutils.read_blocks(infile, size - len(head),
+                                              self.blocksize)
+                for data in itertools.chain([head], blocks):
+                    crc = zlib.crc32(data, crc)
+                    entry.file_size += len(data)
+                    if compressor is None:
+                        pass
+                    elif self.pool is not None:
+                        data = self.pool.apply_async(compress_block,
+                            (data, self.compresslevel))
+                    else:
+                        data = compressor.compress(data)
+                    yield DATA, entry, data
+                
+                if compressor is not None:
+                    # Ends the deflate stream, also after separately
+                    # compressed blocks.
+                    yield DATA, entry, compressor.flush()
+            finally:
+                infile.close()
+            
+            entry.crc = crc & 0xFFFFFFFF
+            yield END, entry
+    
+    def generate(self, files):
+        '''Yield the ZIP archive of files, which is an iterable of
+        (real_path, arcname, st) tuples. St is the os.stat() result of
+        the file. Files that can not be opened are skipped.
+        '''
+        parts = self._read_files(files)
+        if self.pool is not None:
+            parts = lookahead(parts, self.lookahead)
+        
+        for part in parts:
+            entry = part[1]
+            if part[0] == HEADER:
+                entry.offset = self.offset
+                yield self._out(self._local_header(entry))
+            elif part[0] == DATA:
+                data = part[2]
+                if not isinstance(data, str):
+                    data = data.get()
+                entry.compressed_size += len(data)
+                if data:
+                    yield self._out(data)
+            else:
+                self.entries.append(entry)
+                if entry.flags & FLAG_DATA_DESCRIPTOR:
+                    yield self._out(self._data_descriptor(entry))
+        
+        for data in self.close():
+            yield data
+    
+    def _central_header(self, entry):
+        extra = []
+        values = []
+        for value in (entry.file_size, entry.compressed_size, entry.offset):
+            if value >= self.zip64_limit:
+                extra.append(value)
+                value = 0xFFFFFFFF
+            values.append(value)
+        
+        if extra:
+            extra = struct.pack('<HH' + 'Q' * len(extra),
+                                1, 8 * len(extra), *extra)
+            version = VERSION64
+        else:
+            extra = ''
+            version = entry.zip64 and VERSION64 or VERSION
+        
+        external_attr = (entry.mode & 0xFFFF) << 16
+        if stat.S_ISDIR(entry.mode):
+            external_attr |= 0x10 # MS-DOS directory flag
+        
+        file_size, compressed_size, offset = values
+        return CENTRAL_HEADER.pack('PK\x01\x02', MADE_BY_UNIX | version,
+            version, entry.flags, entry.method, entry.dostime, entry.dosdate,
+            entry.crc, compressed_size, file_size, len(entry.arcname),
+            len(extra), 0, 0, 0, external_attr, offset
+            ) + entry.arcname + extra
+    
+    def close(self):
+        '''Yield the central directory that ends the archive.'''
+        start = self.offset
+        for entry in self.entries:
+            yield self._out(self._central_header(entry))
+        
+        count = len(self.entries)
+        size = self.offset - start
+        
+        if (count >= self.zip64_count or size >= self.zip64_limit
+                or start >= self.zip64_limit):
+            record_offset = self.offset
+            yield self._out(END_RECORD64.pack('PK\x06\x06',
+                END_RECORD64.size - 12, MADE_BY_UNIX | VERSION64, VERSION64,
+                0, 0, count, count, size, start))
+            yield self._out(END_LOCATOR64.pack('PK\x06\x07',
+                0, record_offset, 1))
+            count = min(count, 0xFFFF)
+            size = min(size, 0xFFFFFFFF)
+            start = min(start, 0xFFFFFFFF)
+        
+        yield self._out(END_RECORD.pack('PK\x05\x06', 0, 0,
+            count, count, size, start, 0))
+
+def zip_recursively(paths, root_dir, check_read, store = None, workers = 1):
+    '''Generate a ZIP archive of the files at paths, and if they are
+    directories, all files under them. Otherwise works like
+    davutils.add_to_zip_recursively. If workers is above 1, files are
+    compressed by a pool of that many threads.
+    '''
+    if not root_dir.endswith('/'):
+        root_dir += '/'
+    
+    def forbidden(entry):
+        '''Do not enter directories that are left out of the archive.'''
+        return not check_read(entry.path)
+    
+    def files():
+        for real_path in paths:
+            for entry in davutils.walk_directory(real_path,
+                                                 prune = forbidden):
+                path = entry.path
+                st = entry.stat()
+                if st is None:
+                    continue # Removed while walking
+                
+                if not check_read(path):
+                    continue
+                
+                assert path[:len(root_dir)] == root_dir
+                arcname = path[len(root_dir):].encode('cp437', 'replace')
+                yield path, arcname, st
+    
+    if workers > 1:
+        zipobj = ZipStream(store = store, pool = get_pool(workers),
+                           lookahead = workers * 4)
+    else:
+        zipobj = ZipStream(store = store)
+    
+    return zipobj.generate(files())
+
+if __name__ == '__main__':
+    import shutil
+    import StringIO
+    import tempfile
+    import zipfile
+    print "Unit tests"
+    
+    testdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(testdir, u'dir', u'sub'))
+    open(os.path.join(testdir, u'dir', u'a.txt'), 'wb').write('hello ' * 1000)
+    open(os.path.join(testdir, u'dir', u'sub', u'b.gz'), 'wb').write(
+        os.urandom(300000))
+    open(os.path.join(testdir, u'dir', u'empty'), 'wb').close()
+    
+    dicom = '\0' * 128 + 'DICM' + '\x02\x00\x10\x00UI\x16\x00' + \
+        '1.2.840.10008.1.2.4.90'
+    open(os.path.join(testdir, u'dir', u'image'), 'wb').write(dicom)
+    assert is_compressed_dicom(dicom)
+    assert not is_compressed_dicom(dicom.replace('1.2.4.90', '1.2.1\0\0\0'))
+    
+    def store(path, head):
+        return path.endswith('.gz') or is_compressed_dicom(head)
+    
+    def check(zipdata):
+        zipobj = zipfile.ZipFile(StringIO.StringIO(zipdata))
+        assert zipobj.testzip() is None
+        infos = dict((i.filename, i) for i in zipobj.infolist())
+        assert sorted(infos) == ['dir/', 'dir/a.txt', 'dir/empty',
+                                 'dir/image', 'dir/sub/', 'dir/sub/b.gz']
+        assert zipobj.read('dir/a.txt') == 'hello ' * 1000
+        assert infos['dir/a.txt'].compress_type == ZIP_DEFLATED
+        assert infos['dir/sub/b.gz'].compress_type == ZIP_STORED
+        assert infos['dir/image'].compress_type == ZIP_STORED
+        assert zipobj.read('dir/image') == dicom
+        return infos
+    
+    check(''.join(zip_recursively([os.path.join(testdir, u'dir')],
+                                  testdir, lambda p: True, store)))
+    
+    # Blocks compressed in parallel form one deflate stream
+    big = ''.join(str(i) for i in xrange(200000))
+    open(os.path.join(testdir, u'dir', u'a.txt'), 'wb').write(big)
+    zipdata = ''.join(ZipStream(blocksize = 4096, pool = get_pool(4)).generate(
+        [(os.path.join(testdir, u'dir', u'a.txt'), 'a.txt',
+          os.stat(os.path.join(testdir, u'dir', u'a.txt')))]))
+    assert zipfile.ZipFile(StringIO.StringIO(zipdata)).read('a.txt') == big
+    open(os.path.join(testdir, u'dir', u'a.txt'), 'wb').write('hello ' * 1000)
+    check(''.join(zip_recursively([os.path.join(testdir, u'dir')],
+                                  testdir, lambda p: True, store, 4)))
+    
+    # Force ZIP64 records for all sizes, offsets and the entry count
+    ZipStream.zip64_limit = 1000
+    ZipStream.zip64_count = 2
+    infos = check(''.join(zip_recursively([os.path.join(testdir, u'dir')],
+                                          testdir, lambda p: True, store)))
+    assert infos['dir/sub/b.gz'].file_size == 300000
+    
+    # Forbidden directories are neither included nor entered
+    walked = []
+    def check_read(path):
+        walked.append(path)
+        return not path.endswith('sub')
+    zipdata = ''.join(zip_recursively([os.path.join(testdir, u'dir')],
+                                      testdir, check_read, store))
+    names = zipfile.ZipFile(StringIO.StringIO(zipdata)).namelist()
+    assert sorted(names) == ['dir/', 'dir/a.txt', 'dir/empty', 'dir/image']
+    assert not [path for path in walked if 'b.gz' in path]
+    
+    shutil.rmtree(testdir)
+    print "Unit tests OK"